@@ -0,0 +1,120 @@
+"""
+bulk_packer.py — NumPy-backed bulk packing for very large fleets.
+
+NodeAssigner and WANManager switch to these routines when NumPy is installed
+and the number of devices to place reaches their vectorized_threshold. Device
+rows are loaded as (rowid, download, upload) integer arrays, placed in bulk and
+written back by rowid with a single executemany.
+
+NumPy is optional: HAS_NUMPY is False when it is missing and callers keep using
+their pure-Python heap implementations.
+"""
+
+import logging
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    np = None
+    HAS_NUMPY = False
+
+logger = logging.getLogger(__name__)
+
+
+class BulkPacker:
+
+    @staticmethod
+    def load(conn, sql, params=()):
+        """
+        Run a query selecting rowid followed by integer load columns
+        (download, upload, ...) and return it as an (n, columns) int64 array.
+        """
+        cur = conn.execute(sql, params)
+        return BulkPacker.load_rows(cur.fetchall(), len(cur.description))
+
+    @staticmethod
+    def load_rows(rows, width=3):
+        """Convert already-fetched (rowid, download, upload, ...) rows to an int64 array."""
+        if not rows:
+            return np.zeros((0, width), dtype=np.int64)
+        return np.asarray(rows, dtype=np.int64)
+
+    @staticmethod
+    def device_loads(rows, dl_col=1, ul_col=2):
+        """(download, upload, circuit count = 1) columns of a load() result."""
+        return np.column_stack([rows[:, dl_col], rows[:, ul_col], np.ones(len(rows), dtype=np.int64)])
+
+    @staticmethod
+    def pack_balanced(values, bin_count, capacities=None):
+        """
+        Balance an (n, d) array of loads across bin_count bins.
+
+        Columns are normalised to their ideal per-bin share, items sorted by
+        their largest normalised component, and placed a chunk at a time: the
+        heaviest item of each chunk goes to the bin with the lowest peak so
+        far. With equal bins every bin gets one item per chunk of bin_count, so
+        counts differ by at most one and per-dimension loads by at most one
+        item. With capacities, peaks are relative to each bin's share and
+        chunks are halved so bigger bins can take items more often.
+        Returns an int array with a bin index per row.
+        """
+        n = len(values)
+        placement = np.zeros(n, dtype=np.int64)
+        if n == 0 or bin_count <= 0:
+            return placement
+
+        totals = values.sum(axis=0).astype(np.float64)
+        norm   = values * (bin_count / np.where(totals > 0, totals, 1.0))
+        order  = np.argsort(-norm.max(axis=1), kind='stable')
+        loads  = np.zeros((bin_count, values.shape[1]))
+        chunk  = bin_count
+        scale  = np.ones(bin_count)
+        if capacities is not None and len(set(capacities)) > 1:
+            caps  = np.asarray(capacities, dtype=np.float64)
+            scale = caps.sum() / (caps * bin_count)
+            chunk = max(bin_count // 2, 1)
+
+        for start in range(0, n, chunk):
+            idx  = order[start:start + chunk]
+            bins = np.argsort(loads.max(axis=1), kind='stable')[:len(idx)]
+            placement[idx] = bins
+            loads[bins] += norm[idx] * scale[bins, None]
+        return placement
+
+    @staticmethod
+    def pack_to_targets(weights, targets):
+        """
+        Split a 1-D weight array into len(targets) groups whose sums follow the
+        given targets (any non-negative scale).
+
+        Items are shuffled with a fixed seed so every stretch of the sequence
+        carries a similar size mix, then cut at the cumulative target
+        boundaries — each group lands within one item of its share.
+        Returns an int array with a group index per item.
+        """
+        n, k = len(weights), len(targets)
+        if n == 0 or k == 0:
+            return np.zeros(n, dtype=np.int64)
+
+        targets = np.asarray(targets, dtype=np.float64)
+        if targets.sum() <= 0:
+            targets = np.ones(k)
+
+        perm   = np.random.default_rng(0).permutation(n)
+        w      = weights[perm].astype(np.float64)
+        cum    = np.cumsum(w)
+        bounds = np.cumsum(targets) * (cum[-1] / targets.sum())
+
+        groups = np.empty(n, dtype=np.int64)
+        groups[perm] = np.minimum(np.searchsorted(bounds, cum - w / 2, side='right'), k - 1)
+        return groups
+
+    @staticmethod
+    def bin_totals(values, placement, bin_count):
+        """Per-bin column sums of an (n, d) array as a (bin_count, d) int array."""
+        return np.stack([
+            np.bincount(placement, weights=values[:, d], minlength=bin_count)
+            for d in range(values.shape[1])
+        ], axis=1).astype(np.int64)
+
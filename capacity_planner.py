@@ -0,0 +1,188 @@
+"""
+capacity_planner.py — offline what-if comparison of NodeAssigner strategies.
+
+Copies a devices.db snapshot into memory, runs every strategy (plus full with
+promote_to_root) against the copy and reports, per strategy:
+  - per top-level node load (plan DL/UL) and circuit count
+  - load skew ratio (same check NodeAssigner logs at runtime)
+  - network.json tree depth
+  - busiest node's circuits against the per-node TC u16 budget
+  - how many circuits would change parent_node versus the snapshot
+
+Nothing on disk is modified: the snapshot is only read and network.json is
+written to a temporary directory.
+
+Typical usage:
+    python capacity_planner.py --db devices.db --config config.json
+    python capacity_planner.py --queues 8 --nodes --json
+"""
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+
+from node_assigner import (
+    NodeAssigner, STRATEGY_FLAT, STRATEGY_AP_ONLY, STRATEGY_AP_SITE, STRATEGY_FULL, STRATEGY_CPU,
+)
+from settings import TC_U16_NODE_LIMIT, TC_U16_WARN_THRESHOLD
+
+logger = logging.getLogger(__name__)
+
+SCENARIOS = [
+    (STRATEGY_FLAT,    False),
+    (STRATEGY_AP_ONLY, False),
+    (STRATEGY_AP_SITE, False),
+    (STRATEGY_FULL,    False),
+    (STRATEGY_FULL,    True),
+    (STRATEGY_CPU,     False),
+]
+
+
+def _load_snapshot(db_path):
+    """Copy the on-disk DB into an in-memory connection (read-only on the source)."""
+    src = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    mem = sqlite3.connect(':memory:')
+    try:
+        src.backup(mem)
+    finally:
+        src.close()
+    return mem
+
+
+def _tree_stats(network_config, conn):
+    """
+    Walk a network.json tree. Returns (depth, {top_level_name: (dl, ul, circuits)})
+    where dl/ul are the plan-rate sums of every device under the node.
+    """
+    leaf_totals = {
+        parent: (dl or 0, ul or 0, n)
+        for parent, dl, ul, n in conn.execute(
+            "SELECT parent_node, SUM(download_max_mbps), SUM(upload_max_mbps), COUNT(*) "
+            "FROM devices GROUP BY parent_node"
+        )
+    }
+
+    def _walk(name, node, level):
+        dl, ul, n = leaf_totals.get(name, (0, 0, 0))
+        depth = level
+        for child_name, child in node.get("children", {}).items():
+            c_depth, (c_dl, c_ul, c_n) = _walk(child_name, child, level + 1)
+            depth = max(depth, c_depth)
+            dl, ul, n = dl + c_dl, ul + c_ul, n + c_n
+        return depth, (dl, ul, n)
+
+    depth, nodes = 0, {}
+    for name, node in network_config.items():
+        node_depth, totals = _walk(name, node, 1)
+        depth = max(depth, node_depth)
+        nodes[name] = totals
+    if not network_config:
+        dl, ul, n = conn.execute(
+            "SELECT COALESCE(SUM(download_max_mbps), 0), COALESCE(SUM(upload_max_mbps), 0), "
+            "COUNT(*) FROM devices"
+        ).fetchone()
+        nodes["(root)"] = (dl, ul, n)
+    return depth, nodes
+
+
+def simulate(db_path, routers, queues, lqos_conf_path=None):
+    """Run every scenario against a copy of db_path and return a list of report dicts."""
+    baseline = _load_snapshot(db_path)
+    current = dict(baseline.execute("SELECT code, parent_node FROM devices"))
+    total = len(current)
+
+    reports = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for strategy, promote in SCENARIOS:
+            conn = sqlite3.connect(':memory:')
+            baseline.backup(conn)
+
+            assigner = NodeAssigner(os.path.join(tmp, "network.json"), lqos_conf_path)
+            assigner.write_network_json({})
+            assigner.assign(conn, strategy, routers, queues, promote)
+            network_config = assigner.read_network_json()
+
+            depth, nodes = _tree_stats(network_config, conn)
+            moved = sum(
+                1 for code, parent in conn.execute("SELECT code, parent_node FROM devices")
+                if current.get(code) != parent
+            )
+            busiest = max((n for _, _, n in nodes.values()), default=0)
+            reports.append({
+                "strategy":          strategy + (" +promote_to_root" if promote else ""),
+                "depth":             depth,
+                "node_count":        len(nodes),
+                "skew_ratio":        round(NodeAssigner.check_distribution_skew(nodes), 3),
+                "busiest_circuits":  busiest,
+                "tc_node_limit":     TC_U16_NODE_LIMIT,
+                "tc_node_ok":        TC_U16_NODE_LIMIT <= 0 or busiest <= TC_U16_NODE_LIMIT,
+                "moved_circuits":    moved,
+                "nodes": {
+                    name: {"dl_mbps": dl, "ul_mbps": ul, "circuits": n}
+                    for name, (dl, ul, n) in nodes.items()
+                },
+            })
+            conn.close()
+
+    baseline.close()
+    logger.info(
+        f"Simulated {len(reports)} scenarios over {total} circuits "
+        f"(total TC warning threshold {TC_U16_WARN_THRESHOLD})"
+    )
+    return reports
+
+
+def _print_reports(reports, show_nodes):
+    header = (f"{'strategy':<26}{'depth':>6}{'nodes':>7}{'skew':>8}"
+              f"{'max circuits':>14}{'TC':>6}{'moved':>9}")
+    print(header)
+    print("-" * len(header))
+    for r in reports:
+        print(f"{r['strategy']:<26}{r['depth']:>6}{r['node_count']:>7}{r['skew_ratio']:>7.2f}x"
+              f"{r['busiest_circuits']:>14}{'ok' if r['tc_node_ok'] else 'OVER':>6}"
+              f"{r['moved_circuits']:>9}")
+        if show_nodes:
+            for name, n in r["nodes"].items():
+                print(f"    {name:<30}{n['dl_mbps']:>10} DL{n['ul_mbps']:>10} UL"
+                      f"{n['circuits']:>8} circuits")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--db", default="devices.db", help="devices.db snapshot to read")
+    parser.add_argument("--config", default="config.json", help="config.json with bras/site definitions")
+    parser.add_argument("--queues", type=int, help="CPU node count (default: resolved like updatecsv)")
+    parser.add_argument("--lqos-conf", default=None,
+                        help="lqos.conf for shaping-core detection (default: plain CPU0..n-1 nodes)")
+    parser.add_argument("--nodes", action="store_true", help="also print per-node load")
+    parser.add_argument("--json", action="store_true", help="print the full report as JSON")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show assigner log output")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.ERROR,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+    )
+
+    import updatecsv
+    updatecsv.CONFIG_JSON = args.config
+    if args.lqos_conf:
+        updatecsv.LQOS_CONF = args.lqos_conf
+    routers, _, queues, _ = updatecsv.read_config_json()
+    if args.queues:
+        queues = args.queues
+    if not queues:
+        queues = NodeAssigner(None, args.lqos_conf).shaping_queue_count()
+
+    reports = simulate(args.db, routers, queues, args.lqos_conf)
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        _print_reports(reports, args.nodes)
+
+
+if __name__ == "__main__":
+    main()
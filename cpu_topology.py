@@ -0,0 +1,132 @@
+import logging
+import os
+import re
+from pathlib import Path
+
+from settings import HT_SIBLING_WEIGHT, NUMA_REMOTE_WEIGHT
+
+logger = logging.getLogger(__name__)
+
+_SYS_CPU = Path('/sys/devices/system/cpu')
+_SYS_NET = Path('/sys/class/net')
+
+_RE_LQOS_KEY = re.compile(
+    r'^\s*(override_available_queues|to_internet|to_network|interface)\s*=\s*"?([^"#\s]*)"?'
+)
+
+
+class CpuTopology:
+    """
+    Works out which CPU cores LibreQoS actually shapes on, mirroring how it
+    sizes its queues: one queue per core for min(NIC RX/TX queues, online
+    CPUs), unless override_available_queues is set in lqos.conf. Queue i is
+    bound to the i-th online CPU.
+    """
+
+    HT_SIBLING_WEIGHT  = HT_SIBLING_WEIGHT
+    NUMA_REMOTE_WEIGHT = NUMA_REMOTE_WEIGHT
+
+    @staticmethod
+    def parse_cpu_list(text):
+        """Parse a sysfs cpulist such as '0-3,8,10-11' into a sorted list of ints."""
+        cpus = set()
+        for part in text.strip().split(','):
+            if not part:
+                continue
+            lo, _, hi = part.partition('-')
+            cpus.update(range(int(lo), int(hi or lo) + 1))
+        return sorted(cpus)
+
+    @staticmethod
+    def _read(path, default=''):
+        try:
+            return Path(path).read_text().strip()
+        except OSError:
+            return default
+
+    @staticmethod
+    def read_lqos_conf(lqos_conf_path):
+        """Return (override_available_queues, [shaping interface names]) from lqos.conf."""
+        override, interfaces = 0, []
+        for line in CpuTopology._read(lqos_conf_path).splitlines():
+            m = _RE_LQOS_KEY.match(line)
+            if not m or not m.group(2):
+                continue
+            key, value = m.groups()
+            if key == 'override_available_queues':
+                try:
+                    override = int(value)
+                except ValueError:
+                    pass
+            elif value not in interfaces:
+                interfaces.append(value)
+        return override, interfaces
+
+    @staticmethod
+    def online_cpus():
+        online = CpuTopology._read(_SYS_CPU / 'online')
+        if online:
+            return CpuTopology.parse_cpu_list(online)
+        return list(range(os.cpu_count() or 4))
+
+    @staticmethod
+    def _nic_queues(iface):
+        """Usable queue count of a NIC (min of RX and TX), or 0 if unknown."""
+        try:
+            entries = os.listdir(_SYS_NET / iface / 'queues')
+        except OSError:
+            return 0
+        rx = sum(1 for e in entries if e.startswith('rx-'))
+        tx = sum(1 for e in entries if e.startswith('tx-'))
+        return min(rx, tx)
+
+    @staticmethod
+    def _numa_node(cpu):
+        for entry in (_SYS_CPU / f"cpu{cpu}").glob('node*'):
+            if entry.name[4:].isdigit():
+                return int(entry.name[4:])
+        return 0
+
+    @staticmethod
+    def shaping_cores(lqos_conf_path):
+        """
+        Return the cores LibreQoS shapes on as [(cpu_id, capacity_weight)].
+
+        A core gets weight 1.0, times HT_SIBLING_WEIGHT when a hyperthread
+        sibling is also shaping (the two share one physical core), times
+        NUMA_REMOTE_WEIGHT when it sits on a different NUMA node than the
+        shaping NICs.
+        """
+        override, interfaces = CpuTopology.read_lqos_conf(lqos_conf_path)
+        online = CpuTopology.online_cpus()
+
+        if override > 0:
+            count = override
+        else:
+            nic_queues = [q for q in (CpuTopology._nic_queues(i) for i in interfaces) if q]
+            count = min(nic_queues + [len(online)])
+        shaping = online[:count]
+        shaping_set = set(shaping)
+
+        nic_nodes = set()
+        for iface in interfaces:
+            node = CpuTopology._read(_SYS_NET / iface / 'device' / 'numa_node', '-1')
+            if node.lstrip('-').isdigit() and int(node) >= 0:
+                nic_nodes.add(int(node))
+
+        cores = []
+        for cpu in shaping:
+            weight = 1.0
+            siblings = CpuTopology._read(_SYS_CPU / f"cpu{cpu}" / 'topology' / 'thread_siblings_list')
+            if siblings and any(s != cpu and s in shaping_set
+                                for s in CpuTopology.parse_cpu_list(siblings)):
+                weight *= CpuTopology.HT_SIBLING_WEIGHT
+            if nic_nodes and CpuTopology._numa_node(cpu) not in nic_nodes:
+                weight *= CpuTopology.NUMA_REMOTE_WEIGHT
+            cores.append((cpu, weight))
+
+        logger.debug(
+            f"Shaping cores from {lqos_conf_path}: "
+            + ", ".join(f"CPU{cpu}×{weight:.2f}" for cpu, weight in cores)
+        )
+        return cores
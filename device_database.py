@@ -3,9 +3,14 @@ import logging
 import os
 import shutil
 import sqlite3
+import time
+from datetime import datetime
 
 from rate_resolver import RateResolver
-from settings import SOURCE_PRIORITY, TC_U16_WARN_THRESHOLD
+from settings import (
+    SOURCE_PRIORITY, TC_U16_WARN_THRESHOLD, CHANGE_POLL_INTERVAL, JOURNAL_RETENTION,
+    USAGE_PEAK_HOURS, USAGE_HALF_LIFE, USAGE_MIN_SAMPLES,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -29,10 +34,169 @@ _CREATE_DEVICES_SQL = """
         is_static       INTEGER DEFAULT 0,
         weight          INT NOT NULL DEFAULT 0,
         core_name       TEXT DEFAULT '',
-        wan_name        TEXT DEFAULT ''
+        wan_name        TEXT DEFAULT '',
+        usage_dl_bytes    INT  DEFAULT 0,
+        usage_ul_bytes    INT  DEFAULT 0,
+        usage_sample_time REAL DEFAULT 0,
+        usage_dl_mbps     REAL DEFAULT 0,
+        usage_ul_mbps     REAL DEFAULT 0,
+        usage_samples     INT  DEFAULT 0,
+        usage_dl_last     REAL DEFAULT 0,
+        usage_ul_last     REAL DEFAULT 0,
+        topology          TEXT DEFAULT ''
     )
 """
 
+# Per-device traffic counters and their decayed peak-hour averages
+_USAGE_COLUMNS = {
+    'usage_dl_bytes':    "INT DEFAULT 0",
+    'usage_ul_bytes':    "INT DEFAULT 0",
+    'usage_sample_time': "REAL DEFAULT 0",
+    'usage_dl_mbps':     "REAL DEFAULT 0",
+    'usage_ul_mbps':     "REAL DEFAULT 0",
+    'usage_samples':     "INT DEFAULT 0",
+    'usage_dl_last':     "REAL DEFAULT 0",
+    'usage_ul_last':     "REAL DEFAULT 0",
+}
+
+# Concurrent usage per parent node, one row per scan; read by the percentile
+# capacity model in NodeAssigner
+_CREATE_NODE_USAGE_SQL = """
+    CREATE TABLE IF NOT EXISTS node_usage (
+        node        TEXT NOT NULL,
+        sample_time REAL NOT NULL,
+        dl_mbps     REAL NOT NULL,
+        ul_mbps     REAL NOT NULL,
+        PRIMARY KEY (node, sample_time)
+    )
+"""
+
+# Last known libreqos-managed address-list entries per core router, so
+# WANManager can skip re-reading every list after a restart
+_CREATE_WAN_CACHE_SQL = """
+    CREATE TABLE IF NOT EXISTS wan_cache (
+        core     TEXT NOT NULL,
+        list     TEXT NOT NULL,
+        address  TEXT NOT NULL,
+        entry_id TEXT NOT NULL,
+        PRIMARY KEY (core, list, address)
+    ) WITHOUT ROWID
+"""
+
+# Last interface byte counters and rolling (EWMA) rate of every WAN uplink,
+# with the WAN's assigned load at poll time; polled by wan_service, shown by the GUI
+_CREATE_WAN_TRAFFIC_SQL = """
+    CREATE TABLE IF NOT EXISTS wan_traffic (
+        core        TEXT NOT NULL,
+        wan         TEXT NOT NULL,
+        interface   TEXT NOT NULL,
+        sample_time REAL NOT NULL,
+        rx_bytes    INT  NOT NULL,
+        tx_bytes    INT  NOT NULL,
+        dl_mbps     REAL DEFAULT 0,
+        ul_mbps     REAL DEFAULT 0,
+        samples     INT  DEFAULT 0,
+        plan_dl     REAL DEFAULT 0,
+        plan_ul     REAL DEFAULT 0,
+        PRIMARY KEY (core, wan)
+    )
+"""
+
+# One monotonically increasing version per change channel; updatecsv bumps
+# 'devices' after a scan that changed anything, wan_service waits on it
+_CREATE_CHANGE_EVENTS_SQL = """
+    CREATE TABLE IF NOT EXISTS change_events (
+        channel    TEXT PRIMARY KEY,
+        version    INTEGER NOT NULL,
+        changed_at REAL NOT NULL
+    )
+"""
+
+# Device change journal: one row per insert / delete / meaningful update of a
+# device, with a monotonically increasing version (AUTOINCREMENT never reuses
+# one, even after pruning). Written by triggers, so every writer — scanner,
+# assigners, GUI — is captured; last_seen and usage_* updates are not journaled.
+_CREATE_JOURNAL_SQL = """
+    CREATE TABLE IF NOT EXISTS device_journal (
+        version    INTEGER PRIMARY KEY AUTOINCREMENT,
+        code       TEXT NOT NULL,
+        op         TEXT NOT NULL CHECK(op IN ('insert', 'update', 'delete')),
+        changed_at REAL NOT NULL DEFAULT ((julianday('now') - 2440587.5) * 86400.0)
+    )
+"""
+
+_JOURNAL_COLUMNS = [
+    'circuit_id', 'device_id', 'parent_node', 'mac', 'ipv4', 'ipv6',
+    'download_min_mbps', 'upload_min_mbps', 'download_max_mbps', 'upload_max_mbps',
+    'comment', 'source', 'router', 'is_static', 'core_name', 'wan_name', 'topology',
+]
+
+_CREATE_JOURNAL_TRIGGERS_SQL = [
+    "CREATE TRIGGER IF NOT EXISTS devices_journal_insert AFTER INSERT ON devices "
+    "BEGIN INSERT INTO device_journal (code, op) VALUES (new.code, 'insert'); END",
+    "CREATE TRIGGER IF NOT EXISTS devices_journal_delete AFTER DELETE ON devices "
+    "BEGIN INSERT INTO device_journal (code, op) VALUES (old.code, 'delete'); END",
+    f"CREATE TRIGGER IF NOT EXISTS devices_journal_update "
+    f"AFTER UPDATE OF code, {', '.join(_JOURNAL_COLUMNS)} ON devices "
+    f"WHEN old.code IS NOT new.code OR "
+    + " OR ".join(f"old.{col} IS NOT new.{col}" for col in _JOURNAL_COLUMNS)
+    + " BEGIN "
+    "INSERT INTO device_journal (code, op) SELECT old.code, 'delete' WHERE old.code IS NOT new.code; "
+    "INSERT INTO device_journal (code, op) VALUES (new.code, 'update'); END",
+]
+
+# Trigram full-text index over the fields devices are looked up by: username
+# (code), MAC with and without separators, addresses and comment. Each row
+# shares its device's rowid and is kept in sync by triggers, so any substring
+# of three or more characters — an IP prefix, a MAC fragment, part of a
+# username — is an index lookup. Needs SQLite 3.34+ with FTS5; without it
+# search_condition falls back to LIKE.
+_CREATE_SEARCH_SQL = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS devices_fts USING fts5(
+        code, mac, mac_hex, ipv4, ipv6, comment, tokenize = 'trigram'
+    )
+"""
+
+_SEARCH_COLUMNS = ['code', 'mac', 'ipv4', 'ipv6', 'comment']
+
+
+def _search_values(row):
+    return (f"{row}.rowid, {row}.code, {row}.mac, "
+            f"lower(replace(replace(replace({row}.mac, ':', ''), '-', ''), '.', '')), "
+            f"{row}.ipv4, {row}.ipv6, {row}.comment")
+
+
+_SEARCH_INSERT = "INSERT INTO devices_fts (rowid, code, mac, mac_hex, ipv4, ipv6, comment) SELECT "
+
+_CREATE_SEARCH_TRIGGERS_SQL = [
+    "CREATE TRIGGER IF NOT EXISTS devices_search_insert AFTER INSERT ON devices "
+    f"BEGIN {_SEARCH_INSERT}{_search_values('new')}; END",
+    "CREATE TRIGGER IF NOT EXISTS devices_search_delete AFTER DELETE ON devices "
+    "BEGIN DELETE FROM devices_fts WHERE rowid = old.rowid; END",
+    f"CREATE TRIGGER IF NOT EXISTS devices_search_update "
+    f"AFTER UPDATE OF {', '.join(_SEARCH_COLUMNS)} ON devices "
+    f"WHEN " + " OR ".join(f"old.{col} IS NOT new.{col}" for col in _SEARCH_COLUMNS)
+    + " BEGIN DELETE FROM devices_fts WHERE rowid = old.rowid; "
+    f"{_SEARCH_INSERT}{_search_values('new')}; END",
+]
+
+# Covering index for the per-router / per-access-path aggregates NodeAssigner
+# runs on every change (GROUP BY router, topology with plan-rate sums), and the
+# indexes behind the GUI's device list filters and sort orders
+_CREATE_INDEXES_SQL = [
+    "CREATE INDEX IF NOT EXISTS idx_devices_router "
+    "ON devices(router, topology, download_max_mbps, upload_max_mbps)",
+    # (sort key, code) pairs for the GUI's keyset-paginated device list
+    "CREATE INDEX IF NOT EXISTS idx_devices_last_seen ON devices(last_seen, code)",
+    "CREATE INDEX IF NOT EXISTS idx_devices_ipv4_sort ON devices(COALESCE(ipv4, ''), code)",
+    "CREATE INDEX IF NOT EXISTS idx_devices_download ON devices(download_max_mbps, code)",
+    "CREATE INDEX IF NOT EXISTS idx_devices_upload ON devices(upload_max_mbps, code)",
+    "CREATE INDEX IF NOT EXISTS idx_devices_router_sort ON devices(COALESCE(router, ''), code)",
+    "CREATE INDEX IF NOT EXISTS idx_devices_wan_sort ON devices(COALESCE(wan_name, ''), code)",
+    "CREATE INDEX IF NOT EXISTS idx_devices_source ON devices(source)",
+    "CREATE INDEX IF NOT EXISTS idx_devices_core_wan ON devices(core_name, wan_name)",
+]
+
 FIELDNAMES = [
     'Circuit ID', 'Circuit Name', 'Device ID', 'Device Name', 'Parent Node',
     'MAC', 'IPv4', 'IPv6', 'Download Min Mbps', 'Upload Min Mbps',
@@ -92,14 +256,131 @@ class DeviceDatabase:
         if 'wan_name' not in cols:
             self.conn.execute("ALTER TABLE devices ADD COLUMN wan_name TEXT DEFAULT ''")
             logger.info("Added wan_name column to devices table")
+        for col, decl in _USAGE_COLUMNS.items():
+            if col not in cols:
+                self.conn.execute(f"ALTER TABLE devices ADD COLUMN {col} {decl}")
+                logger.info(f"Added {col} column to devices table")
+        if 'topology' not in cols:
+            self.conn.execute("ALTER TABLE devices ADD COLUMN topology TEXT DEFAULT ''")
+            logger.info("Added topology column to devices table")
+        for sql in _CREATE_INDEXES_SQL:
+            self.conn.execute(sql)
+        self.conn.execute(_CREATE_NODE_USAGE_SQL)
+        self.conn.execute(_CREATE_WAN_CACHE_SQL)
+        self.conn.execute(_CREATE_WAN_TRAFFIC_SQL)
+        self.conn.execute(_CREATE_CHANGE_EVENTS_SQL)
+        self.conn.execute(_CREATE_JOURNAL_SQL)
+        for sql in _CREATE_JOURNAL_TRIGGERS_SQL:
+            self.conn.execute(sql)
+        self._open_search_index()
 
         self.conn.commit()
 
+    def _open_search_index(self):
+        """
+        Create the devices_fts search index and its triggers, rebuilding the
+        index when it is out of step with the devices table (first run, schema
+        migration, VACUUM renumbering rowids). Logs and carries on without it
+        if this SQLite has no FTS5 trigram tokenizer.
+        """
+        try:
+            self.conn.execute(_CREATE_SEARCH_SQL)
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Device search index unavailable, falling back to LIKE: {e}")
+            return
+        for sql in _CREATE_SEARCH_TRIGGERS_SQL:
+            self.conn.execute(sql)
+        indexed = self.conn.execute("SELECT COUNT(*) FROM devices_fts").fetchone()[0]
+        devices, in_step = self.conn.execute(
+            "SELECT COUNT(*), COUNT(f.rowid) FROM devices d "
+            "LEFT JOIN devices_fts f ON f.rowid = d.rowid AND f.code = d.code"
+        ).fetchone()
+        if indexed != devices or in_step != devices:
+            self.rebuild_search_index()
+
+    def rebuild_search_index(self):
+        """Repopulate devices_fts from the devices table."""
+        self.conn.execute("DELETE FROM devices_fts")
+        self.conn.execute(f"{_SEARCH_INSERT}{_search_values('d')} FROM devices d")
+        self.conn.commit()
+        logger.info("Rebuilt device search index")
+
+    @staticmethod
+    def load_columns(by_usage=False):
+        """
+        SQL expressions (download, upload, weight) used as a device's load when
+        balancing. With by_usage, devices that have at least USAGE_MIN_SAMPLES
+        peak-hour samples use their observed average (clamped to 1..plan rate);
+        the rest keep their nominal plan rate.
+        """
+        if not by_usage:
+            return "download_max_mbps", "upload_max_mbps", "weight"
+        dl, ul = (
+            f"(CASE WHEN usage_samples >= {USAGE_MIN_SAMPLES} "
+            f"THEN MIN(MAX(CAST(ROUND({avg}) AS INT), 1), {plan}) ELSE {plan} END)"
+            for avg, plan in (("usage_dl_mbps", "download_max_mbps"),
+                              ("usage_ul_mbps", "upload_max_mbps"))
+        )
+        return dl, ul, f"{dl} + {ul}"
+
+    @staticmethod
+    def load_wan_cache(conn):
+        """Persisted WAN address-list caches as {core_address: {(list, address): entry_id}}."""
+        conn.execute(_CREATE_WAN_CACHE_SQL)
+        caches = {}
+        for core, list_name, address, entry_id in conn.execute(
+            "SELECT core, list, address, entry_id FROM wan_cache"
+        ):
+            caches.setdefault(core, {})[(list_name, address)] = entry_id
+        return caches
+
+    @staticmethod
+    def store_wan_cache(conn, core, cache):
+        """Replace the persisted cache of one core; cache None just drops it."""
+        conn.execute("DELETE FROM wan_cache WHERE core = ?", (core,))
+        if cache:
+            conn.executemany(
+                "INSERT INTO wan_cache (core, list, address, entry_id) VALUES (?, ?, ?, ?)",
+                [(core, list_name, address, entry_id)
+                 for (list_name, address), entry_id in cache.items()]
+            )
+        conn.commit()
+
+    @staticmethod
+    def load_wan_traffic(conn):
+        """WAN traffic rows as {(core, wan): {interface, sample_time, rx_bytes, ...}}."""
+        conn.execute(_CREATE_WAN_TRAFFIC_SQL)
+        cols = ('interface', 'sample_time', 'rx_bytes', 'tx_bytes', 'dl_mbps', 'ul_mbps', 'samples',
+                'plan_dl', 'plan_ul')
+        return {
+            (row[0], row[1]): dict(zip(cols, row[2:]))
+            for row in conn.execute(f"SELECT core, wan, {', '.join(cols)} FROM wan_traffic")
+        }
+
+    @staticmethod
+    def store_wan_traffic(conn, rows):
+        """Upsert {(core, wan): {interface, sample_time, rx_bytes, ...}} rows."""
+        conn.executemany("""
+            INSERT OR REPLACE INTO wan_traffic
+                (core, wan, interface, sample_time, rx_bytes, tx_bytes, dl_mbps, ul_mbps, samples,
+                 plan_dl, plan_ul)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, [
+            (core, wan, r['interface'], r['sample_time'], r['rx_bytes'], r['tx_bytes'],
+             r['dl_mbps'], r['ul_mbps'], r['samples'], r['plan_dl'], r['plan_ul'])
+            for (core, wan), r in rows.items()
+        ])
+        conn.commit()
+
     def upsert_device(self, code, parent_node, mac, ipv4, comment, source, router_name,
                       rx_max, tx_max, rx_min, tx_min, scan_time) -> bool:
         """
         Insert or update a device. Returns True if data changed.
 
+        parent_node only seeds new rows — NodeAssigner owns it afterwards — and
+        a comment that differs only in its scan timestamp is not rewritten, so
+        an unchanged device costs a last_seen update and nothing is journaled.
+
         IPv4 conflict resolution: if the same IP already exists under a different
         code, the entry with the higher SOURCE_PRIORITY wins. Lower-priority
         source is skipped.
@@ -130,13 +411,13 @@ class DeviceDatabase:
                     return False
 
         row = self.conn.execute(
-            "SELECT circuit_id, device_id, parent_node, mac, ipv4, comment, "
+            "SELECT circuit_id, device_id, mac, ipv4, comment, "
             "download_max_mbps, upload_max_mbps, download_min_mbps, upload_min_mbps, is_static "
             "FROM devices WHERE code = ?", (code,)
         ).fetchone()
 
         if row:
-            (circuit_id, device_id, old_parent, old_mac, old_ipv4, old_comment,
+            (circuit_id, device_id, old_mac, old_ipv4, old_comment,
              old_dlmax, old_ulmax, old_dlmin, old_ulmin, is_static) = row
 
             self.conn.execute(
@@ -146,17 +427,18 @@ class DeviceDatabase:
             if is_static:
                 return False
 
-            new_vals = (parent_node, mac, ipv4, comment, rx_max, tx_max, rx_min, tx_min)
-            old_vals = (old_parent, old_mac, old_ipv4, old_comment,
+            new_vals = (mac, ipv4, RateResolver.comment_body(comment),
+                        rx_max, tx_max, rx_min, tx_min)
+            old_vals = (old_mac, old_ipv4, RateResolver.comment_body(old_comment),
                         old_dlmax, old_ulmax, old_dlmin, old_ulmin)
             if new_vals != old_vals:
                 self.conn.execute("""
                     UPDATE devices
-                    SET parent_node=?, mac=?, ipv4=?, comment=?, source=?, router=?,
+                    SET mac=?, ipv4=?, comment=?, source=?, router=?,
                         download_max_mbps=?, upload_max_mbps=?, download_min_mbps=?,
                         upload_min_mbps=?, weight=?
                     WHERE code = ?
-                """, (parent_node, mac, ipv4, comment, source, router_name,
+                """, (mac, ipv4, comment, source, router_name,
                       rx_max, tx_max, rx_min, tx_min, rx_max + tx_max, code))
                 logger.debug(f"Updated {code}")
                 return True
@@ -176,6 +458,87 @@ class DeviceDatabase:
             logger.info(f"New device: {code} (source={source}, IP={ipv4})")
             return True
 
+    def record_usage(self, router_name, by_code, by_ip, sample_time):
+        """
+        Fold one round of byte counters for a router's devices into their
+        decayed averages. by_code / by_ip map a device code or IPv4 address to
+        cumulative (download_bytes, upload_bytes); a code match wins over an IP.
+
+        The raw counters are always stored so the next sample has a baseline,
+        but the moving average only advances during USAGE_PEAK_HOURS, with a
+        decay of USAGE_HALF_LIFE seconds of observed peak time. Counter resets
+        (reconnects, queue re-creation) just re-baseline. The rate measured
+        this round is kept in usage_*_last for record_node_usage().
+        """
+        start, end = USAGE_PEAK_HOURS
+        hour = datetime.fromtimestamp(sample_time).hour
+        in_peak = start <= hour < end if start <= end else (hour >= start or hour < end)
+
+        updates = []
+        for code, ipv4, old_dl, old_ul, old_time, avg_dl, avg_ul, samples in self.conn.execute(
+            "SELECT code, ipv4, usage_dl_bytes, usage_ul_bytes, usage_sample_time, "
+            "usage_dl_mbps, usage_ul_mbps, usage_samples FROM devices WHERE router = ?",
+            (router_name,)
+        ):
+            counters = by_code.get(code) or by_ip.get(ipv4)
+            if counters is None:
+                continue
+            dl_bytes, ul_bytes = counters
+            dt = sample_time - (old_time or 0)
+            dl_mbps = ul_mbps = 0.0
+            if old_time and dt > 0 and dl_bytes >= old_dl and ul_bytes >= old_ul:
+                dl_mbps = (dl_bytes - old_dl) * 8 / dt / 1_000_000
+                ul_mbps = (ul_bytes - old_ul) * 8 / dt / 1_000_000
+                if in_peak:
+                    if samples:
+                        alpha = 1 - 0.5 ** (dt / USAGE_HALF_LIFE)
+                        avg_dl += alpha * (dl_mbps - avg_dl)
+                        avg_ul += alpha * (ul_mbps - avg_ul)
+                    else:
+                        avg_dl, avg_ul = dl_mbps, ul_mbps
+                    samples += 1
+            updates.append((dl_bytes, ul_bytes, sample_time, avg_dl, avg_ul, samples,
+                            dl_mbps, ul_mbps, code))
+
+        self.conn.executemany("""
+            UPDATE devices
+            SET usage_dl_bytes=?, usage_ul_bytes=?, usage_sample_time=?,
+                usage_dl_mbps=?, usage_ul_mbps=?, usage_samples=?,
+                usage_dl_last=?, usage_ul_last=?
+            WHERE code = ?
+        """, updates)
+        logger.debug(f"Recorded usage for {len(updates)} device(s) on {router_name}")
+
+    def record_node_usage(self, sample_time, window):
+        """
+        Store the concurrent usage of every parent node for one scan round (sum
+        of the rates measured at sample_time) and drop samples older than
+        window seconds.
+        """
+        cur = self.conn.execute("""
+            INSERT OR REPLACE INTO node_usage (node, sample_time, dl_mbps, ul_mbps)
+            SELECT parent_node, ?, SUM(usage_dl_last), SUM(usage_ul_last)
+            FROM devices
+            WHERE usage_sample_time = ? AND parent_node != ''
+            GROUP BY parent_node
+        """, (sample_time, sample_time))
+        self.conn.execute("DELETE FROM node_usage WHERE sample_time < ?", (sample_time - window,))
+        self.conn.commit()
+        logger.debug(f"Recorded concurrent usage for {cur.rowcount} node(s)")
+
+    def update_topology(self, paths) -> bool:
+        """
+        Store discovered access paths ({code: 'interface/server/pool'}).
+        Returns True if any device's path changed.
+        """
+        cur = self.conn.executemany(
+            "UPDATE devices SET topology = ? WHERE code = ? AND topology IS NOT ?",
+            [(path, code, path) for code, path in paths.items()]
+        )
+        if cur.rowcount > 0:
+            logger.info(f"Topology changed for {cur.rowcount} device(s)")
+        return cur.rowcount > 0
+
     def remove_inactive(self, scan_time) -> bool:
         """Remove devices not seen in the current scan (excluding static entries)."""
         cur = self.conn.execute(
@@ -187,6 +550,126 @@ class DeviceDatabase:
             logger.info(f"Removed {count} inactive device(s)")
         return count > 0
 
+    def publish_change(self, channel='devices'):
+        """Bump a channel's version so processes waiting in wait_for_change wake up."""
+        self.publish(self.conn, channel)
+
+    @staticmethod
+    def publish(conn, channel='devices'):
+        """publish_change on any connection (e.g. the GUI's); a no-op without the table."""
+        try:
+            conn.execute("""
+                INSERT INTO change_events (channel, version, changed_at) VALUES (?, 1, ?)
+                ON CONFLICT(channel) DO UPDATE SET version = version + 1, changed_at = excluded.changed_at
+            """, (channel, time.time()))
+        except sqlite3.OperationalError:
+            return
+        conn.commit()
+
+    def change_version(self, channel='devices'):
+        """Current version of a channel (0 before its first change)."""
+        row = self.conn.execute(
+            "SELECT version FROM change_events WHERE channel = ?", (channel,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def wait_for_change(self, since, timeout, channel='devices'):
+        """
+        Block until the channel's version differs from since, or timeout
+        seconds pass; returns the version seen last. Polls PRAGMA data_version
+        every CHANGE_POLL_INTERVAL seconds, which only moves when another
+        connection commits, so an idle wait never reads a table.
+        """
+        deadline = time.monotonic() + timeout
+        data_version = None
+        while True:
+            current = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            if current != data_version:
+                data_version = current
+                version = self.change_version(channel)
+                if version != since:
+                    return version
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return since
+            time.sleep(min(CHANGE_POLL_INTERVAL, remaining))
+
+    @staticmethod
+    def journal_version(conn):
+        """Latest device journal version (0 before the first change or without a journal)."""
+        try:
+            row = conn.execute(
+                "SELECT seq FROM sqlite_sequence WHERE name = 'device_journal'"
+            ).fetchone()
+        except sqlite3.OperationalError:
+            return 0
+        return row[0] if row else 0
+
+    @staticmethod
+    def journal_changes(conn, since):
+        """
+        Devices changed after journal version since, as (version, {code: op})
+        where op is the net 'insert' / 'update' / 'delete' for that code (the
+        last one, except that an insert followed by updates stays an insert)
+        and version is the newest one included. Returns (version, None) when since
+        is None or older than the retained journal — the caller must then
+        rescan the devices table and continue from version.
+        """
+        current = DeviceDatabase.journal_version(conn)
+        if since is not None and since == current:
+            return current, {}
+        try:
+            oldest = conn.execute("SELECT MIN(version) FROM device_journal").fetchone()[0]
+        except sqlite3.OperationalError:
+            return current, None
+        if since is None or since > current or oldest is None or since < oldest - 1:
+            return current, None
+        changes = {}
+        for version, code, op in conn.execute(
+            "SELECT version, code, op FROM device_journal WHERE version > ? ORDER BY version", (since,)
+        ):
+            if op != 'update' or changes.get(code) != 'insert':
+                changes[code] = op
+            current = version
+        return current, changes
+
+    @staticmethod
+    def search_condition(conn, q):
+        """
+        WHERE condition on devices, and its parameters, matching every
+        whitespace-separated term of q as a case-insensitive substring of the
+        code, MAC (with or without separators), IPv4, IPv6 or comment. Terms of
+        three or more characters are looked up in the devices_fts trigram
+        index; shorter ones, or all of them when there is no index, use LIKE
+        with % and _ escaped so they match literally.
+        """
+        indexed = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'devices_fts'"
+        ).fetchone() is not None
+        like_cols = _SEARCH_COLUMNS + ["replace(replace(replace(mac, ':', ''), '-', ''), '.', '')"]
+        where, params, phrases = [], [], []
+        for term in q.split():
+            if indexed and len(term) >= 3:
+                phrases.append('"' + term.replace('"', '""') + '"')
+            else:
+                where.append("(" + " OR ".join(f"{col} LIKE ? ESCAPE '\\'" for col in like_cols) + ")")
+                pattern = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                params += [f"%{pattern}%"] * len(like_cols)
+        if phrases:
+            where.insert(0, "rowid IN (SELECT rowid FROM devices_fts WHERE devices_fts MATCH ?)")
+            params.insert(0, " ".join(phrases))
+        return " AND ".join(where), params
+
+    def prune_journal(self):
+        """Keep only the newest JOURNAL_RETENTION journal entries."""
+        cur = self.conn.execute(
+            "DELETE FROM device_journal WHERE version <= ?",
+            (self.journal_version(self.conn) - JOURNAL_RETENTION,)
+        )
+        self.conn.commit()
+        if cur.rowcount:
+            logger.debug(f"Pruned {cur.rowcount} device journal entries")
+
     def export_to_csv(self):
         """Export all devices from SQLite to ShapedDevices.csv."""
         rows = self.conn.execute("""
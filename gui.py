@@ -1,4 +1,5 @@
 import os
+import base64
 import json
 import random
 import shutil
@@ -15,6 +16,7 @@ import socket
 import re
 from pathlib import Path
 from flask import Flask, render_template, request, jsonify, Response, stream_with_context, session
+from device_database import DeviceDatabase
 from wan_manager import WANManager
 from settings import (
     MANAGED_SERVICES as _SETTINGS_MANAGED_SERVICES,
@@ -22,6 +24,7 @@ from settings import (
     EXPECTED_MT_POLICY as _SETTINGS_MT_POLICY,
     EXPECTED_CORE_GROUP as _SETTINGS_CORE_GROUP,
     EXPECTED_CORE_POLICY as _SETTINGS_CORE_POLICY,
+    CHANGE_POLL_INTERVAL,
 )
 
 try:
@@ -373,11 +376,34 @@ def _connect_router_api(router: dict):
         plaintext_login=True,
     )
 
+# One API pool per core, kept logged in across WAN operations; keyed on the
+# connection settings so an edited core gets a new pool
+_wan_pools = {}
+_wan_pools_lock = threading.Lock()
+
 def _connect_for_wan(router: dict):
-    """Adapter for WANManager: returns API object (not pool)."""
-    return _connect_router_api(router).get_api()
+    """
+    Adapter for WANManager: the core's shared API pool, logged in, or None if
+    the core is unreachable. WANManager releases it after each operation and
+    only disconnects it after a failure, so the next get_api() logs in again.
+    """
+    key = tuple(router.get(k) for k in ("address", "port", "username", "password"))
+    with _wan_pools_lock:
+        pool = _wan_pools.get(key)
+        if pool is None:
+            for old in [k for k in _wan_pools if k[0] == key[0]]:
+                _wan_pools.pop(old).disconnect()
+            pool = _wan_pools[key] = _connect_router_api(router)
+    try:
+        pool.get_api()
+    except Exception:
+        return None
+    return pool
 
-_wan_manager = WANManager(_connect_for_wan)
+_wan_manager = WANManager(_connect_for_wan, shared_pools=True)
+# Held for a whole rebalance / purge: WANManager's caches must not be shared
+# by concurrent request threads
+_wan_lock = threading.Lock()
 
 def _broadcast_loop():
     while True:
@@ -639,33 +665,260 @@ def _db_con():
     return con
 
 
+_DEVICE_COLUMNS = (
+    "code, circuit_id, device_id, parent_node, mac, ipv4, ipv6, "
+    "download_min_mbps, upload_min_mbps, download_max_mbps, upload_max_mbps, "
+    "comment, source, router, last_seen, is_static, weight, core_name, wan_name"
+)
+# A delta touching more devices than this is sent as full=True instead of rows;
+# the client reloads its pages, which is cheaper than shipping the table.
+_DEVICE_DELTA_MAX = 500
+
+
+def _device_delta(con, since):
+    """
+    Rows changed since device journal version since:
+    {"version", "full", "upserts": [row], "deletes": [code]}, each upserted row
+    carrying its journal "op" ('insert' or 'update'). full=True means
+    the journal no longer reaches back to since, or too many devices changed
+    to send row by row, and the client must reload.
+    """
+    version, changed = DeviceDatabase.journal_changes(con, since)
+    if changed is None or len(changed) > _DEVICE_DELTA_MAX:
+        return {"version": version, "full": True, "upserts": [], "deletes": []}
+    codes = list(changed)
+    upserts = []
+    for start in range(0, len(codes), 500):
+        chunk = codes[start:start + 500]
+        upserts.extend(dict(r) for r in con.execute(
+            f"SELECT {_DEVICE_COLUMNS} FROM devices WHERE code IN ({','.join('?' * len(chunk))})", chunk
+        ))
+    for r in upserts:
+        r["op"] = "insert" if changed[r["code"]] == "insert" else "update"
+    present = {r["code"] for r in upserts}
+    return {"version": version, "full": False, "upserts": upserts,
+            "deletes": [code for code in codes if code not in present]}
+
+
+# Sort options for /api/devices: name -> key expression. Each has an index on
+# (expression, code) in DeviceDatabase, so every page is an index range scan.
+_DEVICE_SORTS = {
+    "last_seen": "last_seen",
+    "code":      "code",
+    "ipv4":      "COALESCE(ipv4, '')",
+    "download":  "download_max_mbps",
+    "upload":    "upload_max_mbps",
+    "router":    "COALESCE(router, '')",
+    "wan":       "COALESCE(wan_name, '')",
+}
+_DEVICE_PAGE_MAX = 1000
+
+
+def _encode_cursor(value, code):
+    return base64.urlsafe_b64encode(json.dumps([value, code]).encode()).decode()
+
+
+def _decode_cursor(cursor):
+    value, code = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return value, code
+
+
+def _device_filters(con, args):
+    """WHERE clauses and parameters for the /api/devices filter arguments."""
+    where, params = [], []
+    for arg, col in (("router", "router"), ("source", "source"),
+                     ("core", "core_name"), ("wan", "wan_name")):
+        value = args.get(arg)
+        if value:
+            where.append(f"{col} = ?")
+            params.append(value)
+    for arg, col, op in (("min_dl", "download_max_mbps", ">="), ("max_dl", "download_max_mbps", "<="),
+                         ("min_ul", "upload_max_mbps", ">="), ("max_ul", "upload_max_mbps", "<=")):
+        value = args.get(arg, type=int)
+        if value is not None:
+            where.append(f"{col} {op} ?")
+            params.append(value)
+    q = args.get("q", "").strip()
+    if q:
+        condition, search_params = DeviceDatabase.search_condition(con, q)
+        where.append(condition)
+        params += search_params
+    return where, params
+
+
 @app.route("/api/devices")
 @require_auth
 def get_devices():
+    """
+    Devices, plus the device journal version they reflect (for /api/devices/changes).
+
+    Without ?limit the whole table is returned. With it, one keyset page:
+    filters router, source, core, wan, min_dl/max_dl, min_ul/max_ul (Mbps) and
+    q (search terms, see /api/devices/search); sort is one of _DEVICE_SORTS with
+    order asc|desc (default last_seen desc); cursor is the "next" value of the
+    previous page, which is null on the last one.
+    """
     try:
         if not DB_PATH.exists():
             return jsonify({"ok": False, "error": "devices.db not found"}), 404
         con = sqlite3.connect(str(DB_PATH))
         con.row_factory = sqlite3.Row
-        cur = con.execute("""
-            SELECT code, circuit_id, device_id, parent_node, mac, ipv4, ipv6,
-                   download_min_mbps, upload_min_mbps,
-                   download_max_mbps, upload_max_mbps,
-                   comment, source, router, last_seen, is_static, weight,
-                   core_name, wan_name
-            FROM devices ORDER BY last_seen DESC
-        """)
+        # One read transaction, so the version matches the snapshot
+        con.execute("BEGIN")
+        version = DeviceDatabase.journal_version(con)
+
+        limit = request.args.get("limit", type=int)
+        if not limit:
+            cur = con.execute(f"SELECT {_DEVICE_COLUMNS} FROM devices ORDER BY last_seen DESC")
+            rows = [dict(r) for r in cur.fetchall()]
+            con.close()
+            return jsonify({"ok": True, "count": len(rows), "rows": rows, "version": version})
+
+        limit = min(max(limit, 1), _DEVICE_PAGE_MAX)
+        sort  = request.args.get("sort", "last_seen")
+        key   = _DEVICE_SORTS.get(sort, _DEVICE_SORTS["last_seen"])
+        desc  = request.args.get("order", "desc") != "asc"
+        where, params = _device_filters(con, request.args)
+        cursor = request.args.get("cursor")
+        if cursor:
+            try:
+                value, code = _decode_cursor(cursor)
+            except (ValueError, TypeError) as e:
+                con.close()
+                return jsonify({"ok": False, "error": f"Invalid cursor: {e}"}), 400
+            # Spelled out rather than as a row value so the expression indexes can seek too
+            op = "<" if desc else ">"
+            where.append(f"{key} {op}= ? AND ({key} {op} ? OR code {op} ?)")
+            params += [value, value, code]
+        direction = "DESC" if desc else "ASC"
+        cur = con.execute(
+            f"SELECT {_DEVICE_COLUMNS}, {key} AS sort_key FROM devices"
+            + (" WHERE " + " AND ".join(where) if where else "")
+            + f" ORDER BY {key} {direction}, code {direction} LIMIT ?",
+            params + [limit + 1]
+        )
         rows = [dict(r) for r in cur.fetchall()]
         con.close()
-        return jsonify({"ok": True, "count": len(rows), "rows": rows})
+        more = len(rows) > limit
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1]["sort_key"], rows[-1]["code"]) if more else None
+        for r in rows:
+            del r["sort_key"]
+        return jsonify({"ok": True, "count": len(rows), "rows": rows,
+                        "next": next_cursor, "version": version})
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+
+@app.route("/api/devices/search")
+@require_auth
+def search_devices():
+    """
+    Up to ?limit (default 20, at most 200) devices matching every term of ?q
+    as a substring of their code, MAC (with or without separators), IPv4, IPv6
+    or comment — an IP prefix, a MAC fragment, part of a username. Served from
+    the devices_fts trigram index, so it answers without scanning the table.
+    """
+    try:
+        if not DB_PATH.exists():
+            return jsonify({"ok": False, "error": "devices.db not found"}), 404
+        q = request.args.get("q", "").strip()
+        if not q:
+            return jsonify({"ok": True, "count": 0, "rows": [], "more": False})
+        limit = min(max(request.args.get("limit", 20, type=int), 1), 200)
+        con = _db_con()
+        condition, params = DeviceDatabase.search_condition(con, q)
+        rows = [dict(r) for r in con.execute(
+            f"SELECT {_DEVICE_COLUMNS} FROM devices WHERE {condition} LIMIT ?", params + [limit + 1]
+        )]
+        con.close()
+        more = len(rows) > limit
+        rows = sorted(rows[:limit], key=lambda r: r["code"])
+        return jsonify({"ok": True, "count": len(rows), "rows": rows, "more": more})
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+
+@app.route("/api/devices/summary")
+@require_auth
+def get_device_summary():
+    """Device count per source and the ten highest download plans, for the dashboard."""
+    try:
+        if not DB_PATH.exists():
+            return jsonify({"ok": False, "error": "devices.db not found"}), 404
+        con = _db_con()
+        by_source = {r["source"]: r["n"] for r in con.execute(
+            "SELECT source, COUNT(*) AS n FROM devices GROUP BY source"
+        )}
+        top = [dict(r) for r in con.execute(
+            f"SELECT {_DEVICE_COLUMNS} FROM devices ORDER BY download_max_mbps DESC, code DESC LIMIT 10"
+        )]
+        con.close()
+        return jsonify({"ok": True, "count": sum(by_source.values()), "by_source": by_source, "top": top})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
 
+@app.route("/api/devices/changes")
+@require_auth
+def get_device_changes():
+    """Devices inserted, updated or deleted since ?since=<version>."""
+    try:
+        if not DB_PATH.exists():
+            return jsonify({"ok": False, "error": "devices.db not found"}), 404
+        con = _db_con()
+        delta = _device_delta(con, request.args.get("since", type=int))
+        con.close()
+        return jsonify({"ok": True, **delta})
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+
+@app.route("/api/devices/stream")
+@require_auth
+def device_stream():
+    """
+    SSE feed of device deltas (same payload as /api/devices/changes), starting
+    after ?since=<version> or the Last-Event-ID of a reconnecting client. Waits
+    on PRAGMA data_version, so an idle stream reads no table.
+    """
+    last_id = request.headers.get("Last-Event-ID")
+    since = int(last_id) if last_id and last_id.isdigit() else request.args.get("since", type=int)
+
+    def generate():
+        con = _db_con()
+        version, data_version, idle = since, None, 0.0
+        try:
+            while True:
+                current = con.execute("PRAGMA data_version").fetchone()[0]
+                if current != data_version:
+                    data_version = current
+                    delta = _device_delta(con, version)
+                    if delta["full"] or delta["version"] != version:
+                        version = delta["version"]
+                        idle = 0.0
+                        yield f"id: {version}\ndata: {json.dumps(delta)}\n\n"
+                if idle >= 15:
+                    idle = 0.0
+                    yield ": keepalive\n\n"
+                time.sleep(CHANGE_POLL_INTERVAL)
+                idle += CHANGE_POLL_INTERVAL
+        finally:
+            con.close()
+
+    return Response(stream_with_context(generate()),
+                    mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.route("/api/wan/stats")
 @require_auth
 def wan_stats():
-    """Return per-WAN device counts and bandwidth totals, plus wan_assignment config."""
+    """
+    Return per-WAN device counts and bandwidth totals, plus wan_assignment config.
+    WANs polled by wan_service also carry their measured rolling rate
+    (measured_dl / measured_ul in Mbps, measured_at as a unix timestamp).
+    """
     try:
         cfg = _load_config()
         wan_cfg = cfg.get("wan_assignment", {})
@@ -691,6 +944,7 @@ def wan_stats():
             GROUP BY core_name, wan_name
             ORDER BY core_name, wan_name
         """).fetchall()
+        traffic = DeviceDatabase.load_wan_traffic(con)
         con.close()
 
         # Attach configured limits from cores
@@ -707,6 +961,9 @@ def wan_stats():
         for r in rows:
             key = (r["core_name"], r["wan_name"])
             lim = limits.get(key, {"dl_limit": 0, "ul_limit": 0, "wan_label": r["wan_name"]})
+            measured = traffic.get(key)
+            if measured and not measured["samples"]:
+                measured = None
             stats["wans"].append({
                 "core_name":    r["core_name"],
                 "wan_name":     r["wan_name"],
@@ -716,6 +973,9 @@ def wan_stats():
                 "total_ul":     r["total_ul"],
                 "dl_limit":     lim["dl_limit"],
                 "ul_limit":     lim["ul_limit"],
+                "measured_dl":  round(measured["dl_mbps"], 1) if measured else None,
+                "measured_ul":  round(measured["ul_mbps"], 1) if measured else None,
+                "measured_at":  measured["sample_time"] if measured else None,
             })
 
         return jsonify({"ok": True, **stats})
@@ -723,97 +983,15 @@ def wan_stats():
         return jsonify({"ok": False, "error": str(e)}), 500
 
 
-def _sync_core_wan_address_lists(con, cfg: dict) -> dict:
-    """
-    Sync core WAN address-lists by delta only (add/remove differences).
-    Returns a summary with per-core changes and errors.
-    """
-    cores = cfg.get("cores", []) or []
-    summary = {
-        "ok": True,
-        "cores": [],
-        "total_added": 0,
-        "total_removed": 0,
-        "errors": [],
-    }
-
-    for core in cores:
-        core_name = core.get("name", "")
-        core_result = {"core": core_name, "added": 0, "removed": 0, "error": ""}
-        wans = core.get("wans", []) or []
-        if not wans:
-            summary["cores"].append(core_result)
-            continue
-
-        pool = None
-        try:
-            pool = _connect_router_api(core)
-            api = pool.get_api()
-            resource = api.get_resource("/ip/firewall/address-list")
-
-            target = set()
-            for i, wan in enumerate(wans, start=1):
-                wan_name = wan.get("address_list", f"WAN{i}")
-                rows = con.execute(
-                    "SELECT ipv4 FROM devices "
-                    "WHERE core_name=? AND wan_name=? AND ipv4 IS NOT NULL AND ipv4 != ''",
-                    (core_name, wan_name),
-                ).fetchall()
-                for (ip,) in rows:
-                    target.add((wan_name, ip))
-
-            current = {}
-            for i, wan in enumerate(wans, start=1):
-                wan_name = wan.get("address_list", f"WAN{i}")
-                entries = resource.get(list=wan_name)
-                for e in entries:
-                    ip = e.get("address")
-                    eid = e.get(".id")
-                    if ip and eid:
-                        current[(wan_name, ip)] = eid
-
-            to_add = target - set(current.keys())
-            to_remove = set(current.keys()) - target
-
-            for wan_name, ip in to_remove:
-                try:
-                    resource.remove(id=current[(wan_name, ip)])
-                    core_result["removed"] += 1
-                except Exception:
-                    # Keep going; one bad row should not block the rest.
-                    pass
-
-            for wan_name, ip in to_add:
-                try:
-                    resource.add(list=wan_name, address=ip, comment="libreqos-managed")
-                    core_result["added"] += 1
-                except Exception as ex:
-                    if "already have such entry" not in str(ex):
-                        raise
-
-            summary["total_added"] += core_result["added"]
-            summary["total_removed"] += core_result["removed"]
-
-        except Exception as ex:
-            core_result["error"] = str(ex)
-            summary["ok"] = False
-            summary["errors"].append(f"{core_name}: {ex}")
-        finally:
-            if pool is not None:
-                try:
-                    pool.disconnect()
-                except Exception:
-                    pass
-
-        summary["cores"].append(core_result)
-
-    return summary
-
-
 @app.route("/api/wan/rebalance", methods=["POST"])
 @require_auth
 def wan_rebalance():
     """Rebalance active devices across WANs with delta DB updates (no table wipe)."""
+    with _wan_lock:
+        return _wan_rebalance()
+
+
+def _wan_rebalance():
     try:
         cfg = _load_config()
         wan_cfg = cfg.get("wan_assignment", {})
@@ -867,7 +1045,7 @@ def wan_rebalance():
                 )
 
             _wan_manager.assign_wan_nodes(con, cores, wan_cfg)
-            sync_summary = _sync_core_wan_address_lists(con, cfg)
+            sync_summary = _wan_manager.sync_wan_address_lists(con, cores, wan_cfg, force=True)
 
             # Rebalance is only fully successful when router API sync succeeds.
             if not sync_summary.get("ok", False):
@@ -897,48 +1075,22 @@ def wan_rebalance():
 @require_auth
 def wan_purge():
     """Purge all libreqos-managed WAN address-list entries from every core router, then rebalance."""
+    with _wan_lock:
+        return _wan_purge()
+
+
+def _wan_purge():
     cfg = _load_config()
     cores = cfg.get("cores", []) or []
     wan_cfg = cfg.get("wan_assignment", {})
 
-    purge_results = []
-    purge_errors = []
-
     # ── Step 1: delete all libreqos-managed entries from each core ──────────
-    for core in cores:
-        core_name = core.get("name", "")
-        wans = core.get("wans", []) or []
-        removed = 0
-        pool = None
-        try:
-            pool = _connect_router_api(core)
-            api = pool.get_api()
-            resource = api.get_resource("/ip/firewall/address-list")
-
-            wan_names = {wan.get("address_list", f"WAN{i}") for i, wan in enumerate(wans, start=1)}
-            for wan_name in wan_names:
-                try:
-                    entries = resource.get(list=wan_name)
-                except Exception:
-                    entries = []
-                for e in entries:
-                    if e.get("comment", "") == "libreqos-managed":
-                        try:
-                            resource.remove(id=e[".id"])
-                            removed += 1
-                        except Exception:
-                            pass
-
-            purge_results.append({"core": core_name, "removed": removed})
-        except Exception as ex:
-            purge_errors.append(f"{core_name}: {ex}")
-            purge_results.append({"core": core_name, "removed": 0, "error": str(ex)})
-        finally:
-            if pool is not None:
-                try:
-                    pool.disconnect()
-                except Exception:
-                    pass
+    purge_summary = _wan_manager.purge_managed(cores, wan_cfg)
+    purge_results = [
+        {"core": c["core"], "removed": c["removed"], **({"error": c["error"]} if c["error"] else {})}
+        for c in purge_summary["cores"]
+    ]
+    purge_errors = list(purge_summary["errors"])
 
     # ── Step 2: clear WAN assignments in DB ──────────────────────────────────
     try:
@@ -981,7 +1133,7 @@ def wan_purge():
             ).fetchall()]
 
             _wan_manager.assign_wan_nodes(con, cores, wan_cfg)
-            sync_summary = _sync_core_wan_address_lists(con, cfg)
+            sync_summary = _wan_manager.sync_wan_address_lists(con, cores, wan_cfg, force=True)
         finally:
             con.close()
 
@@ -1043,6 +1195,7 @@ def add_device():
             d.get("wan_name", ""),
         ))
         con.commit()
+        DeviceDatabase.publish(con)
         con.close()
         return jsonify({"ok": True})
     except sqlite3.IntegrityError as e:
@@ -1085,6 +1238,7 @@ def update_device(code):
             code,
         ))
         con.commit()
+        DeviceDatabase.publish(con)
         con.close()
         return jsonify({"ok": True})
     except sqlite3.IntegrityError as e:
@@ -1100,6 +1254,7 @@ def delete_device(code):
         con = _db_con()
         con.execute("DELETE FROM devices WHERE code=?", (code,))
         con.commit()
+        DeviceDatabase.publish(con)
         con.close()
         return jsonify({"ok": True})
     except Exception as e:
@@ -83,7 +83,7 @@ cp "gui.py" "$SRC_DIR/gui.py"
 chmod +x "$SRC_DIR/gui.py"
 
 printf "${YELLOW}➜ Copying Python modules...${NC}\n"
-for module in rate_resolver.py device_database.py node_assigner.py router_scanner.py wan_manager.py; do
+for module in rate_resolver.py device_database.py node_assigner.py router_scanner.py wan_manager.py bulk_packer.py cpu_topology.py capacity_planner.py prefix_set.py; do
     cp "$module" "$SRC_DIR/$module"
     printf "  • $module\n"
 done
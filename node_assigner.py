@@ -1,7 +1,17 @@
-import heapq
 import json
 import logging
 import os
+import sqlite3
+import time
+
+from bulk_packer import BulkPacker, HAS_NUMPY
+from cpu_topology import CpuTopology
+from device_database import DeviceDatabase
+from settings import (
+    CPU_BALANCE_CIRCUITS, CPU_REFINE_TIME_BUDGET, CPU_VECTORIZED_THRESHOLD, USAGE_ENABLED, USAGE_WEIGHTING,
+    TC_U16_NODE_LIMIT, CAPACITY_MODEL, CAPACITY_FACTOR, CAPACITY_PERCENTILE, CAPACITY_HEADROOM,
+    CAPACITY_MIN_SAMPLES, CAPACITY_WINDOW, CAPACITY_OVERRIDES,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -10,64 +20,104 @@ STRATEGY_FLAT    = 'flat'     # No parent hierarchy; empty network.json (max per
 STRATEGY_AP_ONLY = 'ap_only'  # Devices grouped under their router as parent node
 STRATEGY_AP_SITE = 'ap_site'  # Devices grouped under site → router hierarchy
 STRATEGY_FULL    = 'full'     # Full path shaping; pair with promote_to_root if single-core saturates
-STRATEGY_CPU     = 'cpu'      # Greedy bin-pack across CPU nodes (current default)
+STRATEGY_CPU     = 'cpu'      # DL/UL-balanced bin-pack across CPU nodes (current default)
 
 ALL_STRATEGIES = {STRATEGY_FLAT, STRATEGY_AP_ONLY, STRATEGY_AP_SITE, STRATEGY_FULL, STRATEGY_CPU}
 
 
 class NodeAssigner:
-    def __init__(self, network_json_path='network.json'):
+    CPU_BALANCE_CIRCUITS     = CPU_BALANCE_CIRCUITS
+    CPU_REFINE_TIME_BUDGET   = CPU_REFINE_TIME_BUDGET
+    CPU_VECTORIZED_THRESHOLD = CPU_VECTORIZED_THRESHOLD
+    USAGE_ENABLED            = USAGE_ENABLED
+    USAGE_WEIGHTING          = USAGE_WEIGHTING
+    TC_U16_NODE_LIMIT        = TC_U16_NODE_LIMIT
+    CAPACITY_MODEL           = CAPACITY_MODEL
+    CAPACITY_FACTOR          = CAPACITY_FACTOR
+    CAPACITY_PERCENTILE      = CAPACITY_PERCENTILE
+    CAPACITY_HEADROOM        = CAPACITY_HEADROOM
+    CAPACITY_MIN_SAMPLES     = CAPACITY_MIN_SAMPLES
+    CAPACITY_WINDOW          = CAPACITY_WINDOW
+    CAPACITY_OVERRIDES       = CAPACITY_OVERRIDES
+
+    def __init__(self, network_json_path='network.json', lqos_conf_path=None):
         self.network_json_path = network_json_path
+        # lqos.conf locates LibreQoS's shaping cores; None keeps plain CPU0..n-1 nodes
+        self.lqos_conf_path = lqos_conf_path
 
     # ── Public API ──────────────────────────────────────────────────────────
 
     def assign(self, conn, strategy, routers, queues, promote_to_root):
         """Dispatch to the correct strategy and write network.json."""
         if strategy == STRATEGY_FLAT:
+            self._clear_parent_nodes(conn)
             self.write_network_json({})
 
         elif strategy == STRATEGY_AP_ONLY:
             router_totals = self._assign_router_nodes(conn, routers)
             self.check_distribution_skew(router_totals, label="router")
-            self._update_network_json_by_router(router_totals)
+            network_config = self._build_network_json_by_router(router_totals)
+            self._write_tree(conn, network_config)
 
         elif strategy in (STRATEGY_AP_SITE, STRATEGY_FULL):
-            node_totals = self._assign_site_nodes(conn, routers)
-            flat_totals = {k: (dl, ul) for k, (dl, ul, *_) in node_totals.items()}
-            self.check_distribution_skew(flat_totals, label="site/router")
-            self._update_network_json_by_site(node_totals)
+            depth = 1 if strategy == STRATEGY_AP_SITE else None
+            node_totals = self._assign_site_nodes(conn, routers, depth)
+            top_totals = {k: (dl, ul) for k, (dl, ul, parent) in node_totals.items() if not parent}
+            self.check_distribution_skew(top_totals, label="site/router")
             if promote_to_root and strategy == STRATEGY_FULL:
-                effective_queues = queues or (os.cpu_count() or 4)
+                # CPU nodes replace the site tree, so only their placement is written
+                effective_queues = self._tc_queue_count(conn, queues or self.shaping_queue_count())
                 cpu_totals = self._assign_cpu_nodes(conn, effective_queues)
                 self.check_distribution_skew(cpu_totals, label="CPU")
-                self._update_network_json(cpu_totals)
+                network_config = self._build_network_json(cpu_totals)
+            else:
+                network_config = self._build_network_json_by_site(node_totals)
+            self._write_tree(conn, network_config)
 
         elif strategy == STRATEGY_CPU:
             if queues is not None:
-                cpu_totals = self._assign_cpu_nodes(conn, queues)
+                cpu_totals = self._assign_cpu_nodes(conn, self._tc_queue_count(conn, queues))
                 self.check_distribution_skew(cpu_totals, label="CPU")
-                self._update_network_json(cpu_totals)
+                network_config = self._build_network_json(cpu_totals)
+                self._write_tree(conn, network_config)
             else:
+                self._clear_parent_nodes(conn)
                 logger.info("Skipping network.json (queues=false)")
 
+    def shaping_queue_count(self):
+        """Number of CPU queues LibreQoS shapes on (falls back to os.cpu_count())."""
+        if self.lqos_conf_path:
+            cores = CpuTopology.shaping_cores(self.lqos_conf_path)
+            if cores:
+                return len(cores)
+        return os.cpu_count() or 4
+
     @staticmethod
     def check_distribution_skew(totals: dict, label: str = "node"):
         """
-        Warn if the max/min load ratio across nodes exceeds 2:1.
-        Skewed distribution signals one core will saturate while others stay idle.
+        Warn if the max/min load ratio across nodes exceeds 2:1 in any dimension.
+        Download and upload (and circuit count, when the totals carry it) are
+        checked separately so a node saturated in one direction is not hidden
+        by being light in the other. Returns the worst ratio found.
         """
-        loads = {k: dl + ul for k, (dl, ul) in totals.items()}
-        if not loads:
-            return
-        max_load = max(loads.values())
-        min_load = min(loads.values())
-        if min_load > 0 and max_load / min_load > 2.0:
-            worst = max(loads, key=loads.get)
+        worst_ratio, worst = 1.0, None
+        for dim, unit in enumerate(("Mbps DL", "Mbps UL", "circuits")):
+            loads = {k: v[dim] for k, v in totals.items() if len(v) > dim}
+            if not loads:
+                continue
+            max_load = max(loads.values())
+            min_load = min(loads.values())
+            if min_load > 0 and max_load / min_load > worst_ratio:
+                worst_ratio = max_load / min_load
+                worst = (max(loads, key=loads.get), max_load, min_load, unit)
+        if worst and worst_ratio > 2.0:
+            name, max_load, min_load, unit = worst
             logger.warning(
-                f"Load skew detected across {label}s: {worst} has {max_load:.0f} Mbps vs "
-                f"min {min_load:.0f} Mbps (ratio {max_load/min_load:.1f}x). "
+                f"Load skew detected across {label}s: {name} has {max_load:.0f} {unit} vs "
+                f"min {min_load:.0f} {unit} (ratio {worst_ratio:.1f}x). "
                 "Review topology or use promote_to_root."
             )
+        return worst_ratio
 
     def read_network_json(self):
         try:
@@ -89,132 +139,608 @@ class NodeAssigner:
             logger.error(f"Error writing network JSON: {e}")
 
     # ── Private — node assignment ───────────────────────────────────────────
+    # The tree strategies stage each device's parent node in the temp table
+    # node_map (rowid_ → parent_node); _fit_tc_budget splits oversized nodes
+    # there, and _apply_node_map then writes only the devices whose final
+    # parent differs, so a repeat assign of an unchanged fleet writes nothing.
+
+    @staticmethod
+    def _stage_node_map(conn):
+        """Start node_map afresh, seeded with every device's current parent node."""
+        conn.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS node_map (rowid_ INTEGER PRIMARY KEY, parent_node TEXT)"
+        )
+        conn.execute("DELETE FROM node_map")
+        conn.execute("INSERT INTO node_map SELECT rowid, parent_node FROM devices")
+
+    @staticmethod
+    def _apply_node_map(conn):
+        """Write the staged parent nodes to the devices whose parent changed."""
+        cur = conn.execute("""
+            UPDATE devices
+            SET parent_node = (SELECT m.parent_node FROM node_map m WHERE m.rowid_ = devices.rowid)
+            WHERE rowid IN (SELECT rowid_ FROM node_map)
+              AND parent_node IS NOT (SELECT m.parent_node FROM node_map m WHERE m.rowid_ = devices.rowid)
+        """)
+        conn.commit()
+        logger.info(f"Moved {max(cur.rowcount, 0)} device(s) to a new parent node")
+
+    @staticmethod
+    def _clear_parent_nodes(conn):
+        """Detach scanned devices from any parent node (flat / queues=false)."""
+        cur = conn.execute("UPDATE devices SET parent_node = '' WHERE parent_node != '' AND is_static = 0")
+        conn.commit()
+        if cur.rowcount > 0:
+            logger.info(f"Cleared parent node of {cur.rowcount} device(s)")
 
     def _assign_cpu_nodes(self, conn, cpu_count):
         """
-        Distribute all devices across CPU0..CPU{n-1} using greedy bin-packing.
-        Returns {cpu_name: (total_dl_mbps, total_ul_mbps)}.
+        Distribute all devices across cpu_count CPU nodes, named and weighted
+        after LibreQoS's shaping cores (see _cpu_nodes).
+        Download, upload and (with balance_circuits) circuit count are balanced
+        as separate dimensions — see _balance_vectors. Large fleets take the
+        NumPy path in _assign_cpu_nodes_bulk when it is available.
+        With weight_by_usage, devices are balanced on observed peak-hour usage;
+        the returned totals always stay at nominal plan rates.
+        Returns {cpu_name: (total_dl_mbps, total_ul_mbps, circuit_count)}.
         """
-        devices = conn.execute(
-            "SELECT code, download_max_mbps, upload_max_mbps FROM devices ORDER BY weight DESC"
-        ).fetchall()
+        load_dl, load_ul, _ = DeviceDatabase.load_columns(self.USAGE_WEIGHTING)
+        sql = (
+            f"SELECT rowid, {load_dl}, {load_ul}, download_max_mbps, upload_max_mbps "
+            "FROM devices ORDER BY weight DESC"
+        )
+        if HAS_NUMPY:
+            count = conn.execute("SELECT COUNT(*) FROM devices").fetchone()[0]
+            if count >= self.CPU_VECTORIZED_THRESHOLD:
+                return self._assign_cpu_nodes_bulk(conn, cpu_count, sql)
+
+        self._stage_node_map(conn)
+        devices = conn.execute(sql).fetchall()
+        names, weights = self._cpu_nodes(cpu_count)
 
-        heap = [(0, i) for i in range(cpu_count)]
-        heapq.heapify(heap)
+        dims    = 3 if self.CPU_BALANCE_CIRCUITS else 2
+        vectors = [(load_dl, load_ul, 1)[:dims] for _, load_dl, load_ul, _, _ in devices]
+        placement = self._balance_vectors(vectors, cpu_count, self.CPU_REFINE_TIME_BUDGET, weights)
 
-        cpu_totals  = {f"CPU{i}": [0, 0] for i in range(cpu_count)}
+        cpu_totals  = {name: [0, 0, 0] for name in names}
         assignments = []
 
-        for code, dl, ul in devices:
-            load, cpu_idx = heapq.heappop(heap)
-            cpu_name = f"CPU{cpu_idx}"
-            assignments.append((cpu_name, code))
+        for (rowid, _, _, dl, ul), cpu_idx in zip(devices, placement):
+            cpu_name = names[cpu_idx]
+            assignments.append((cpu_name, rowid))
             cpu_totals[cpu_name][0] += dl
             cpu_totals[cpu_name][1] += ul
-            heapq.heappush(heap, (load + dl + ul, cpu_idx))
+            cpu_totals[cpu_name][2] += 1
 
-        conn.executemany("UPDATE devices SET parent_node = ? WHERE code = ?", assignments)
-        conn.commit()
+        conn.executemany("INSERT OR REPLACE INTO node_map VALUES (?2, ?1)", assignments)
         logger.info(f"Assigned {len(devices)} devices across {cpu_count} CPUs")
         return {k: tuple(v) for k, v in cpu_totals.items()}
 
+    def _assign_cpu_nodes_bulk(self, conn, cpu_count, sql):
+        """
+        NumPy variant of _assign_cpu_nodes: chunked balanced packing with
+        per-node totals computed in bulk (no refinement pass — with this many
+        devices every CPU already lands within one device of the others).
+        """
+        self._stage_node_map(conn)
+        rows = BulkPacker.load(conn, sql)
+        names, weights = self._cpu_nodes(cpu_count)
+        dims = 3 if self.CPU_BALANCE_CIRCUITS else 2
+        placement = BulkPacker.pack_balanced(
+            BulkPacker.device_loads(rows, 1, 2)[:, :dims], cpu_count, weights
+        )
+        totals = BulkPacker.bin_totals(BulkPacker.device_loads(rows, 3, 4), placement, cpu_count)
+
+        conn.executemany(
+            "INSERT OR REPLACE INTO node_map VALUES (?2, ?1)",
+            zip(map(names.__getitem__, placement.tolist()), rows[:, 0].tolist())
+        )
+        logger.info(f"Assigned {len(rows)} devices across {cpu_count} CPUs (vectorized)")
+        return {names[i]: tuple(int(x) for x in totals[i]) for i in range(cpu_count)}
+
+    def _cpu_nodes(self, cpu_count):
+        """
+        Names and capacity weights for cpu_count CPU nodes. Nodes take the IDs
+        of LibreQoS's shaping cores (CPU<id>) and their HT/NUMA weights; when
+        more nodes are needed than there are shaping cores, or lqos.conf is not
+        configured, plain CPU0..CPU{n-1} nodes of equal weight are used.
+        """
+        cores = CpuTopology.shaping_cores(self.lqos_conf_path) if self.lqos_conf_path else []
+        if cores and len(cores) >= cpu_count:
+            cores = cores[:cpu_count]
+            return [f"CPU{cpu}" for cpu, _ in cores], [weight for _, weight in cores]
+        if cores:
+            logger.info(
+                f"{cpu_count} CPU nodes requested but LibreQoS shapes on {len(cores)} "
+                "core(s) — using unweighted CPU nodes"
+            )
+        return [f"CPU{i}" for i in range(cpu_count)], [1.0] * cpu_count
+
+    @staticmethod
+    def _balance_vectors(vectors, bin_count, time_budget=0.0, capacities=None):
+        """
+        Multi-dimensional bin balancing. Returns a bin index per input vector.
+
+        Each dimension is normalised by its ideal per-bin share (weighted by
+        the optional per-bin capacities), so a bin's "peak" is its most-loaded
+        dimension relative to a perfect split.
+          1. Greedy: largest items first, each into the bin whose peak stays
+             lowest after placement (ties → least total load).
+          2. Refinement: repeatedly take the bin with the highest peak and try
+             moving one of its items, then swapping a pair, with a lighter bin
+             whenever that lowers the hot bin's peak without creating a new one.
+             Stops at a local optimum or when time_budget seconds have elapsed.
+        """
+        if bin_count <= 0 or not vectors:
+            return [0] * len(vectors)
+
+        dims   = range(len(vectors[0]))
+        totals = [sum(v[d] for v in vectors) for d in dims]
+        capacities = capacities or [1.0] * bin_count
+        scale  = [sum(capacities) / (c * bin_count) for c in capacities]
+        norm   = [[v[d] * bin_count / totals[d] if totals[d] else 0.0 for d in dims]
+                  for v in vectors]
+
+        loads     = [[0.0] * len(totals) for _ in range(bin_count)]
+        members   = [set() for _ in range(bin_count)]
+        placement = [0] * len(vectors)
+
+        for i in sorted(range(len(norm)), key=lambda i: max(norm[i]), reverse=True):
+            v = norm[i]
+            best = min(
+                range(bin_count),
+                key=lambda b: (max(loads[b][d] + v[d] * scale[b] for d in dims), sum(loads[b])),
+            )
+            for d in dims:
+                loads[best][d] += v[d] * scale[best]
+            members[best].add(i)
+            placement[i] = best
+
+        def _shift(src, dst, delta):
+            for d in dims:
+                loads[src][d] -= delta[d] * scale[src]
+                loads[dst][d] += delta[d] * scale[dst]
+
+        def _improve(hot, peak, deadline):
+            others = sorted((b for b in range(bin_count) if b != hot),
+                            key=lambda b: max(loads[b]))
+            for b in others:
+                for i in members[hot]:
+                    if time.monotonic() > deadline:
+                        return False
+                    v = norm[i]
+                    if max(max(loads[hot][d] - v[d] * scale[hot], loads[b][d] + v[d] * scale[b])
+                           for d in dims) < peak - 1e-9:
+                        _shift(hot, b, v)
+                        members[hot].remove(i)
+                        members[b].add(i)
+                        placement[i] = b
+                        return True
+            for b in others:
+                for i in members[hot]:
+                    if time.monotonic() > deadline:
+                        return False
+                    vi = norm[i]
+                    for j in members[b]:
+                        delta = [vi[d] - norm[j][d] for d in dims]
+                        if max(delta) <= 0:
+                            continue
+                        if max(max(loads[hot][d] - delta[d] * scale[hot],
+                                   loads[b][d] + delta[d] * scale[b])
+                               for d in dims) < peak - 1e-9:
+                            _shift(hot, b, delta)
+                            members[hot].remove(i)
+                            members[b].remove(j)
+                            members[hot].add(j)
+                            members[b].add(i)
+                            placement[i], placement[j] = b, hot
+                            return True
+            return False
+
+        deadline = time.monotonic() + time_budget
+        steps = 0
+        while bin_count > 1 and time.monotonic() < deadline:
+            hot = max(range(bin_count), key=lambda b: max(loads[b]))
+            if not _improve(hot, max(loads[hot]), deadline):
+                break
+            steps += 1
+
+        peaks = [max(l) for l in loads]
+        logger.debug(
+            f"Balanced {len(vectors)} items over {bin_count} bins: "
+            f"{steps} refinement step(s), peak {max(peaks):.3f} of ideal 1.0"
+        )
+        return placement
+
     def _assign_router_nodes(self, conn, routers):
         """
         ap_only strategy: parent_node = router name for all devices from that router.
         Returns {router_name: (total_dl_mbps, total_ul_mbps)}.
         """
-        router_totals = {}
-        for router in routers:
-            name = router['name']
-            row = conn.execute(
-                "SELECT SUM(download_max_mbps), SUM(upload_max_mbps) FROM devices WHERE router = ?",
-                (name,)
-            ).fetchone()
-            dl, ul = (row[0] or 0), (row[1] or 0)
-            router_totals[name] = (dl, ul)
-            conn.execute("UPDATE devices SET parent_node = ? WHERE router = ?", (name, name))
-        conn.commit()
+        names = [router['name'] for router in routers]
+        sums = {
+            router: (dl or 0, ul or 0)
+            for router, dl, ul in conn.execute(
+                "SELECT router, SUM(download_max_mbps), SUM(upload_max_mbps) "
+                "FROM devices GROUP BY router"
+            )
+        }
+        router_totals = {name: sums.get(name, (0, 0)) for name in names}
+
+        self._stage_node_map(conn)
+        conn.execute(
+            f"INSERT OR REPLACE INTO node_map SELECT rowid, router FROM devices "
+            f"WHERE router IN ({','.join('?' * len(names))})",
+            names
+        )
         logger.info(f"Assigned router-level parent nodes for {len(routers)} routers")
         return router_totals
 
-    def _assign_site_nodes(self, conn, routers):
+    def _assign_site_nodes(self, conn, routers, depth=None):
         """
-        ap_site / full strategy: parent_node = router name, with optional site above.
-        Returns {node_name: (total_dl_mbps, total_ul_mbps, parent_site_or_empty)}.
+        ap_site / full strategy: site (optional) → router → discovered access
+        levels from the devices' topology path (interface → server → pool).
+        depth limits how many access levels are kept below the router (ap_site
+        keeps the interface only, full keeps the whole path). Devices without a
+        discovered path stay on the router node.
+        Nested nodes are named '<parent>/<component>' so they stay unique.
+        Returns {node_name: (total_dl_mbps, total_ul_mbps, parent_name_or_empty)}.
         """
         node_totals = {}
-        for router in routers:
-            name = router['name']
-            row = conn.execute(
-                "SELECT SUM(download_max_mbps), SUM(upload_max_mbps) FROM devices WHERE router = ?",
-                (name,)
-            ).fetchone()
-            dl, ul = (row[0] or 0), (row[1] or 0)
 
-            conn.execute("UPDATE devices SET parent_node = ? WHERE router = ?", (name, name))
+        def _add(name, parent, dl, ul):
+            n_dl, n_ul, _ = node_totals.get(name, (0, 0, parent))
+            node_totals[name] = (n_dl + dl, n_ul + ul, parent)
+
+        groups = {}
+        for router, topology, dl, ul in conn.execute(
+            "SELECT router, topology, SUM(download_max_mbps), SUM(upload_max_mbps) "
+            "FROM devices GROUP BY router, topology"
+        ):
+            groups.setdefault(router, []).append((topology, dl or 0, ul or 0))
 
+        leaves = []
+        for router in routers:
+            name = router['name']
             site = router.get('site', '')
             if site:
-                node_totals[name] = (dl, ul, site)
-                if site not in node_totals:
-                    node_totals[site] = (0, 0, '')
-                s_dl, s_ul, _ = node_totals[site]
-                node_totals[site] = (s_dl + dl, s_ul + ul, '')
-            else:
-                node_totals[name] = (dl, ul, '')
+                _add(site, '', 0, 0)
+            _add(name, site, 0, 0)
 
-        conn.commit()
-        logger.info(f"Assigned site/router-level parent nodes for {len(routers)} routers")
+            for topology, dl, ul in groups.get(name, []):
+                chain = [site, name] if site else [name]
+                for component in [c for c in (topology or '').split('/') if c][:depth]:
+                    chain.append(f"{chain[-1]}/{component}")
+                for i, node in enumerate(chain):
+                    _add(node, chain[i - 1] if i else '', dl, ul)
+                leaves.append((name, topology, chain[-1]))
+
+        self._stage_node_map(conn)
+        conn.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS node_leaves "
+            "(router TEXT, topology TEXT, parent_node TEXT, PRIMARY KEY (router, topology))"
+        )
+        conn.execute("DELETE FROM node_leaves")
+        conn.executemany("INSERT OR REPLACE INTO node_leaves VALUES (?, ?, ?)", leaves)
+        conn.execute("""
+            INSERT OR REPLACE INTO node_map
+            SELECT d.rowid, l.parent_node
+            FROM devices d JOIN node_leaves l ON l.router = d.router AND l.topology IS d.topology
+        """)
+
+        logger.info(
+            f"Assigned site/router-level parent nodes for {len(routers)} routers "
+            f"({len(node_totals)} nodes)"
+        )
         return node_totals
 
-    # ── Private — network.json builders ────────────────────────────────────
+    # ── Private — TC u16 budget ────────────────────────────────────────────
+
+    def _tc_queue_count(self, conn, queues):
+        """
+        Raise the CPU node count when the fleet would put more than
+        TC_U16_NODE_LIMIT circuits on a single node at the requested fan-out.
+        """
+        total  = conn.execute("SELECT COUNT(*) FROM devices").fetchone()[0]
+        needed = -(-total // self.TC_U16_NODE_LIMIT) if self.TC_U16_NODE_LIMIT > 0 else 0
+        if needed > queues:
+            logger.warning(
+                f"TC u16 budget: {total} circuits over {queues} CPU nodes exceeds "
+                f"{self.TC_U16_NODE_LIMIT} per node — increasing queue fan-out to {needed}"
+            )
+            return needed
+        return queues
+
+    def _fit_tc_budget(self, conn, network_config):
+        """
+        Keep every top-level node's circuit count (its own devices plus its
+        subtree) within TC_U16_NODE_LIMIT. A top-level node and everything
+        below it is shaped on one LibreQoS CPU queue, whose HTB class minors
+        are a 16-bit space, so an oversized top-level node is split into
+        sibling parts "<name>-1".."-n" that LibreQoS can spread across queues.
+        A leaf node splits its devices (balanced on DL/UL/circuits); a node
+        with children shares its child nodes out between the parts. Nested
+        nodes are never split, as the budget is per queue. Works on the staged
+        node_map; returns the adjusted config.
+        """
+        limit = self.TC_U16_NODE_LIMIT
+        if limit <= 0:
+            return network_config
+        counts = dict(conn.execute(
+            "SELECT parent_node, COUNT(*) FROM node_map GROUP BY parent_node"
+        ).fetchall())
+        moves  = []
+        result = {}
+        for name, node in network_config.items():
+            total = self._subtree_circuits(name, node, counts)
+            if total <= limit:
+                result[name] = node
+                continue
+
+            parts = -(-total // limit)
+            logger.warning(
+                f"TC u16 budget: node {name} has {total} circuits (limit {limit}) — "
+                f"splitting into {parts} nodes"
+            )
+            if node["children"]:
+                split = self._split_node_children(conn, name, node, counts, parts)
+            else:
+                split = self._split_node_devices(conn, name, node, counts, parts, moves)
+            for part_name, part in split.items():
+                part_total = self._subtree_circuits(part_name, part, counts)
+                if part_total > limit:
+                    logger.warning(
+                        f"TC u16 budget: {part_name} still has {part_total} circuits — "
+                        "a single child node exceeds the limit"
+                    )
+            result.update(split)
+        if moves:
+            conn.executemany("UPDATE node_map SET parent_node = ? WHERE rowid_ = ?", moves)
+        return result
+
+    @staticmethod
+    def _subtree_circuits(name, node, counts):
+        return counts.get(name, 0) + sum(
+            NodeAssigner._subtree_circuits(child_name, child, counts)
+            for child_name, child in node["children"].items()
+        )
+
+    def _split_node_devices(self, conn, name, node, counts, parts, moves):
+        # Ordered by code so a repeat assign puts every device in the same part
+        rows = conn.execute(
+            "SELECT m.rowid_, d.download_max_mbps, d.upload_max_mbps "
+            "FROM node_map m JOIN devices d ON d.rowid = m.rowid_ "
+            "WHERE m.parent_node = ? ORDER BY d.code",
+            (name,)
+        ).fetchall()
+        placement = self._balance_vectors([(dl, ul, 1) for _, dl, ul in rows], parts)
 
-    def _update_network_json_by_router(self, router_totals):
-        """Build network.json with each router as a top-level node (ap_only)."""
-        network_config = {
-            name: {
-                "downloadBandwidthMbps": max(int(dl * 1.1), 1),
-                "uploadBandwidthMbps":   max(int(ul * 1.1), 1),
-                "type": "ap",
+        names  = [f"{name}-{i + 1}" for i in range(parts)]
+        totals = [[0, 0, 0] for _ in range(parts)]
+        for (rowid, dl, ul), idx in zip(rows, placement):
+            moves.append((names[idx], rowid))
+            totals[idx][0] += dl
+            totals[idx][1] += ul
+            totals[idx][2] += 1
+
+        counts.pop(name, None)
+        split = {}
+        for part_name, (dl, ul, n) in zip(names, totals):
+            counts[part_name] = n
+            split[part_name] = self._node_entry(dl, ul, node["type"])
+        return split
+
+    def _split_node_children(self, conn, name, node, counts, parts):
+        """
+        Share a node's children out between parts. Devices attached directly
+        to the node are placed as one more item and move, with their share of
+        the node's size, to whichever part receives them.
+        """
+        children = list(node["children"].items())
+        circuits = [self._subtree_circuits(c_name, child, counts) for c_name, child in children]
+        direct   = counts.get(name, 0)
+        placement = self._balance_vectors([(c,) for c in circuits + [direct]], parts)
+
+        names = [f"{name}-{i + 1}" for i in range(parts)]
+        split = {
+            part_name: {
+                "downloadBandwidthMbps": 0,
+                "uploadBandwidthMbps":   0,
+                "type": node["type"],
                 "children": {}
             }
-            for name, (dl, ul) in router_totals.items()
+            for part_name in names
         }
-        self.write_network_json(network_config)
+        for (c_name, child), idx in zip(children, placement):
+            part = split[names[idx]]
+            part["children"][c_name] = child
+            part["downloadBandwidthMbps"] += child["downloadBandwidthMbps"]
+            part["uploadBandwidthMbps"]   += child["uploadBandwidthMbps"]
 
-    def _update_network_json_by_site(self, node_totals):
-        """Build network.json with site → router hierarchy (ap_site / full)."""
-        network_config = {}
-
-        for name, (dl, ul, parent) in node_totals.items():
-            if not parent:
-                network_config[name] = {
-                    "downloadBandwidthMbps": max(int(dl * 1.1), 1),
-                    "uploadBandwidthMbps":   max(int(ul * 1.1), 1),
-                    "type": "site",
-                    "children": {}
-                }
-
-        for name, (dl, ul, parent) in node_totals.items():
-            if parent and parent in network_config:
-                network_config[parent]["children"][name] = {
-                    "downloadBandwidthMbps": max(int(dl * 1.1), 1),
-                    "uploadBandwidthMbps":   max(int(ul * 1.1), 1),
-                    "type": "ap",
-                    "children": {}
-                }
+        if direct:
+            part_name = names[placement[-1]]
+            dl, ul = conn.execute(
+                "SELECT SUM(d.download_max_mbps), SUM(d.upload_max_mbps) "
+                "FROM node_map m JOIN devices d ON d.rowid = m.rowid_ WHERE m.parent_node = ?",
+                (name,)
+            ).fetchone()
+            own = self._node_entry(dl or 0, ul or 0, node["type"])
+            split[part_name]["downloadBandwidthMbps"] += own["downloadBandwidthMbps"]
+            split[part_name]["uploadBandwidthMbps"]   += own["uploadBandwidthMbps"]
+            conn.execute("UPDATE node_map SET parent_node = ? WHERE parent_node = ?", (part_name, name))
+            counts[part_name] = counts.pop(name)
+        for part in split.values():
+            part["downloadBandwidthMbps"] = max(part["downloadBandwidthMbps"], 1)
+            part["uploadBandwidthMbps"]   = max(part["uploadBandwidthMbps"], 1)
+        return split
 
+    # ── Private — node capacity model ──────────────────────────────────────
+
+    def _write_tree(self, conn, network_config):
+        """
+        Fit the tree to the TC budget, write the staged parent nodes, size the
+        nodes and write network.json.
+        """
+        network_config = self._fit_tc_budget(conn, network_config)
+        self._apply_node_map(conn)
+        self._apply_capacity_model(conn, network_config)
         self.write_network_json(network_config)
 
-    def _update_network_json(self, cpu_totals):
-        """Build network.json with CPU nodes (cpu strategy)."""
-        network_config = {
-            cpu: {
-                "downloadBandwidthMbps": max(int(dl * 1.1), 1),
-                "uploadBandwidthMbps":   max(int(ul * 1.1), 1),
-                "type": "site",
-                "children": {}
+    def _apply_capacity_model(self, conn, network_config):
+        """
+        Resize nodes built at CAPACITY_FACTOR × plan sum, in place:
+          - 'fixed': keep that size
+          - 'percentile': CAPACITY_PERCENTILE of the node's observed concurrent
+            usage (per-scan sum over its subtree within CAPACITY_WINDOW) times
+            CAPACITY_HEADROOM, never below its largest single plan nor above
+            the fixed size. Nodes with fewer than CAPACITY_MIN_SAMPLES samples
+            keep the fixed size. Needs usage recording (usage.enabled); without
+            it every node keeps the fixed size and a warning is logged.
+        CAPACITY_OVERRIDES ({node: {"download": Mbps, "upload": Mbps} and/or
+        {"factor": x}}) replace the model for the listed nodes.
+        """
+        if self.CAPACITY_MODEL not in ('fixed', 'percentile'):
+            logger.warning(f"Unknown capacity model '{self.CAPACITY_MODEL}', using 'fixed'")
+        percentile = self.CAPACITY_MODEL == 'percentile'
+        if percentile and not self.USAGE_ENABLED:
+            logger.warning(
+                "Capacity model 'percentile' needs usage.enabled (no node usage is "
+                "recorded) — keeping fixed node sizes"
+            )
+            percentile = False
+        if not percentile and not self.CAPACITY_OVERRIDES:
+            return
+
+        observed, largest = {}, {}
+        if percentile:
+            observed = self._observed_percentiles(conn, network_config)
+            largest = {
+                node: (dl or 0, ul or 0)
+                for node, dl, ul in conn.execute(
+                    "SELECT parent_node, MAX(download_max_mbps), MAX(upload_max_mbps) "
+                    "FROM devices GROUP BY parent_node"
+                )
             }
-            for cpu, (dl, ul) in cpu_totals.items()
+
+        resized = 0
+
+        def _walk(name, node):
+            nonlocal resized
+            floor_dl, floor_ul = largest.get(name, (0, 0))
+            for child_name, child in node.get("children", {}).items():
+                c_dl, c_ul = _walk(child_name, child)
+                floor_dl, floor_ul = max(floor_dl, c_dl), max(floor_ul, c_ul)
+
+            override = self.CAPACITY_OVERRIDES.get(name)
+            samples, p_dl, p_ul = observed.get(name, (0, 0, 0))
+            if isinstance(override, dict):
+                for key, field in (("downloadBandwidthMbps", "download"),
+                                   ("uploadBandwidthMbps",   "upload")):
+                    if field in override:
+                        node[key] = max(int(override[field]), 1)
+                    elif "factor" in override:
+                        node[key] = max(int(node[key] / self.CAPACITY_FACTOR * override["factor"]), 1)
+                resized += 1
+            elif percentile and samples >= self.CAPACITY_MIN_SAMPLES:
+                for key, value, floor in (("downloadBandwidthMbps", p_dl, floor_dl),
+                                          ("uploadBandwidthMbps",   p_ul, floor_ul)):
+                    size = max(int(value * self.CAPACITY_HEADROOM), floor, 1)
+                    node[key] = min(node[key], size)
+                resized += 1
+            return floor_dl, floor_ul
+
+        for name, node in network_config.items():
+            _walk(name, node)
+        logger.info(f"Capacity model '{self.CAPACITY_MODEL}': resized {resized} node(s)")
+
+    def _observed_percentiles(self, conn, network_config):
+        """
+        {node: (samples, dl_pct, ul_pct)}: the nearest-rank CAPACITY_PERCENTILE
+        of each node's concurrent usage within CAPACITY_WINDOW, where a sample
+        is the sum over the node's subtree at one sample_time. Computed in
+        SQLite over node_usage (window functions, 3.25+) so only one row per
+        node reaches Python.
+        """
+        tree = []
+
+        def _collect(name, node, ancestors):
+            ancestors = ancestors + [name]
+            tree.extend((name, ancestor) for ancestor in ancestors)
+            for child_name, child in node.get("children", {}).items():
+                _collect(child_name, child, ancestors)
+
+        for name, node in network_config.items():
+            _collect(name, node, [])
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS node_tree (node TEXT, ancestor TEXT)")
+        conn.execute("DELETE FROM node_tree")
+        conn.executemany("INSERT INTO node_tree VALUES (?, ?)", tree)
+        try:
+            rows = conn.execute("""
+                WITH series AS (
+                    SELECT t.ancestor AS node, SUM(u.dl_mbps) AS dl, SUM(u.ul_mbps) AS ul
+                    FROM node_usage u JOIN node_tree t ON t.node = u.node
+                    WHERE u.sample_time >= (SELECT MAX(sample_time) FROM node_usage) - ?2
+                    GROUP BY t.ancestor, u.sample_time
+                ), ranked AS (
+                    SELECT node, dl, ul,
+                           ROW_NUMBER() OVER (PARTITION BY node ORDER BY dl) AS dl_rank,
+                           ROW_NUMBER() OVER (PARTITION BY node ORDER BY ul) AS ul_rank,
+                           COUNT(*) OVER (PARTITION BY node) AS n
+                    FROM series
+                ), picked AS (
+                    SELECT *, MIN(MAX(CAST(?1 * n AS INTEGER) + (?1 * n > CAST(?1 * n AS INTEGER)), 1), n)
+                              AS target
+                    FROM ranked
+                )
+                SELECT node, MAX(n),
+                       MAX(CASE WHEN dl_rank = target THEN dl END),
+                       MAX(CASE WHEN ul_rank = target THEN ul END)
+                FROM picked GROUP BY node
+            """, (self.CAPACITY_PERCENTILE / 100, self.CAPACITY_WINDOW)).fetchall()
+        except sqlite3.OperationalError:
+            return {}   # DB not opened through DeviceDatabase — no samples yet
+        return {node: (n, dl, ul) for node, n, dl, ul in rows}
+
+    # ── Private — network.json builders ────────────────────────────────────
+
+    def _node_entry(self, dl, ul, node_type):
+        """One network.json node sized at CAPACITY_FACTOR × its aggregate plan rates."""
+        return {
+            "downloadBandwidthMbps": max(int(dl * self.CAPACITY_FACTOR), 1),
+            "uploadBandwidthMbps":   max(int(ul * self.CAPACITY_FACTOR), 1),
+            "type": node_type,
+            "children": {}
+        }
+
+    def _build_network_json_by_router(self, router_totals):
+        """network.json with each router as a top-level node (ap_only)."""
+        return {
+            name: self._node_entry(dl, ul, "ap")
+            for name, (dl, ul) in router_totals.items()
+        }
+
+    def _build_network_json_by_site(self, node_totals):
+        """
+        network.json from the site → router → access-level hierarchy
+        (ap_site / full). Top-level and inner nodes are 'site', leaves 'ap'.
+        """
+        children = {}
+        for name, (_, _, parent) in node_totals.items():
+            children.setdefault(parent, []).append(name)
+
+        def _build(name, is_top):
+            dl, ul, _ = node_totals[name]
+            kids = children.get(name, [])
+            entry = self._node_entry(dl, ul, "site" if is_top or kids else "ap")
+            for kid in kids:
+                entry["children"][kid] = _build(kid, False)
+            return entry
+
+        return {name: _build(name, True) for name in children.get('', [])}
+
+    def _build_network_json(self, cpu_totals):
+        """network.json with CPU nodes (cpu strategy)."""
+        return {
+            cpu: self._node_entry(dl, ul, "site")
+            for cpu, (dl, ul, *_) in cpu_totals.items()
         }
-        self.write_network_json(network_config)
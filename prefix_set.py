@@ -0,0 +1,64 @@
+import ipaddress
+
+
+class PrefixSet:
+    """
+    A set of IPv4 hosts kept as its minimal list of covering CIDR prefixes.
+
+    Prefixes are stored as (prefix_len, block) integer pairs, where block is
+    the address shifted right by 32 - prefix_len. Adding a host merges it with
+    its buddy block for as long as the buddy is present; removing a host
+    splits its covering prefix back into the buddies along its path. Both are
+    O(prefix length) — at most 32 set lookups — so WANManager can keep every
+    WAN's collapsed address list current as devices come and go, without
+    re-collapsing the whole list.
+    """
+
+    __slots__ = ('_prefixes',)
+
+    def __init__(self, hosts=()):
+        self._prefixes = set()
+        for ip in hosts:
+            self.add(ip)
+
+    def __len__(self):
+        return len(self._prefixes)
+
+    def __contains__(self, ip):
+        return self._covering(ip) is not None
+
+    def _covering(self, ip):
+        """The stored (prefix_len, block) containing ip, or None."""
+        for plen in range(32, -1, -1):
+            key = (plen, ip >> (32 - plen))
+            if key in self._prefixes:
+                return key
+        return None
+
+    def add(self, ip) -> bool:
+        """Add a host (int). Returns True if the prefix list changed."""
+        if self._covering(ip) is not None:
+            return False
+        plen, block = 32, ip
+        while plen > 0 and (plen, block ^ 1) in self._prefixes:
+            self._prefixes.remove((plen, block ^ 1))
+            plen, block = plen - 1, block >> 1
+        self._prefixes.add((plen, block))
+        return True
+
+    def discard(self, ip) -> bool:
+        """Remove a host (int). Returns True if the prefix list changed."""
+        key = self._covering(ip)
+        if key is None:
+            return False
+        self._prefixes.remove(key)
+        for plen in range(key[0] + 1, 33):
+            self._prefixes.add((plen, (ip >> (32 - plen)) ^ 1))
+        return True
+
+    def cidrs(self):
+        """The prefixes as CIDR strings ('10.0.0.0/24', '10.0.1.7/32', ...)."""
+        return [
+            f"{ipaddress.IPv4Address(block << (32 - plen))}/{plen}"
+            for plen, block in self._prefixes
+        ]
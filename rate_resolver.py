@@ -103,6 +103,11 @@ class RateResolver:
         ts = datetime.fromtimestamp(scan_time).strftime('%Y-%m-%d %H:%M:%S')
         return f"{source} | {rate_label} | {ts}"
 
+    @staticmethod
+    def comment_body(comment):
+        """A build_comment string without its trailing scan timestamp."""
+        return re.sub(r' \| \d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$', '', comment or '')
+
     @staticmethod
     def extract_first_rate(text):
         """
@@ -1,17 +1,30 @@
+import ipaddress
 import logging
 import time
 
 import routeros_api
 
 from rate_resolver import RateResolver
+from settings import USAGE_ENABLED
 
 logger = logging.getLogger(__name__)
 
 
 class RouterScanner:
+    USAGE_ENABLED = USAGE_ENABLED
+
     def __init__(self, db):
         # db: DeviceDatabase — scanner writes discovered devices through it
         self.db = db
+        # {ipv4: (download_bytes, upload_bytes)} from the current router's hotspot
+        # sessions, kept so usage collection does not re-fetch /ip/hotspot/active
+        self._hotspot_bytes = {}
+        # Set by the caller for strategies that shape on the discovered hierarchy
+        # (ap_site / full); costs a few extra API reads per router scan
+        self.discover_topology = False
+        # {code: (source, session_key, ipv4)} from the current router's scan,
+        # resolved to access paths by _collect_topology
+        self._access = {}
 
     # ── Router connection ───────────────────────────────────────────────────
 
@@ -21,20 +34,30 @@ class RouterScanner:
         Open a RouterOS API connection with retry logic.
         Returns the API object on success, None after all retries are exhausted.
         """
+        pool = RouterScanner.connect_pool(router, retries)
+        return pool.get_api() if pool is not None else None
+
+    @staticmethod
+    def connect_pool(router, retries=3):
+        """
+        As connect, but returns the logged-in RouterOsApiPool, so the caller
+        can disconnect() it when done (WANManager's connect_fn).
+        """
         for attempt in range(retries):
             try:
-                api = routeros_api.RouterOsApiPool(
+                pool = routeros_api.RouterOsApiPool(
                     router['address'],
                     username=router['username'],
                     password=router['password'],
                     port=router['port'],
                     plaintext_login=True,
-                ).get_api()
+                )
+                pool.get_api()
                 logger.info(
                     f"Connected to {router['name']} ({router['address']}) "
                     f"[attempt {attempt + 1}]"
                 )
-                return api
+                return pool
             except Exception as e:
                 logger.warning(
                     f"Connection error to {router['name']} "
@@ -77,11 +100,17 @@ class RouterScanner:
             }
 
             changed = False
+            self._access = {}
             changed |= self._process_pppoe_users(api, router, ip_to_list, scan_time)
             changed |= self._process_hotspot_users(api, router, ip_to_list, scan_time)
             changed |= self._process_dhcp_leases(api, router, ip_to_list, scan_time)
             changed |= self._process_address_list(router, addr_list_entries, scan_time)
 
+            if self.USAGE_ENABLED:
+                self._collect_usage(api, router, scan_time)
+            if self.discover_topology:
+                changed |= self._collect_topology(api, router)
+
             self.db.conn.commit()
             return changed
 
@@ -133,6 +162,7 @@ class RouterScanner:
             )
 
             comment = RateResolver.build_comment('pppoe', rate_used or list_name, rate_failed, scan_time)
+            self._access[code] = ('pppoe', name, address)
 
             if self.db.upsert_device(
                 code, '', mac, address, comment, 'pppoe', router_name,
@@ -158,12 +188,18 @@ class RouterScanner:
 
         users = self.get_resource_data(api, '/ip/hotspot/active')
         logger.info(f"Hotspot: {len(users)} active users on {router_name}")
+        self._hotspot_bytes = {}
 
         for user in users:
             username = user.get('user', '')
             mac      = user.get('mac-address', '').upper()
             address  = user.get('address', '')
 
+            if address:
+                self._hotspot_bytes[address] = (
+                    self._to_int(user.get('bytes-out')), self._to_int(user.get('bytes-in'))
+                )
+
             if (not username and not mac) or not address:
                 continue
 
@@ -184,6 +220,7 @@ class RouterScanner:
             )
 
             comment = RateResolver.build_comment('hotspot', rate_used or list_name, rate_failed, scan_time)
+            self._access[code] = ('hotspot', user.get('server', ''), address)
 
             if self.db.upsert_device(
                 code, '', mac, address, comment, 'hotspot', router_name,
@@ -234,6 +271,7 @@ class RouterScanner:
             comment = RateResolver.build_comment(
                 'dhcp', rate_used or addr_list_field, rate_failed, scan_time
             )
+            self._access[code] = ('dhcp', lease.get('server', ''), address)
 
             if self.db.upsert_device(
                 code, '', mac, address, comment, 'dhcp', router_name,
@@ -243,6 +281,111 @@ class RouterScanner:
 
         return changed
 
+    def _collect_usage(self, api, router, scan_time):
+        """
+        Gather cumulative per-subscriber byte counters and hand them to the DB:
+          - PPPoE: dynamic <pppoe-NAME> server interfaces (tx = download)
+          - Hotspot: bytes-out/bytes-in of the sessions fetched this scan
+          - Simple queues: 'bytes' (upload/download) of single-host targets,
+            which covers DHCP and address-list subscribers
+        """
+        by_code = {}
+        for iface in self.get_resource_data(api, '/interface'):
+            name = iface.get('name', '')
+            if iface.get('type') == 'pppoe-in' and name.startswith('<pppoe-') and name.endswith('>'):
+                by_code[f"PPP-{name[7:-1]}"] = (
+                    self._to_int(iface.get('tx-byte')), self._to_int(iface.get('rx-byte'))
+                )
+
+        by_ip = {}
+        for queue in self.get_resource_data(api, '/queue/simple'):
+            target = queue.get('target', '')
+            up, _, down = queue.get('bytes', '').partition('/')
+            if target.endswith('/32') and ',' not in target and down:
+                by_ip[target[:-3]] = (self._to_int(down), self._to_int(up))
+        by_ip.update(self._hotspot_bytes)
+
+        self.db.record_usage(router['name'], by_code, by_ip, scan_time)
+        self._hotspot_bytes = {}
+
+    def _collect_topology(self, api, router) -> bool:
+        """
+        Resolve each subscriber seen this scan to its access path on the BRAS,
+        stored as 'interface/server/pool':
+          - PPPoE: session → /interface/pppoe-server binding (service) →
+            /interface/pppoe-server/server (interface)
+          - Hotspot: session server → /ip/hotspot (interface)
+          - DHCP: lease server → /ip/dhcp-server (interface, address-pool)
+          - Pool: the /ip/pool whose ranges contain the subscriber address
+        Returns True if any device's path changed.
+        """
+        if not self._access:
+            return False
+
+        pppoe_service = {
+            b.get('user', ''): b.get('service', '')
+            for b in self.get_resource_data(api, '/interface/pppoe-server')
+        }
+        servers = {
+            ('pppoe', s.get('service-name', '')): (s.get('interface', ''), '')
+            for s in self.get_resource_data(api, '/interface/pppoe-server/server')
+        }
+        for h in self.get_resource_data(api, '/ip/hotspot'):
+            servers[('hotspot', h.get('name', ''))] = (h.get('interface', ''), h.get('address-pool', ''))
+        for d in self.get_resource_data(api, '/ip/dhcp-server'):
+            servers[('dhcp', d.get('name', ''))] = (d.get('interface', ''), d.get('address-pool', ''))
+        pools = self._parse_pools(self.get_resource_data(api, '/ip/pool'))
+
+        paths = {}
+        for code, (source, key, address) in self._access.items():
+            server = pppoe_service.get(key, '') if source == 'pppoe' else key
+            iface, server_pool = servers.get((source, server), ('', ''))
+            if server_pool == 'none':
+                server_pool = ''
+            pool = self._pool_for(pools, address) or server_pool
+            paths[code] = '/'.join(c.replace('/', '-') for c in (iface, server, pool))
+
+        logger.info(f"Topology: resolved {len(paths)} access paths on {router['name']}")
+        return self.db.update_topology(paths)
+
+    @staticmethod
+    def _parse_pools(entries):
+        """/ip/pool entries → [(first_int, last_int, name)] from their 'ranges' field."""
+        pools = []
+        for entry in entries:
+            for part in entry.get('ranges', '').split(','):
+                part = part.strip()
+                try:
+                    if '/' in part:
+                        net = ipaddress.IPv4Network(part, strict=False)
+                        first, last = int(net.network_address), int(net.broadcast_address)
+                    else:
+                        lo, _, hi = part.partition('-')
+                        first = int(ipaddress.IPv4Address(lo))
+                        last  = int(ipaddress.IPv4Address(hi or lo))
+                except ValueError:
+                    continue
+                pools.append((first, last, entry.get('name', '')))
+        return pools
+
+    @staticmethod
+    def _pool_for(pools, address):
+        try:
+            ip = int(ipaddress.IPv4Address(address))
+        except ValueError:
+            return ''
+        for first, last, name in pools:
+            if first <= ip <= last:
+                return name
+        return ''
+
+    @staticmethod
+    def _to_int(value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return 0
+
     def _process_address_list(self, router, addr_list_entries, scan_time) -> bool:
         """
         Standalone address list entries: rate comes directly from the list name.
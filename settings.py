@@ -12,6 +12,39 @@ _DEFAULTS = {
         "default_interval": 300,
         "error_retry_interval": 30,
         "rebalance_threshold": 1.10,
+        "rebalance_low_watermark": 1.0,
+        "rebalance_move_budget": 500,
+        "vectorized_threshold": 20000,
+        "sync_batch_size": 200,
+        "sync_workers": 4,
+        "core_sync_deadline": 120,
+        "cache_sample_size": 16,
+        "traffic_half_life": 900,
+        "traffic_min_samples": 3,
+        "traffic_max_age": 900,
+    },
+    "node_assigner": {
+        "balance_circuits": True,
+        "refine_time_budget": 2.0,
+        "vectorized_threshold": 20000,
+        "ht_sibling_weight": 0.6,
+        "numa_remote_weight": 0.8,
+    },
+    "usage": {
+        "enabled": False,
+        "weight_by_usage": False,
+        "peak_hours": [18, 23],
+        "half_life": 3600,
+        "min_samples": 6,
+    },
+    "capacity": {
+        "model": "fixed",
+        "factor": 1.1,
+        "percentile": 95,
+        "headroom": 1.2,
+        "min_samples": 12,
+        "window_hours": 168,
+        "overrides": {},
     },
     "rates": {
         "min_dl_rate_percentage": 0.5,
@@ -24,6 +57,9 @@ _DEFAULTS = {
     },
     "database": {
         "tc_u16_warn_threshold": 60000,
+        "tc_u16_node_limit": 30000,
+        "change_poll_interval": 1.0,
+        "journal_retention": 200000,
         "source_priority": {
             "pppoe": 4,
             "hotspot": 3,
@@ -84,9 +120,45 @@ ERROR_RETRY_INTERVAL = int(_s["scanner"]["error_retry_interval"])
 WAN_DEFAULT_INTERVAL     = int(_s["wan_service"]["default_interval"])
 WAN_ERROR_RETRY_INTERVAL = int(_s["wan_service"]["error_retry_interval"])
 WAN_REBALANCE_THRESHOLD  = float(_s["wan_service"]["rebalance_threshold"])
+WAN_REBALANCE_LOW_MARK   = float(_s["wan_service"]["rebalance_low_watermark"])
+WAN_REBALANCE_BUDGET     = int(_s["wan_service"]["rebalance_move_budget"])
+WAN_VECTORIZED_THRESHOLD = int(_s["wan_service"]["vectorized_threshold"])
+WAN_SYNC_BATCH_SIZE      = int(_s["wan_service"]["sync_batch_size"])
+WAN_SYNC_WORKERS         = int(_s["wan_service"]["sync_workers"])
+WAN_CORE_SYNC_DEADLINE   = float(_s["wan_service"]["core_sync_deadline"])
+WAN_CACHE_SAMPLE_SIZE    = int(_s["wan_service"]["cache_sample_size"])
+WAN_TRAFFIC_HALF_LIFE    = float(_s["wan_service"]["traffic_half_life"])
+WAN_TRAFFIC_MIN_SAMPLES  = int(_s["wan_service"]["traffic_min_samples"])
+WAN_TRAFFIC_MAX_AGE      = float(_s["wan_service"]["traffic_max_age"])
+
+# ── Node assigner constants ───────────────────────────────────────────────────
+CPU_BALANCE_CIRCUITS     = bool(_s["node_assigner"]["balance_circuits"])
+CPU_REFINE_TIME_BUDGET   = float(_s["node_assigner"]["refine_time_budget"])
+CPU_VECTORIZED_THRESHOLD = int(_s["node_assigner"]["vectorized_threshold"])
+HT_SIBLING_WEIGHT        = float(_s["node_assigner"]["ht_sibling_weight"])
+NUMA_REMOTE_WEIGHT       = float(_s["node_assigner"]["numa_remote_weight"])
+
+# ── Usage tracking constants ──────────────────────────────────────────────────
+USAGE_ENABLED     = bool(_s["usage"]["enabled"])
+USAGE_WEIGHTING   = bool(_s["usage"]["weight_by_usage"])
+USAGE_PEAK_HOURS  = tuple(int(h) for h in _s["usage"]["peak_hours"])
+USAGE_HALF_LIFE   = float(_s["usage"]["half_life"])
+USAGE_MIN_SAMPLES = int(_s["usage"]["min_samples"])
+
+# ── Node capacity model constants ─────────────────────────────────────────────
+CAPACITY_MODEL       = str(_s["capacity"]["model"])
+CAPACITY_FACTOR      = float(_s["capacity"]["factor"])
+CAPACITY_PERCENTILE  = float(_s["capacity"]["percentile"])
+CAPACITY_HEADROOM    = float(_s["capacity"]["headroom"])
+CAPACITY_MIN_SAMPLES = int(_s["capacity"]["min_samples"])
+CAPACITY_WINDOW      = float(_s["capacity"]["window_hours"]) * 3600
+CAPACITY_OVERRIDES   = dict(_s["capacity"]["overrides"])
 
 # ── Database constants ────────────────────────────────────────────────────────
 TC_U16_WARN_THRESHOLD = int(_s["database"]["tc_u16_warn_threshold"])
+TC_U16_NODE_LIMIT     = int(_s["database"]["tc_u16_node_limit"])
+CHANGE_POLL_INTERVAL  = float(_s["database"]["change_poll_interval"])
+JOURNAL_RETENTION     = int(_s["database"]["journal_retention"])
 SOURCE_PRIORITY       = dict(_s["database"]["source_priority"])
 
 # ── GUI constants ─────────────────────────────────────────────────────────────
@@ -0,0 +1,93 @@
+import pytest
+
+import cpu_topology
+from cpu_topology import CpuTopology
+
+LQOS_CONF = """
+[queues]
+# override_available_queues = 3
+override_available_queues = {override}
+
+[bridge]
+use_xdp_bridge = true
+to_internet = "ens1f0"   # ISP side
+to_network = "ens1f1"
+
+[single_interface]
+interface = ""
+"""
+
+
+@pytest.fixture
+def sysfs(tmp_path, monkeypatch):
+    """
+    Fake /sys for 8 online CPUs (0-3 on NUMA node 0, 4-7 on node 1, CPU n
+    and n+4 are hyperthread siblings) and two 6-queue NICs on node 0.
+    """
+    cpu = tmp_path / 'cpu'
+    net = tmp_path / 'net'
+    cpu.mkdir()
+    (cpu / 'online').write_text("0-7\n")
+    for n in range(8):
+        (cpu / f"cpu{n}" / 'topology').mkdir(parents=True)
+        (cpu / f"cpu{n}" / f"node{n // 4}").mkdir()
+        (cpu / f"cpu{n}" / 'topology' / 'thread_siblings_list').write_text(f"{n % 4},{n % 4 + 4}\n")
+    for iface in ('ens1f0', 'ens1f1'):
+        (net / iface / 'device').mkdir(parents=True)
+        (net / iface / 'device' / 'numa_node').write_text("0\n")
+        for q in range(6):
+            (net / iface / 'queues' / f"rx-{q}").mkdir(parents=True)
+            (net / iface / 'queues' / f"tx-{q}").mkdir()
+    monkeypatch.setattr(cpu_topology, "_SYS_CPU", cpu)
+    monkeypatch.setattr(cpu_topology, "_SYS_NET", net)
+    monkeypatch.setattr(CpuTopology, "HT_SIBLING_WEIGHT", 0.5)
+    monkeypatch.setattr(CpuTopology, "NUMA_REMOTE_WEIGHT", 0.8)
+    return tmp_path
+
+
+def _conf(tmp_path, override=0):
+    path = tmp_path / 'lqos.conf'
+    path.write_text(LQOS_CONF.format(override=override))
+    return str(path)
+
+
+@pytest.mark.parametrize("text, cpus", [
+    ("0-3,8,10-11\n", [0, 1, 2, 3, 8, 10, 11]),
+    ("5", [5]),
+    ("2,0-1,1", [0, 1, 2]),
+    ("", []),
+])
+def test_parse_cpu_list(text, cpus):
+    assert CpuTopology.parse_cpu_list(text) == cpus
+
+
+def test_read_lqos_conf(tmp_path):
+    assert CpuTopology.read_lqos_conf(_conf(tmp_path, 4)) == (4, ['ens1f0', 'ens1f1'])
+    assert CpuTopology.read_lqos_conf(_conf(tmp_path, 'auto')) == (0, ['ens1f0', 'ens1f1'])
+    assert CpuTopology.read_lqos_conf(str(tmp_path / 'missing.conf')) == (0, [])
+
+
+def test_shaping_cores_follow_nic_queues(sysfs):
+    cores = CpuTopology.shaping_cores(_conf(sysfs))
+
+    # 6 queues bind CPUs 0-5; 0/4 and 1/5 are sibling pairs, 4-5 are remote
+    assert cores == pytest.approx([(0, 0.5), (1, 0.5), (2, 1.0), (3, 1.0), (4, 0.4), (5, 0.4)])
+
+
+def test_shaping_cores_override_and_online_limit(sysfs):
+    assert CpuTopology.shaping_cores(_conf(sysfs, 3)) == [(0, 1.0), (1, 1.0), (2, 1.0)]
+
+    (sysfs / 'cpu' / 'online').write_text("0-1,4-5\n")
+    cores = CpuTopology.shaping_cores(_conf(sysfs))
+    assert cores == pytest.approx([(0, 0.5), (1, 0.5), (4, 0.4), (5, 0.4)])
+
+
+def test_shaping_cores_without_nic_info(sysfs):
+    for iface in ('ens1f0', 'ens1f1'):
+        (sysfs / 'net' / iface / 'device' / 'numa_node').write_text("-1\n")
+        for q in range(6):
+            (sysfs / 'net' / iface / 'queues' / f"rx-{q}").rmdir()
+
+    # No usable queue count: every online CPU shapes, and no NUMA penalty applies
+    cores = CpuTopology.shaping_cores(_conf(sysfs))
+    assert cores == [(n, 0.5) for n in range(8)]
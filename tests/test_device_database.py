@@ -0,0 +1,255 @@
+from datetime import datetime
+
+import pytest
+
+import device_database
+from device_database import DeviceDatabase
+from rate_resolver import RateResolver
+
+
+def _open(tmp_path):
+    db = DeviceDatabase(str(tmp_path / 'devices.db'), str(tmp_path / 'ShapedDevices.csv'))
+    db.open()
+    return db
+
+
+def _scan(db, scan_time, count=50):
+    """Upsert count PPPoE devices the way RouterScanner does; True if any changed."""
+    changed = False
+    for i in range(count):
+        comment = RateResolver.build_comment('pppoe', '50M/20M', False, scan_time)
+        changed |= db.upsert_device(
+            f"PPP-user{i}", '', f"AA:BB:CC:00:00:{i:02X}", f"10.0.0.{i + 1}", comment,
+            'pppoe', 'R1', 50, 20, 25, 10, scan_time
+        )
+    db.conn.commit()
+    return changed
+
+
+def test_identical_scan_journals_nothing(tmp_path):
+    db = _open(tmp_path)
+    assert _scan(db, 1_700_000_000)
+    db.conn.execute("UPDATE devices SET parent_node = 'CPU0'")
+    db.conn.commit()
+    version = DeviceDatabase.journal_version(db.conn)
+
+    assert not _scan(db, 1_700_000_600)
+
+    assert DeviceDatabase.journal_changes(db.conn, version) == (version, {})
+    assert {p for (p,) in db.conn.execute("SELECT parent_node FROM devices")} == {'CPU0'}
+    assert db.conn.execute("SELECT MIN(last_seen) FROM devices").fetchone()[0] == 1_700_000_600
+
+
+def test_rate_change_is_journaled(tmp_path):
+    db = _open(tmp_path)
+    _scan(db, 1_700_000_000, count=1)
+    version = DeviceDatabase.journal_version(db.conn)
+
+    comment = RateResolver.build_comment('pppoe', '100M/50M', False, 1_700_000_600)
+    assert db.upsert_device(
+        "PPP-user0", '', "AA:BB:CC:00:00:00", "10.0.0.1", comment,
+        'pppoe', 'R1', 100, 50, 50, 25, 1_700_000_600
+    )
+    db.conn.commit()
+
+    assert DeviceDatabase.journal_changes(db.conn, version)[1] == {"PPP-user0": "update"}
+
+
+def test_insert_then_update_is_journaled_as_insert(tmp_path):
+    db = _open(tmp_path)
+    _scan(db, 1_700_000_000, count=1)
+    version = DeviceDatabase.journal_version(db.conn)
+
+    _scan(db, 1_700_000_000, count=2)
+    db.conn.execute("UPDATE devices SET wan_name = 'WAN1' WHERE code = 'PPP-user1'")
+    db.conn.execute("UPDATE devices SET wan_name = 'WAN1' WHERE code = 'PPP-user0'")
+    db.conn.commit()
+
+    assert DeviceDatabase.journal_changes(db.conn, version)[1] == {
+        "PPP-user1": "insert", "PPP-user0": "update",
+    }
+
+
+# ── Search index ──
+
+def _search(conn, q):
+    condition, params = DeviceDatabase.search_condition(conn, q)
+    return {code for (code,) in conn.execute(f"SELECT code FROM devices WHERE {condition}", params)}
+
+
+def _matches(db, q):
+    """Codes whose search columns contain every term of q, computed in Python."""
+    rows = db.conn.execute("SELECT code, mac, ipv4, ipv6, comment FROM devices").fetchall()
+    hits = set()
+    for row in rows:
+        text = [v.lower() for v in row if v]
+        if row[1]:
+            text.append(row[1].lower().replace(':', '').replace('-', '').replace('.', ''))
+        if all(any(term.lower() in v for v in text) for term in q.split()):
+            hits.add(row[0])
+    return hits
+
+
+def _indexed(db):
+    if db.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'devices_fts'").fetchone() is None:
+        pytest.skip("SQLite without FTS5 trigram tokenizer")
+
+
+def _seed(db):
+    _scan(db, 1_700_000_000, count=30)
+    db.conn.execute("UPDATE devices SET comment = 'rate 100%_cap' WHERE code = 'PPP-user7'")
+    db.conn.execute("UPDATE devices SET ipv6 = '2001:db8::7' WHERE code = 'PPP-user7'")
+    db.conn.commit()
+
+
+def test_search_triggers_follow_insert_update_and_delete(tmp_path):
+    db = _open(tmp_path)
+    _indexed(db)
+    _scan(db, 1_700_000_000, count=3)
+    assert _search(db.conn, "aabbcc000002") == {"PPP-user2"}
+
+    db.conn.execute("UPDATE devices SET ipv4 = '192.0.2.9', comment = 'moved' WHERE code = 'PPP-user2'")
+    assert _search(db.conn, "10.0.0.3") == set()
+    assert _search(db.conn, "192.0.2.9 moved") == {"PPP-user2"}
+
+    db.conn.execute("DELETE FROM devices WHERE code = 'PPP-user2'")
+    assert _search(db.conn, "192.0.2.9") == set()
+    assert db.conn.execute("SELECT COUNT(*) FROM devices_fts").fetchone()[0] == 2
+
+
+def test_renumbered_rowids_rebuild_search_index(tmp_path):
+    db = _open(tmp_path)
+    _indexed(db)
+    _scan(db, 1_700_000_000, count=3)
+    db.conn.execute("UPDATE devices SET rowid = rowid + 100")
+    db.conn.commit()
+    assert _search(db.conn, "PPP-user1") == set()
+    db.conn.close()
+
+    db = _open(tmp_path)
+
+    assert _search(db.conn, "PPP-user1") == {"PPP-user1"}
+    assert _search(db.conn, "10.0.0.3") == {"PPP-user2"}
+
+
+SEARCHES = [
+    "PPP", "user1", "ppp-USER2", "10.0.0.1", "aa:bb:cc:00:00:0a", "aabbcc00000a",
+    "00:1", "1", "0a", "u", "ser 10.0", "2001:db8", ":7", "db8 cap",
+    "100%", "%", "_", "0%_", "e_", "%_c", "nomatch", "zz",
+]
+
+
+@pytest.mark.parametrize("q", SEARCHES)
+def test_search_index_matches_like_fallback(tmp_path, q):
+    db = _open(tmp_path)
+    _indexed(db)
+    _seed(db)
+    fallback = DeviceDatabase(str(tmp_path / 'fallback.db'), str(tmp_path / 'fallback.csv'))
+    fallback.open()
+    _seed(fallback)
+    for (name,) in fallback.conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'devices\\_search\\_%' ESCAPE '\\'"
+    ).fetchall():
+        fallback.conn.execute(f"DROP TRIGGER {name}")
+    fallback.conn.execute("DROP TABLE devices_fts")
+
+    expected = _matches(db, q)
+    assert _search(db.conn, q) == expected
+    assert _search(fallback.conn, q) == expected
+
+
+# ── Usage averages ──
+
+MB = 1_000_000 // 8  # bytes per megabit
+
+
+def _at(hour, minute=0):
+    return int(datetime(2026, 1, 5, hour, minute).timestamp())
+
+
+def _usage(db, code="PPP-user0"):
+    return db.conn.execute(
+        "SELECT usage_dl_mbps, usage_ul_mbps, usage_samples, usage_dl_last, usage_ul_last "
+        "FROM devices WHERE code = ?", (code,)
+    ).fetchone()
+
+
+@pytest.fixture
+def peak(monkeypatch):
+    monkeypatch.setattr(device_database, "USAGE_PEAK_HOURS", (19, 23))
+    monkeypatch.setattr(device_database, "USAGE_HALF_LIFE", 600)
+
+
+def test_usage_average_decays_with_half_life(tmp_path, peak):
+    db = _open(tmp_path)
+    _scan(db, _at(19), count=1)
+    db.record_usage('R1', {"PPP-user0": (0, 0)}, {}, _at(19))
+    assert _usage(db)[2] == 0
+
+    # 100 / 20 Mbps over the first 10 minutes seeds the average outright
+    db.record_usage('R1', {"PPP-user0": (600 * 100 * MB, 600 * 20 * MB)}, {}, _at(19, 10))
+    assert _usage(db) == pytest.approx((100, 20, 1, 100, 20))
+
+    # One half-life at 0 Mbps halves it
+    db.record_usage('R1', {"PPP-user0": (600 * 100 * MB, 600 * 20 * MB)}, {}, _at(19, 20))
+    assert _usage(db) == pytest.approx((50, 10, 2, 0, 0))
+
+    # Two half-lives at 60 / 30 Mbps close three quarters of the gap
+    db.record_usage('R1', {"PPP-user0": (600 * 100 * MB + 1200 * 60 * MB,
+                                         600 * 20 * MB + 1200 * 30 * MB)}, {}, _at(19, 40))
+    assert _usage(db) == pytest.approx((57.5, 25, 3, 60, 30))
+
+
+def test_usage_average_only_advances_in_peak_hours(tmp_path, peak):
+    db = _open(tmp_path)
+    _scan(db, _at(12), count=2)
+    db.record_usage('R1', {}, {"10.0.0.1": (0, 0), "10.0.0.2": (0, 0)}, _at(12))
+
+    db.record_usage('R1', {}, {"10.0.0.1": (600 * 80 * MB, 0)}, _at(12, 10))
+
+    # Off-peak: the rate is measured and the counters re-baselined, the average untouched
+    assert _usage(db) == pytest.approx((0, 0, 0, 80, 0))
+    assert db.conn.execute(
+        "SELECT usage_dl_bytes, usage_sample_time FROM devices WHERE code = 'PPP-user0'"
+    ).fetchone() == (600 * 80 * MB, _at(12, 10))
+    # A device missing from the round keeps its previous baseline
+    assert db.conn.execute(
+        "SELECT usage_sample_time FROM devices WHERE code = 'PPP-user1'"
+    ).fetchone() == (_at(12),)
+
+    db.conn.execute("UPDATE devices SET usage_sample_time = ? WHERE code = 'PPP-user0'", (_at(22, 50),))
+    db.record_usage('R1', {}, {"10.0.0.1": (600 * 80 * MB + 600 * 40 * MB, 0)}, _at(23))
+    assert _usage(db)[2] == 0
+
+    db.record_usage('R1', {}, {"10.0.0.1": (600 * 80 * MB + 600 * 40 * MB, 0)}, _at(22, 59))
+    assert _usage(db)[2] == 0  # clock went backwards: no rate, just a new baseline
+
+
+def test_usage_average_overnight_peak_window(tmp_path, monkeypatch):
+    monkeypatch.setattr(device_database, "USAGE_PEAK_HOURS", (22, 2))
+    db = _open(tmp_path)
+    _scan(db, _at(0), count=1)
+    db.record_usage('R1', {"PPP-user0": (0, 0)}, {}, _at(0, 30))
+
+    db.record_usage('R1', {"PPP-user0": (600 * 40 * MB, 600 * 8 * MB)}, {}, _at(0, 40))
+
+    assert _usage(db) == pytest.approx((40, 8, 1, 40, 8))
+
+
+def test_usage_counter_reset_rebaselines(tmp_path, peak):
+    db = _open(tmp_path)
+    _scan(db, _at(20), count=1)
+    db.record_usage('R1', {"PPP-user0": (0, 0)}, {}, _at(20))
+    db.record_usage('R1', {"PPP-user0": (600 * 100 * MB, 600 * 20 * MB)}, {}, _at(20, 10))
+
+    # Reconnect: counters restart below the stored baseline
+    db.record_usage('R1', {"PPP-user0": (600 * 5 * MB, 600 * 20 * MB + 5)}, {}, _at(20, 20))
+
+    assert _usage(db) == pytest.approx((100, 20, 1, 0, 0))
+    assert db.conn.execute(
+        "SELECT usage_dl_bytes, usage_ul_bytes FROM devices WHERE code = 'PPP-user0'"
+    ).fetchone() == (600 * 5 * MB, 600 * 20 * MB + 5)
+
+    # The next round measures from the new baseline
+    db.record_usage('R1', {"PPP-user0": (600 * 5 * MB + 600 * 100 * MB, 600 * 20 * MB + 5)}, {}, _at(20, 30))
+    assert _usage(db) == pytest.approx((100, 10, 2, 100, 0))
@@ -0,0 +1,144 @@
+import pytest
+
+pytest.importorskip("flask")
+
+import gui
+from device_database import DeviceDatabase
+
+SOURCES = ['pppoe', 'hotspot', 'dhcp']
+
+
+@pytest.fixture
+def devices(tmp_path, monkeypatch):
+    """57 devices whose sort keys tie in small groups, with NULL and '' variants."""
+    db = DeviceDatabase(str(tmp_path / 'devices.db'))
+    db.open()
+    rows = []
+    for i in range(57):
+        rows.append({
+            'code': f"D{i:02d}",
+            'ipv4': None if i % 5 == 0 else f"10.0.{i % 4}.{i + 1}",
+            'router': None if i % 6 == 0 else f"R{i % 2 + 1}",
+            'wan_name': ['', None, 'WAN1', 'WAN2'][i % 4],
+            'download_max_mbps': [10, 25, 50][i % 3],
+            'upload_max_mbps': [5, 10][i % 2],
+            'last_seen': 1_700_000_000 + i % 4 * 60,
+            'source': SOURCES[i % 3],
+            'comment': f"user{i}",
+        })
+    db.conn.executemany(
+        "INSERT INTO devices (code, circuit_id, device_id, ipv4, router, wan_name, "
+        "download_min_mbps, upload_min_mbps, download_max_mbps, upload_max_mbps, "
+        "last_seen, source, comment) VALUES (:code, :code, :code, :ipv4, :router, :wan_name, "
+        "1, 1, :download_max_mbps, :upload_max_mbps, :last_seen, :source, :comment)",
+        rows
+    )
+    db.conn.commit()
+    monkeypatch.setattr(gui, "DB_PATH", tmp_path / 'devices.db')
+    return rows
+
+
+@pytest.fixture
+def client():
+    client = gui.app.test_client()
+    with client.session_transaction() as sess:
+        sess["authed"] = True
+    return client
+
+
+SORT_VALUE = {
+    "last_seen": lambda r: r['last_seen'],
+    "code":      lambda r: r['code'],
+    "ipv4":      lambda r: r['ipv4'] or '',
+    "download":  lambda r: r['download_max_mbps'],
+    "upload":    lambda r: r['upload_max_mbps'],
+    "router":    lambda r: r['router'] or '',
+    "wan":       lambda r: r['wan_name'] or '',
+}
+
+
+def _pages(client, **params):
+    """Every code /api/devices returns, following next cursors from the first page."""
+    codes, cursor = [], None
+    for _ in range(100):
+        query = dict(params, limit=7)
+        if cursor:
+            query["cursor"] = cursor
+        d = client.get("/api/devices", query_string=query).get_json()
+        assert d["ok"], d
+        codes += [r["code"] for r in d["rows"]]
+        cursor = d["next"]
+        if not cursor:
+            return codes
+    raise AssertionError("paging did not terminate")
+
+
+def test_sorts_cover_every_device_page():
+    assert set(SORT_VALUE) == set(gui._DEVICE_SORTS)
+
+
+@pytest.mark.parametrize("order", ["asc", "desc"])
+@pytest.mark.parametrize("sort", sorted(gui._DEVICE_SORTS))
+def test_keyset_pages_skip_and_repeat_nothing(devices, client, sort, order):
+    codes = _pages(client, sort=sort, order=order)
+
+    key = SORT_VALUE[sort]
+    expected = sorted(devices, key=lambda r: (key(r), r['code']), reverse=order == "desc")
+    assert codes == [r['code'] for r in expected]
+
+
+@pytest.mark.parametrize("params, keep", [
+    ({"source": "pppoe"}, lambda r: r['source'] == 'pppoe'),
+    ({"source": "dhcp", "router": "R1"}, lambda r: r['source'] == 'dhcp' and r['router'] == 'R1'),
+    ({"wan": "WAN2", "min_dl": 25}, lambda r: r['wan_name'] == 'WAN2' and r['download_max_mbps'] >= 25),
+    ({"max_dl": 25, "min_ul": 10}, lambda r: r['download_max_mbps'] <= 25 and r['upload_max_mbps'] >= 10),
+    ({"q": "user1", "source": "hotspot"}, lambda r: 'user1' in r['comment'] and r['source'] == 'hotspot'),
+    ({"q": "10.0.3", "min_dl": 25}, lambda r: (r['ipv4'] or '').startswith('10.0.3') and r['download_max_mbps'] >= 25),
+])
+def test_filters_combine_across_pages(devices, client, params, keep):
+    codes = _pages(client, sort="download", order="desc", **params)
+
+    expected = sorted((r for r in devices if keep(r)),
+                      key=lambda r: (r['download_max_mbps'], r['code']), reverse=True)
+    assert expected and codes == [r['code'] for r in expected]
+
+
+@pytest.mark.parametrize("cursor", ["not-base64!", "bm90IGpzb24", gui._encode_cursor(1, 2)[:-4]])
+def test_malformed_cursor_is_rejected(devices, client, cursor):
+    r = client.get("/api/devices", query_string={"limit": 7, "cursor": cursor})
+
+    assert r.status_code == 400
+    assert r.get_json()["error"].startswith("Invalid cursor")
+
+
+class _Pool:
+    def __init__(self, router):
+        self.router, self.logins, self.connected = router, 0, False
+
+    def get_api(self):
+        if self.router.get("password") == "wrong":
+            raise ConnectionError("login failure")
+        if not self.connected:
+            self.logins, self.connected = self.logins + 1, True
+        return self
+
+    def disconnect(self):
+        self.connected = False
+
+
+def test_wan_operations_reuse_one_pool_per_core(monkeypatch):
+    monkeypatch.setattr(gui, "_connect_router_api", _Pool)
+    monkeypatch.setattr(gui, "_wan_pools", {})
+    core = {"name": "C1", "address": "192.0.2.1", "port": 8728, "username": "api", "password": "x"}
+
+    for _ in range(3):
+        with gui._wan_manager._session(core) as api:
+            assert api is not None
+    pool = gui._connect_for_wan(core)
+    assert pool.logins == 1 and pool.connected
+
+    # Edited credentials replace the core's pool; a failed login yields None
+    edited = dict(core, password="y")
+    assert gui._connect_for_wan(edited) is not pool and not pool.connected
+    assert gui._connect_for_wan(dict(core, password="wrong")) is None
+    assert len(gui._wan_pools) == 1
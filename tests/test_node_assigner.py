@@ -0,0 +1,254 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import node_assigner
+from device_database import DeviceDatabase
+from node_assigner import (NodeAssigner, STRATEGY_AP_ONLY, STRATEGY_AP_SITE, STRATEGY_CPU,
+                           STRATEGY_FLAT, STRATEGY_FULL)
+
+ROUTERS = [{'name': 'R1', 'site': 'S1'}, {'name': 'R2', 'site': 'S1'}]
+
+
+def _open(tmp_path, count=60):
+    db = DeviceDatabase(str(tmp_path / 'devices.db'))
+    db.open()
+    db.conn.executemany(
+        "INSERT INTO devices (code, circuit_id, device_id, ipv4, router, topology, "
+        "download_min_mbps, upload_min_mbps, download_max_mbps, upload_max_mbps, weight) "
+        "VALUES (?, ?, ?, ?, ?, ?, 1, 1, ?, ?, ?)",
+        [(f"D{i}", f"c{i}", f"d{i}", f"10.0.{i // 250}.{i % 250 + 1}", f"R{i % 2 + 1}",
+          f"ether{i % 3}", 10 + i % 7, 5 + i % 3, 15 + i % 7 + i % 3) for i in range(count)]
+    )
+    db.conn.commit()
+    return db
+
+
+@pytest.mark.parametrize("strategy, queues, limit", [
+    (STRATEGY_AP_ONLY, None, 0), (STRATEGY_AP_SITE, None, 0), (STRATEGY_CPU, 4, 0),
+    # Below the device count, so the TC budget splits nodes
+    (STRATEGY_AP_ONLY, None, 20), (STRATEGY_AP_SITE, None, 20),
+])
+def test_repeat_assign_writes_nothing(tmp_path, strategy, queues, limit):
+    db = _open(tmp_path)
+    assigner = NodeAssigner(str(tmp_path / 'network.json'))
+    assigner.TC_U16_NODE_LIMIT = limit
+    assigner.assign(db.conn, strategy, ROUTERS, queues, False)
+    assert db.conn.execute("SELECT COUNT(*) FROM devices WHERE parent_node = ''").fetchone()[0] == 0
+
+    db.conn.execute("CREATE TEMP TABLE writes (code TEXT)")
+    db.conn.execute("CREATE TEMP TRIGGER count_writes AFTER UPDATE ON main.devices "
+                    "BEGIN INSERT INTO writes VALUES (new.code); END")
+    assigner.assign(db.conn, strategy, ROUTERS, queues, False)
+    assert db.conn.execute("SELECT COUNT(*) FROM writes").fetchone()[0] == 0
+    if limit:
+        assert db.conn.execute(
+            "SELECT MAX(n) FROM (SELECT COUNT(*) AS n FROM devices GROUP BY parent_node)"
+        ).fetchone()[0] <= limit
+
+
+def test_site_assign_moves_devices_to_their_leaf(tmp_path):
+    db = _open(tmp_path, count=6)
+    db.conn.execute("UPDATE devices SET parent_node = 'stale'")
+    assigner = NodeAssigner(str(tmp_path / 'network.json'))
+    assigner.assign(db.conn, STRATEGY_AP_SITE, ROUTERS, None, False)
+    assert dict(db.conn.execute("SELECT code, parent_node FROM devices")) == {
+        f"D{i}": f"R{i % 2 + 1}/ether{i % 3}" for i in range(6)
+    }
+
+
+TOPOLOGIES = [
+    ('R1', 'ether1/pppoe-a/pool1', 100), ('R1', 'ether1/pppoe-a/pool1', 50),
+    ('R1', 'ether1/pppoe-a/pool2', 20), ('R1', 'ether2//pool3', 10),
+    ('R1', None, 5), ('R2', 'vlan10/dhcp1/', 40), ('R2', None, 30),
+]
+
+
+def _open_topology(tmp_path):
+    db = DeviceDatabase(str(tmp_path / 'devices.db'))
+    db.open()
+    db.conn.executemany(
+        "INSERT INTO devices (code, circuit_id, device_id, router, topology, "
+        "download_min_mbps, upload_min_mbps, download_max_mbps, upload_max_mbps) "
+        "VALUES (?, ?, ?, ?, ?, 1, 1, ?, ?)",
+        [(f"D{i}", f"c{i}", f"d{i}", router, topology, dl, 1)
+         for i, (router, topology, dl) in enumerate(TOPOLOGIES)]
+    )
+    db.conn.commit()
+    return db
+
+
+def _shape(tree):
+    """network.json reduced to {name: (download, type, children)}."""
+    return {name: (node["downloadBandwidthMbps"], node["type"], _shape(node["children"]))
+            for name, node in tree.items()}
+
+
+@pytest.mark.parametrize("strategy, parents, tree", [
+    (STRATEGY_AP_SITE,
+     ['R1/ether1'] * 3 + ['R1/ether2', 'R1', 'R2/vlan10', 'R2'],
+     {'S1': (185, 'site', {'R1': (185, 'site', {
+          'R1/ether1': (170, 'ap', {}), 'R1/ether2': (10, 'ap', {})})}),
+      'R2': (70, 'site', {'R2/vlan10': (40, 'ap', {})})}),
+    (STRATEGY_FULL,
+     ['R1/ether1/pppoe-a/pool1'] * 2 + ['R1/ether1/pppoe-a/pool2', 'R1/ether2/pool3', 'R1',
+                                        'R2/vlan10/dhcp1', 'R2'],
+     {'S1': (185, 'site', {'R1': (185, 'site', {
+          'R1/ether1': (170, 'site', {'R1/ether1/pppoe-a': (170, 'site', {
+              'R1/ether1/pppoe-a/pool1': (150, 'ap', {}),
+              'R1/ether1/pppoe-a/pool2': (20, 'ap', {})})}),
+          'R1/ether2': (10, 'site', {'R1/ether2/pool3': (10, 'ap', {})})})}),
+      'R2': (70, 'site', {'R2/vlan10': (40, 'site', {'R2/vlan10/dhcp1': (40, 'ap', {})})})}),
+])
+def test_site_strategies_nest_discovered_paths(tmp_path, strategy, parents, tree):
+    db = _open_topology(tmp_path)
+    assigner = NodeAssigner(str(tmp_path / 'network.json'))
+    assigner.CAPACITY_FACTOR = 1.0
+    assigner.assign(db.conn, strategy, [{'name': 'R1', 'site': 'S1'}, {'name': 'R2'}], None, False)
+
+    # Empty path components are skipped; devices without a path stay on the router
+    assert [p for (p,) in db.conn.execute("SELECT parent_node FROM devices ORDER BY rowid")] == parents
+    assert _shape(assigner.read_network_json()) == tree
+
+
+def test_flat_clears_parent_nodes(tmp_path):
+    db = _open(tmp_path)
+    assigner = NodeAssigner(str(tmp_path / 'network.json'))
+    assigner.assign(db.conn, STRATEGY_AP_ONLY, ROUTERS, None, False)
+    assigner.assign(db.conn, STRATEGY_FLAT, ROUTERS, None, False)
+    assert {p for (p,) in db.conn.execute("SELECT parent_node FROM devices")} == {''}
+
+
+def test_tc_split_sizes_parts_with_direct_devices(tmp_path):
+    db = DeviceDatabase(str(tmp_path / 'devices.db'))
+    db.open()
+    parents = ['R1'] * 8 + ['R1/a'] * 12 + ['R1/b'] * 4
+    db.conn.executemany(
+        "INSERT INTO devices (code, circuit_id, device_id, parent_node, "
+        "download_min_mbps, upload_min_mbps, download_max_mbps, upload_max_mbps) "
+        "VALUES (?, ?, ?, ?, 1, 1, 100, 10)",
+        [(f"D{i}", f"c{i}", f"d{i}", parent) for i, parent in enumerate(parents)]
+    )
+    assigner = NodeAssigner(str(tmp_path / 'network.json'))
+    assigner.TC_U16_NODE_LIMIT = 15
+    assigner.CAPACITY_FACTOR = 1.0
+    config = {"R1": assigner._node_entry(2400, 240, "site")}
+    config["R1"]["children"] = {
+        "R1/a": assigner._node_entry(1200, 120, "ap"),
+        "R1/b": assigner._node_entry(400, 40, "ap"),
+    }
+
+    assigner._stage_node_map(db.conn)
+    split = assigner._fit_tc_budget(db.conn, config)
+    assigner._apply_node_map(db.conn)
+
+    assert sorted(split) == ["R1-1", "R1-2"]
+    nested = [c for part in split.values() for c in part["children"]]
+    assert sorted(nested) == ["R1/a", "R1/b"]
+    holder = db.conn.execute(
+        "SELECT DISTINCT parent_node FROM devices WHERE code IN ('D0', 'D7')"
+    ).fetchall()
+    assert len(holder) == 1
+    part = split[holder[0][0]]
+    children_dl = sum(c["downloadBandwidthMbps"] for c in part["children"].values())
+    assert part["downloadBandwidthMbps"] == children_dl + 800
+    assert sum(p["downloadBandwidthMbps"] for p in split.values()) == 2400
+
+
+def _record_usage(db, samples):
+    db.conn.executemany(
+        "INSERT INTO node_usage (node, sample_time, dl_mbps, ul_mbps) VALUES (?, ?, ?, ?)", samples
+    )
+    db.conn.commit()
+
+
+def test_percentile_model_sizes_nodes_on_concurrent_subtree_usage(tmp_path):
+    db = _open(tmp_path, count=0)
+    # Leaves a and b peak at different times; their parent sees the sum per sample
+    _record_usage(db, [(leaf, t, dl, dl / 10)
+                       for t in range(20)
+                       for leaf, dl in (("R1/a", 10 + t), ("R1/b", 50 - t))])
+    assigner = NodeAssigner(str(tmp_path / 'network.json'))
+    assigner.CAPACITY_MODEL, assigner.USAGE_ENABLED = 'percentile', True
+    assigner.CAPACITY_PERCENTILE, assigner.CAPACITY_HEADROOM = 95, 1.0
+    assigner.CAPACITY_MIN_SAMPLES, assigner.CAPACITY_WINDOW = 5, 3600
+    config = {"R1": assigner._node_entry(1000, 1000, "site")}
+    config["R1"]["children"] = {
+        "R1/a": assigner._node_entry(1000, 1000, "ap"),
+        "R1/b": assigner._node_entry(1000, 1000, "ap"),
+    }
+
+    assigner._apply_capacity_model(db.conn, config)
+
+    children = config["R1"]["children"]
+    assert children["R1/a"]["downloadBandwidthMbps"] == 28       # 19th of 10..29
+    assert children["R1/b"]["downloadBandwidthMbps"] == 49       # 19th of 31..50
+    assert config["R1"]["downloadBandwidthMbps"] == 60          # a + b is 60 at every sample
+    assert config["R1"]["uploadBandwidthMbps"] == 6
+
+
+def test_percentile_model_without_usage_recording_keeps_fixed_sizes(tmp_path, caplog):
+    db = _open(tmp_path, count=0)
+    _record_usage(db, [("R1", t, 5, 5) for t in range(20)])
+    assigner = NodeAssigner(str(tmp_path / 'network.json'))
+    assigner.CAPACITY_MODEL, assigner.USAGE_ENABLED, assigner.CAPACITY_MIN_SAMPLES = 'percentile', False, 5
+    config = {"R1": assigner._node_entry(1000, 1000, "site")}
+    fixed = dict(config["R1"])
+
+    assigner._apply_capacity_model(db.conn, config)
+
+    assert config["R1"] == fixed
+    assert "needs usage.enabled" in caplog.text
+
+
+def _bin_loads(vectors, placement, bins):
+    loads = [[0] * len(vectors[0]) for _ in range(bins)]
+    for v, b in zip(vectors, placement):
+        for d, x in enumerate(v):
+            loads[b][d] += x
+    return loads
+
+
+def test_refinement_lowers_the_greedy_peak():
+    vectors = [(3,), (3,), (2,), (2,), (2,)]
+    greedy = NodeAssigner._balance_vectors(vectors, 2)
+    refined = NodeAssigner._balance_vectors(vectors, 2, time_budget=5.0)
+
+    assert max(_bin_loads(vectors, greedy, 2)) == [7]
+    assert sorted(_bin_loads(vectors, refined, 2)) == [[6], [6]]
+
+
+def test_refinement_stops_at_its_time_budget(monkeypatch):
+    # No move or swap helps, so refinement only ends on the deadline
+    vectors = [(3, 1, 1)] * 20000 + [(1, 3, 1)] * 20001
+    calls = []
+
+    def monotonic():
+        calls.append(time.perf_counter())
+        return calls[-1]
+
+    monkeypatch.setattr(node_assigner, "time", SimpleNamespace(monotonic=monotonic))
+    NodeAssigner._balance_vectors(vectors, 2, time_budget=0.001)
+
+    deadline = calls[0] + 0.001
+    assert calls[-1] - deadline < 0.02
+
+
+@pytest.mark.parametrize("threshold", [float('inf'), 0], ids=["heap", "numpy"])
+def test_cpu_placement_is_balanced_on_both_paths(tmp_path, threshold):
+    if threshold == 0 and not node_assigner.HAS_NUMPY:
+        pytest.skip("numpy is not installed")
+    db = _open(tmp_path, count=2000)
+    assigner = NodeAssigner(str(tmp_path / 'network.json'))
+    assigner.CPU_VECTORIZED_THRESHOLD = threshold
+    assigner.CPU_REFINE_TIME_BUDGET = 0.0
+
+    assigner.assign(db.conn, STRATEGY_CPU, ROUTERS, 8, False)
+
+    totals = {node: (dl, ul, n) for node, dl, ul, n in db.conn.execute(
+        "SELECT parent_node, SUM(download_max_mbps), SUM(upload_max_mbps), COUNT(*) "
+        "FROM devices GROUP BY parent_node"
+    )}
+    assert len(totals) == 8 and sum(n for _, _, n in totals.values()) == 2000
+    assert NodeAssigner.check_distribution_skew(totals, label="CPU") < 1.1
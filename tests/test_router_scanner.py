@@ -0,0 +1,79 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("routeros_api")
+
+from router_scanner import RouterScanner
+
+RESOURCES = {
+    '/interface/pppoe-server': [
+        {'user': 'alice', 'service': 'pppoe-a'},
+        {'user': 'bob', 'service': 'pppoe/b'},
+    ],
+    '/interface/pppoe-server/server': [
+        {'service-name': 'pppoe-a', 'interface': 'vlan100'},
+        {'service-name': 'pppoe/b', 'interface': 'vlan200'},
+    ],
+    '/ip/hotspot': [{'name': 'hs1', 'interface': 'wlan1', 'address-pool': 'hs-pool'}],
+    '/ip/dhcp-server': [
+        {'name': 'dhcp1', 'interface': 'bridge1', 'address-pool': 'none'},
+        {'name': 'dhcp2', 'interface': 'ether5', 'address-pool': 'dhcp2-pool'},
+    ],
+    '/ip/pool': [
+        {'name': 'ppp-pool', 'ranges': '100.64.0.2-100.64.0.254,100.64.1.0/24'},
+        {'name': 'lan-pool', 'ranges': '192.168.88.10-192.168.88.20'},
+        {'name': 'broken', 'ranges': 'garbage,10.9.9.9'},
+    ],
+}
+
+
+class _Api:
+    def get_resource(self, path):
+        return SimpleNamespace(get=lambda: RESOURCES[path])
+
+
+def test_parse_pools_and_lookup():
+    pools = RouterScanner._parse_pools(RESOURCES['/ip/pool'])
+
+    assert pools == [
+        (0x64400002, 0x644000FE, 'ppp-pool'), (0x64400100, 0x644001FF, 'ppp-pool'),
+        (0xC0A8580A, 0xC0A85814, 'lan-pool'), (0x0A090909, 0x0A090909, 'broken'),
+    ]
+    assert RouterScanner._pool_for(pools, '100.64.1.255') == 'ppp-pool'
+    assert RouterScanner._pool_for(pools, '100.64.0.1') == ''
+    assert RouterScanner._pool_for(pools, '10.9.9.9') == 'broken'
+    assert RouterScanner._pool_for(pools, '') == ''
+
+
+def test_collect_topology_resolves_access_paths():
+    stored = {}
+    scanner = RouterScanner(SimpleNamespace(update_topology=lambda paths: stored.update(paths) or True))
+    scanner._access = {
+        'PPP-alice': ('pppoe', 'alice', '100.64.0.7'),
+        'PPP-bob':   ('pppoe', 'bob', '100.64.1.9'),
+        'PPP-carol': ('pppoe', 'carol', '100.64.0.8'),   # no server binding
+        'HS-dave':   ('hotspot', 'hs1', '10.5.0.3'),     # outside every pool
+        'DHCP-eve':  ('dhcp', 'dhcp1', '192.168.88.15'),
+        'DHCP-finn': ('dhcp', 'dhcp1', '192.168.88.99'), # server pool is 'none'
+        'DHCP-gus':  ('dhcp', 'dhcp2', ''),
+    }
+
+    assert scanner._collect_topology(_Api(), {'name': 'R1'})
+
+    # '/' inside a component is replaced so the path keeps three levels
+    assert stored == {
+        'PPP-alice': 'vlan100/pppoe-a/ppp-pool',
+        'PPP-bob':   'vlan200/pppoe-b/ppp-pool',
+        'PPP-carol': '//ppp-pool',
+        'HS-dave':   'wlan1/hs1/hs-pool',
+        'DHCP-eve':  'bridge1/dhcp1/lan-pool',
+        'DHCP-finn': 'bridge1/dhcp1/',
+        'DHCP-gus':  'ether5/dhcp2/dhcp2-pool',
+    }
+
+
+def test_collect_topology_skips_without_sessions():
+    scanner = RouterScanner(SimpleNamespace(update_topology=pytest.fail))
+
+    assert not scanner._collect_topology(_Api(), {'name': 'R1'})
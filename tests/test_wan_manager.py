@@ -0,0 +1,511 @@
+import threading
+from collections import Counter
+from types import SimpleNamespace
+
+import pytest
+
+import wan_manager
+from device_database import DeviceDatabase
+from wan_manager import UNMANAGED_ENTRY, WANManager
+
+CORE = {'name': 'C1', 'address': '192.0.2.1', 'wans': [{'address_list': 'WAN1'}, {'address_list': 'WAN2'}]}
+
+
+def _open(tmp_path):
+    db = DeviceDatabase(str(tmp_path / 'devices.db'))
+    db.open()
+    return db
+
+
+def _add(db, code, ipv4, wan_name):
+    db.conn.execute(
+        "INSERT INTO devices (code, circuit_id, device_id, ipv4, core_name, wan_name, "
+        "download_min_mbps, upload_min_mbps, download_max_mbps, upload_max_mbps) "
+        "VALUES (?, ?, ?, ?, 'C1', ?, 1, 1, 10, 10)",
+        (code, f"c-{code}", f"d-{code}", ipv4, wan_name)
+    )
+
+
+def test_incremental_target_survives_address_handover(tmp_path):
+    db = _open(tmp_path)
+    _add(db, 'A', '10.0.0.1', 'WAN1')
+    _add(db, 'B', '10.0.0.3', 'WAN1')
+    db.conn.commit()
+    manager = WANManager(connect_fn=None)
+    manager._refresh_targets(db.conn)
+
+    # B is journaled first (comment), then A leaves .1 and B takes it
+    db.conn.execute("UPDATE devices SET comment = 'edited' WHERE code = 'B'")
+    db.conn.execute("UPDATE devices SET ipv4 = '10.0.0.2' WHERE code = 'A'")
+    db.conn.execute("UPDATE devices SET ipv4 = '10.0.0.1' WHERE code = 'B'")
+    db.conn.commit()
+    manager._refresh_targets(db.conn)
+
+    expected = manager._build_target_subnets(db.conn, CORE)
+    assert ('WAN1', '10.0.0.1/32') in expected
+    assert manager._current_target(db.conn, CORE) == expected
+
+
+def test_incremental_target_matches_full_rebuild(tmp_path):
+    db = _open(tmp_path)
+    for i in range(64):
+        _add(db, f"D{i}", f"10.0.1.{i}", f"WAN{i % 2 + 1}")
+    db.conn.commit()
+    manager = WANManager(connect_fn=None)
+    manager._refresh_targets(db.conn)
+
+    # Swap every pair's addresses through a spare one, and move a few WANs
+    for i in range(0, 64, 2):
+        db.conn.execute("UPDATE devices SET ipv4 = '10.0.9.9' WHERE code = ?", (f"D{i}",))
+        db.conn.execute("UPDATE devices SET ipv4 = ? WHERE code = ?", (f"10.0.1.{i}", f"D{i + 1}"))
+        db.conn.execute("UPDATE devices SET ipv4 = ? WHERE code = ?", (f"10.0.1.{i + 1}", f"D{i}"))
+    db.conn.execute("UPDATE devices SET wan_name = 'WAN2' WHERE code IN ('D4', 'D10')")
+    db.conn.execute("DELETE FROM devices WHERE code = 'D7'")
+    db.conn.commit()
+    manager._refresh_targets(db.conn)
+
+    assert manager._current_target(db.conn, CORE) == manager._build_target_subnets(db.conn, CORE)
+
+
+def test_devices_on_removed_wan_are_reassigned(tmp_path):
+    db = _open(tmp_path)
+    for i in range(30):
+        _add(db, f"D{i}", f"10.0.2.{i}", '')
+    db.conn.commit()
+    three = dict(CORE, wans=CORE['wans'] + [{'address_list': 'WAN3'}])
+    for mode in ('device', 'hash'):
+        manager = WANManager(connect_fn=None)
+        manager.assign_wan_nodes(db.conn, [three], {'mode': mode, 'include_dhcp': True})
+        assert db.conn.execute("SELECT COUNT(*) FROM devices WHERE wan_name = 'WAN3'").fetchone()[0]
+
+        manager.assign_wan_nodes(db.conn, [CORE], {'mode': mode, 'include_dhcp': True})
+        assert {w for (w,) in db.conn.execute("SELECT DISTINCT wan_name FROM devices")} == {'WAN1', 'WAN2'}
+
+
+class _Promise:
+    def __init__(self, value=None, error=None):
+        self.value, self.error = value, error
+
+    def get(self):
+        if self.error:
+            raise self.error
+        return self.value
+
+
+class _AddressList:
+    """Just enough of a routeros_api address-list resource for _apply_changes."""
+
+    def __init__(self, entries):
+        # {id: {'list', 'address', 'comment'}}
+        self.entries = dict(entries)
+        self.queries = []
+
+    def add_async(self, **kwargs):
+        address = kwargs['address']
+        address = address[:-3] if address.endswith('/32') else address
+        for entry in self.entries.values():
+            if (entry['list'], entry['address']) == (kwargs['list'], address):
+                return _Promise(error=Exception("failure: already have such entry"))
+        entry_id = f"*{len(self.entries) + 1:X}"
+        self.entries[entry_id] = {'list': kwargs['list'], 'address': address, 'comment': kwargs['comment']}
+        return _Promise(entry_id)
+
+    def remove_async(self, id):
+        del self.entries[id]
+        return _Promise()
+
+    def call_async(self, command, arguments, queries):
+        self.queries.append((arguments, queries))
+        rows = [dict(entry, id=entry_id) for entry_id, entry in self.entries.items()
+                if all(dict(entry, id=entry_id).get(k) == v for k, v in queries.items())]
+        if 'count-only' in arguments:
+            return _Promise(SimpleNamespace(done_message={'ret': str(len(rows))}))
+        return _Promise(rows)
+
+    def call(self, command, arguments, queries):
+        return self.call_async(command, arguments, queries).get()
+
+
+class _Api:
+    def __init__(self, resource):
+        self.resource = resource
+
+    def get_resource(self, path):
+        return self.resource
+
+
+def test_existing_unmanaged_entry_satisfies_add_and_survives_removal():
+    resource = _AddressList({'*1': {'list': 'WAN1', 'address': '10.0.0.1', 'comment': 'by hand'}})
+    manager = WANManager(connect_fn=None)
+    cache = manager._cache[CORE['address']] = {}
+    key = ('WAN1', '10.0.0.1/32')
+
+    added, removed, errors = manager._apply_changes(
+        resource, CORE, cache, {key, ('WAN1', '10.0.0.2/32')}, set()
+    )
+    assert (added, removed, errors) == (1, 0, [])
+    assert cache[key] == UNMANAGED_ENTRY
+    assert resource.entries['*1']['comment'] == 'by hand'
+
+    # The rebuilt cache still holds it, so the next sync adds nothing
+    cache = manager._cache[CORE['address']] = manager._build_wan_cache(_Api(resource), CORE)
+    assert cache[key] == UNMANAGED_ENTRY and len(cache) == 2
+
+    # The device leaves the WAN: the key is dropped, the operator's entry stays
+    added, removed, errors = manager._apply_changes(resource, CORE, cache, set(), {key})
+    assert (added, removed, errors) == (0, 0, [])
+    assert key not in cache
+    assert resource.entries['*1'] == {'list': 'WAN1', 'address': '10.0.0.1', 'comment': 'by hand'}
+
+
+def test_overrunning_core_is_skipped_until_its_worker_finishes():
+    release, calls = threading.Event(), []
+
+    def worker(core, arg, deadline):
+        calls.append(arg)
+        if arg == 'slow':
+            release.wait(30)
+        return {"core": core['name'], "added": 0, "removed": 0, "error": ""}
+
+    manager = WANManager(connect_fn=None)
+    manager.WAN_CORE_SYNC_DEADLINE = 0.05
+    assert manager._run_cores([(CORE, 'slow')], worker)['C1']['error'] == "deadline exceeded"
+
+    assert manager._run_cores([(CORE, 'again')], worker)['C1']['error'] == "previous sync still running"
+    assert calls == ['slow']
+
+    release.set()
+    manager._inflight[CORE['address']].result(timeout=5)
+    assert manager._run_cores([(CORE, 'again')], worker)['C1']['error'] == ""
+    assert calls == ['slow', 'again']
+
+
+class _Interfaces:
+    def __init__(self, counters):
+        self.counters = counters
+
+    def call(self, command, arguments):
+        return [{'name': name, 'rx-byte': str(rx), 'tx-byte': str(tx)}
+                for name, (rx, tx) in self.counters.items()]
+
+
+class _Pool:
+    def __init__(self, counters):
+        self.counters, self.connected = counters, True
+
+    def get_api(self):
+        return self
+
+    def get_resource(self, path):
+        return _Interfaces(self.counters)
+
+    def disconnect(self):
+        self.connected = False
+
+
+def test_traffic_poll_disconnects_and_skips_unreachable_cores(tmp_path):
+    db = _open(tmp_path)
+    cores = [dict(CORE, wans=[{'address_list': 'WAN1', 'interface': 'ether1'}]),
+             {'name': 'C2', 'address': '192.0.2.2', 'wans': [{'address_list': 'WAN1', 'interface': 'ether1'}]}]
+    pools = []
+
+    def connect(core):
+        if core['name'] == 'C2':
+            return None
+        pools.append(_Pool({'ether1': (1_000_000 * len(pools), 500_000 * len(pools))}))
+        return pools[-1]
+
+    manager = WANManager(connect)
+    manager.poll_wan_traffic(db.conn, cores, sample_time=1000)
+    rates = manager.poll_wan_traffic(db.conn, cores, sample_time=1008)
+
+    assert rates == {('C1', 'WAN1'): (1.0, 0.5)}
+    assert len(pools) == 2 and not any(pool.connected for pool in pools)
+
+
+def test_subnet_block_is_listed_whole_only_when_fully_owned(tmp_path):
+    db = _open(tmp_path)
+    for i in range(1, 7):
+        _add(db, f"D{i}", f"10.0.3.{i}", 'WAN1')        # every host of 10.0.3.0/29
+    for i in (9, 10):
+        _add(db, f"E{i}", f"10.0.3.{i}", 'WAN1')        # two of the six hosts of 10.0.3.8/29
+    db.conn.commit()
+    manager = WANManager(connect_fn=None)
+    partial = {('WAN1', '10.0.3.9/32'), ('WAN1', '10.0.3.10/32')}
+
+    target = manager._build_target_subnets(db.conn, CORE, {'mode': 'subnet', 'subnet_prefix': 29})
+    assert target == {('WAN1', '10.0.3.0/29')} | partial
+
+    # whole_blocks: the known devices alone decide, steering the unknown hosts too
+    target = manager._build_target_subnets(
+        db.conn, CORE, {'mode': 'subnet', 'subnet_prefix': 29, 'whole_blocks': True}
+    )
+    assert target == {('WAN1', '10.0.3.0/28')}
+
+    # An unassigned (e.g. excluded) device keeps its block from being whole either way
+    _add(db, 'X', '10.0.3.12', '')
+    db.conn.commit()
+    target = manager._build_target_subnets(
+        db.conn, CORE, {'mode': 'subnet', 'subnet_prefix': 29, 'whole_blocks': True}
+    )
+    assert target == {('WAN1', '10.0.3.0/29')} | partial
+
+
+def test_lossy_aggregation_lists_minority_addresses_as_exceptions(tmp_path):
+    db = _open(tmp_path)
+    three = dict(CORE, wans=CORE['wans'] + [{'address_list': 'WAN3'}])
+    for i in range(250):                                  # 10.0.4.0/24: 230 / 16 / 4 of 256
+        _add(db, f"A{i}", f"10.0.4.{i}", 'WAN1' if i < 230 else 'WAN2' if i < 246 else 'WAN3')
+    for i in range(256):                                  # 10.0.5.0/24: all WAN2 but .200
+        if i != 200:
+            _add(db, f"B{i}", f"10.0.5.{i}", 'WAN2')
+    db.conn.execute(
+        "INSERT INTO devices (code, circuit_id, device_id, ipv4, core_name, wan_name, "
+        "download_min_mbps, upload_min_mbps, download_max_mbps, upload_max_mbps) "
+        "VALUES ('Y', 'c-Y', 'd-Y', '10.0.5.200', 'C2', 'WAN1', 1, 1, 10, 10)"
+    )
+    for i in range(0, 256, 2):                            # 10.0.6.0/24: half full
+        _add(db, f"C{i}", f"10.0.6.{i}", 'WAN3')
+    db.conn.commit()
+    manager = WANManager(connect_fn=None)
+    sources = {'aggregate_fill_ratio': 0.75, 'aggregate_min_prefix': 16}
+
+    target = manager._build_target_subnets(db.conn, three, sources)
+
+    def listed(name, prefix):
+        return {subnet for wan, subnet in target if wan == name and subnet.startswith(prefix)}
+
+    assert listed('WAN1', '10.0.4.') == {'10.0.4.0/24'}
+    assert listed('WAN2-except', '') == {'10.0.4.230/31', '10.0.4.232/29', '10.0.4.240/30', '10.0.4.244/31'}
+    assert listed('WAN3-except', '') == {'10.0.4.246/31', '10.0.4.248/31'}
+    # The other core's device blocks every supernet containing it; the lone
+    # neighbour left over is listed on its own
+    assert listed('WAN2', '10.0.5.') == {
+        '10.0.5.0/25', '10.0.5.128/26', '10.0.5.224/27', '10.0.5.208/28',
+        '10.0.5.192/29', '10.0.5.204/30', '10.0.5.202/31', '10.0.5.201/32',
+    }
+    assert listed('WAN3', '10.0.6.') == {f"10.0.6.{i}/32" for i in range(0, 256, 2)}
+    assert {wan for wan, _ in target} == {'WAN1', 'WAN2', 'WAN3', 'WAN2-except', 'WAN3-except'}
+
+    # Without the lossy ratio nothing is listed as an exception
+    exact = manager._build_target_subnets(db.conn, three)
+    assert {wan for wan, _ in exact} == {'WAN1', 'WAN2', 'WAN3'}
+    assert ('WAN2', '10.0.4.232/29') in exact
+
+
+def test_lossy_aggregation_prefers_the_largest_supernet():
+    owned = {(10 << 24) + i: 'WAN1' for i in range(0, 1024) if i % 64}     # 10.0.0.0/22, 1 in 64 missing
+    owned[(10 << 24) + 1024 + 4] = 'WAN1'
+    owned[(10 << 24) + 1024 + 5] = 'WAN1'
+
+    supernets, exceptions, remaining = WANManager._aggregate_lossy(owned, set(), 0.9, 20)
+
+    assert supernets == {'WAN1': ['10.0.0.0/22', '10.0.4.4/31']}
+    assert exceptions == {}
+    assert remaining == {}
+
+    # A blocked address inside it falls back to the largest blocks around it
+    supernets, exceptions, remaining = WANManager._aggregate_lossy(owned, {(10 << 24) + 512}, 0.9, 20)
+    assert supernets['WAN1'] == [
+        '10.0.0.0/23', '10.0.3.0/24', '10.0.2.128/25', '10.0.2.64/26', '10.0.2.32/27',
+        '10.0.2.16/28', '10.0.2.8/29', '10.0.2.4/30', '10.0.2.2/31', '10.0.4.4/31',
+    ]
+    assert remaining == {(10 << 24) + 513: 'WAN1'}
+
+
+class _RecordingList(_AddressList):
+    """_AddressList that logs when each command is sent and read, and fails some."""
+
+    def __init__(self, entries, fail_send=(), fail_reply=()):
+        super().__init__(entries)
+        self.log, self.fail_send, self.fail_reply = [], set(fail_send), set(fail_reply)
+
+    def _track(self, what, promise):
+        self.log.append(('send', what))
+        if what in self.fail_send:
+            raise ConnectionError(f"send {what}")
+        if what in self.fail_reply:
+            promise = _Promise(error=Exception(f"failure: no such item {what}"))
+
+        log = self.log
+
+        class _Tracked:
+            def get(self):
+                log.append(('read', what))
+                return promise.get()
+        return _Tracked()
+
+    def add_async(self, **kwargs):
+        return self._track(kwargs['address'], super().add_async(**kwargs))
+
+    def remove_async(self, id):
+        return self._track(id, super().remove_async(id))
+
+
+def test_changes_are_pipelined_in_batches_and_failures_collected(caplog):
+    old = {f"*{i + 1:X}": {'list': 'WAN1', 'address': f"10.0.0.{i}", 'comment': 'libreqos-managed'}
+           for i in range(5)}
+    resource = _RecordingList(old, fail_send={'*2', '10.0.1.3/32'}, fail_reply={'*4', '10.0.1.1/32'})
+    manager = WANManager(connect_fn=None)
+    manager.WAN_SYNC_BATCH_SIZE = 3
+    cache = {('WAN1', f"10.0.0.{i}/32"): f"*{i + 1:X}" for i in range(5)}
+    to_add = {('WAN2', f"10.0.1.{i}/32") for i in range(7)}
+
+    added, removed, errors = manager._apply_changes(resource, CORE, cache, to_add, set(cache))
+
+    # Removes before adds; each batch is sent in full before any reply is read
+    assert [kind for kind, _ in resource.log] == (
+        ['send'] * 3 + ['read'] * 2 + ['send'] * 2 + ['read'] * 2
+        + ['send'] * 3 + ['read'] * 3 + ['send'] * 3 + ['read'] * 2 + ['send'] + ['read']
+    )
+    assert [what for kind, what in resource.log if kind == 'send'] == (
+        ['*1', '*2', '*3', '*4', '*5'] + [f"10.0.1.{i}/32" for i in range(7)]
+    )
+    assert (added, removed) == (5, 3)
+    assert errors == [
+        "remove 10.0.0.1/32 (WAN1): send *2",
+        "remove 10.0.0.3/32 (WAN1): failure: no such item *4",
+        "add 10.0.1.1/32 (WAN2): failure: no such item 10.0.1.1/32",
+        "add 10.0.1.3/32 (WAN2): send 10.0.1.3/32",
+    ]
+    # A remove that was never sent stays cached; refused removes and failed adds are dropped
+    assert cache[('WAN1', '10.0.0.1/32')] == '*2'
+    assert set(cache) == {('WAN1', '10.0.0.1/32')} | {
+        key for key in to_add if key[1] not in ('10.0.1.1/32', '10.0.1.3/32')
+    }
+    assert len([r for r in caplog.records if "failed in batch" in r.getMessage()]) == 4
+
+
+def test_changes_stop_at_the_deadline(monkeypatch):
+    resource = _RecordingList({})
+    manager = WANManager(connect_fn=None)
+    manager.WAN_SYNC_BATCH_SIZE = 2
+    clock = iter([0, 0, 5])
+    monkeypatch.setattr(wan_manager.time, "monotonic", lambda: next(clock))
+    cache = {}
+
+    added, removed, errors = manager._apply_changes(
+        resource, CORE, cache, {('WAN1', f"10.0.0.{i}/32") for i in range(5)}, set(), deadline=1
+    )
+
+    assert (added, removed) == (4, 0)
+    assert errors == ["deadline exceeded: 1 add command(s) not sent"]
+    assert len(cache) == 4
+
+
+def _managed(count, list_name='WAN1'):
+    return {f"*{i + 1:X}": {'list': list_name, 'address': f"10.0.0.{i}", 'comment': 'libreqos-managed'}
+            for i in range(count)}
+
+
+def _connect_to(resource):
+    return lambda core: SimpleNamespace(get_api=lambda: _Api(resource), disconnect=lambda: None)
+
+
+def test_fresh_persisted_cache_is_adopted():
+    resource = _AddressList(dict(_managed(40), **{
+        '*99': {'list': 'WAN2', 'address': '10.0.9.9', 'comment': 'by hand'},
+    }))
+    manager = WANManager(_connect_to(resource))
+    manager.WAN_CACHE_SAMPLE_SIZE = 8
+    cache = {('WAN1', f"10.0.0.{i}/32"): f"*{i + 1:X}" for i in range(40)}
+    cache[('WAN2', '10.0.9.9/32')] = UNMANAGED_ENTRY
+
+    assert manager._validate_cache(CORE, dict(cache))["error"] == ""
+
+    assert manager._cache[CORE['address']] == cache
+    counted = {q['list'] for args, q in resource.queries if 'count-only' in args}
+    sampled = [q['id'] for args, q in resource.queries if 'id' in q]
+    assert counted == {'WAN1', 'WAN2'}
+    # The unmanaged marker is neither counted for WAN2 nor sampled
+    assert len(sampled) == 8 and UNMANAGED_ENTRY not in sampled
+
+
+@pytest.mark.parametrize("change", [
+    lambda entries: entries.pop('*7'),                                        # entry removed
+    lambda entries: entries.update({'*50': dict(entries['*1'], address='10.0.5.5')}),  # one too many
+    lambda entries: entries['*3'].update(address='10.0.3.3'),                 # same id, other address
+    lambda entries: entries['*3'].update(list='WAN2'),                        # moved to another list
+])
+def test_stale_persisted_cache_is_dropped(change):
+    resource = _AddressList(_managed(10))
+    change(resource.entries)
+    manager = WANManager(_connect_to(resource))
+    manager.WAN_CACHE_SAMPLE_SIZE = 10
+    cache = {('WAN1', f"10.0.0.{i}/32"): f"*{i + 1:X}" for i in range(10)}
+
+    assert manager._validate_cache(CORE, cache)["error"] == ""
+
+    assert CORE['address'] not in manager._cache
+
+
+def test_cache_validation_reports_unreachable_core():
+    manager = WANManager(lambda core: None)
+
+    assert manager._validate_cache(CORE, {('WAN1', '10.0.0.1/32'): '*1'})["error"] == "connection failed"
+    assert CORE['address'] not in manager._cache
+
+
+def _placement(db):
+    return dict(db.conn.execute("SELECT code, wan_name FROM devices"))
+
+
+def test_hash_placement_is_capacity_proportional_and_moves_minimally(tmp_path):
+    db = _open(tmp_path)
+    for i in range(6000):
+        _add(db, f"D{i}", None, '')
+    db.conn.commit()
+    wans = [{'address_list': f"WAN{n}", 'download_limit': 500 * n, 'upload_limit': 100 * n}
+            for n in (1, 2, 3)]
+    core = dict(CORE, wans=wans)
+    sources = {'mode': 'hash', 'include_dhcp': True}
+    manager = WANManager(connect_fn=None)
+
+    manager.assign_wan_nodes(db.conn, [core], sources)
+    before = _placement(db)
+    counts = Counter(before.values())
+    for n in (1, 2, 3):
+        assert abs(counts[f"WAN{n}"] / 6000 - n / 6) < 0.02, counts
+
+    # Stateless: a repeat cycle writes nothing
+    db.conn.execute("CREATE TEMP TABLE writes (code TEXT)")
+    db.conn.execute("CREATE TEMP TRIGGER count_writes AFTER UPDATE ON main.devices "
+                    "BEGIN INSERT INTO writes VALUES (new.code); END")
+    manager.assign_wan_nodes(db.conn, [core], sources)
+    assert db.conn.execute("SELECT COUNT(*) FROM writes").fetchone()[0] == 0
+
+    # A new WAN only takes its own share, and only from the others
+    grown = dict(core, wans=wans + [{'address_list': 'WAN4', 'download_limit': 2000, 'upload_limit': 400}])
+    manager.assign_wan_nodes(db.conn, [grown], sources)
+    after = _placement(db)
+    moved = {code for code in before if after[code] != before[code]}
+    assert {after[code] for code in moved} == {'WAN4'}
+    assert abs(len(moved) / 6000 - 4 / 10) < 0.02
+
+    # Removing a WAN moves only its devices, spread over the rest by capacity
+    manager.assign_wan_nodes(db.conn, [dict(core, wans=wans[1:])], sources)
+    final = _placement(db)
+    moved = {code for code in before if final[code] != before[code]}
+    assert moved == {code for code, wan in before.items() if wan == 'WAN1'}
+    share = Counter(final[code] for code in moved)
+    assert abs(share['WAN2'] / len(moved) - 2 / 5) < 0.06, share
+
+
+def test_shared_pools_are_released_and_only_disconnected_after_a_failure():
+    pool = _Pool({})
+    manager = WANManager(lambda core: pool, shared_pools=True)
+
+    with manager._session(CORE) as api:
+        assert api is pool
+    assert pool.connected
+
+    with pytest.raises(ConnectionError):
+        with manager._session(CORE):
+            raise ConnectionError("socket closed")
+    assert not pool.connected
+
+    # Owned pools are always disconnected
+    pool = _Pool({})
+    with WANManager(lambda core: pool)._session(CORE):
+        pass
+    assert not pool.connected
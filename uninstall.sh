@@ -45,7 +45,7 @@ log_delete "$SRC_DIR/wan_service.py"
 log_delete "$SRC_DIR/gui.py"
 
 # Python modules
-for module in rate_resolver.py device_database.py node_assigner.py router_scanner.py wan_manager.py; do
+for module in rate_resolver.py device_database.py node_assigner.py router_scanner.py wan_manager.py bulk_packer.py cpu_topology.py capacity_planner.py prefix_set.py; do
     log_delete "$SRC_DIR/$module"
 done
 
@@ -4,10 +4,11 @@ import os
 import subprocess
 import time
 
+from cpu_topology import CpuTopology
 from device_database import DeviceDatabase
-from node_assigner import NodeAssigner, STRATEGY_CPU, ALL_STRATEGIES
+from node_assigner import NodeAssigner, STRATEGY_CPU, STRATEGY_AP_SITE, STRATEGY_FULL, ALL_STRATEGIES
 from router_scanner import RouterScanner
-from settings import SCAN_INTERVAL, ERROR_RETRY_INTERVAL
+from settings import SCAN_INTERVAL, ERROR_RETRY_INTERVAL, USAGE_ENABLED, CAPACITY_WINDOW
 
 # ── Constants ─────────────────────────────────────────────────────────────────
 
@@ -15,6 +16,7 @@ CONFIG_JSON        = 'config.json'
 SHAPED_DEVICES_CSV = 'ShapedDevices.csv'
 NETWORK_JSON       = 'network.json'
 DB_FILE            = 'devices.db'
+LQOS_CONF          = '/etc/lqos.conf'
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -30,7 +32,7 @@ def read_config_json():
       1. Explicit 'strategy' key in config.json
       2. Legacy 'no_parent: true'  → STRATEGY_FLAT
       3. Legacy 'queues: false'    → no network.json (queues=None)
-      4. Default                   → STRATEGY_CPU with auto cpu_count
+      4. Default                   → STRATEGY_CPU with one queue per LibreQoS shaping core
     """
     try:
         with open(CONFIG_JSON, 'r') as f:
@@ -54,7 +56,7 @@ def read_config_json():
         if queues_raw is False:
             queues = None
         elif queues_raw is True:
-            queues = os.cpu_count() or 4
+            queues = len(CpuTopology.shaping_cores(LQOS_CONF)) or os.cpu_count() or 4
         else:
             queues = int(queues_raw)
 
@@ -93,7 +95,10 @@ def main():
     db.open()
 
     scanner  = RouterScanner(db)
-    assigner = NodeAssigner(NETWORK_JSON)
+    assigner = NodeAssigner(NETWORK_JSON, LQOS_CONF)
+    # Assignment inputs of the last assign() — a config change re-runs it
+    # even when no device changed
+    assigned_config = None
 
     while True:
         try:
@@ -101,6 +106,7 @@ def main():
 
             scan_time   = time.time()
             any_changes = False
+            scanner.discover_topology = strategy in (STRATEGY_AP_SITE, STRATEGY_FULL)
 
             for router in routers:
                 logger.info(f"Processing router: {router['name']} ({router['address']})")
@@ -109,14 +115,22 @@ def main():
 
             if db.remove_inactive(scan_time):
                 any_changes = True
+            db.prune_journal()
+
+            assign_config = (strategy, queues, promote_to_root,
+                             [(r['name'], r.get('site', '')) for r in routers])
+            if assign_config != assigned_config:
+                any_changes = True
 
             if any_changes:
                 db.backup_files()
                 db.check_tc_u16_overflow()
 
                 assigner.assign(db.conn, strategy, routers, queues, promote_to_root)
+                assigned_config = assign_config
 
                 db.export_to_csv()
+                db.publish_change()
 
                 try:
                     result = subprocess.run(
@@ -131,6 +145,10 @@ def main():
             else:
                 logger.info("No changes detected.")
 
+            # After assign, so usage is attributed to the nodes devices now sit on
+            if USAGE_ENABLED:
+                db.record_node_usage(scan_time, CAPACITY_WINDOW)
+
             logger.info(f"Scan complete. Next in {SCAN_INTERVAL}s.")
             time.sleep(SCAN_INTERVAL)
 
@@ -1,27 +1,119 @@
+import bisect
+import hashlib
 import heapq
 import ipaddress
 import logging
+import math
+import random
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
 
-from settings import WAN_REBALANCE_THRESHOLD
+from bulk_packer import BulkPacker, HAS_NUMPY
+from device_database import DeviceDatabase
+from prefix_set import PrefixSet
+from settings import (
+    WAN_REBALANCE_THRESHOLD, WAN_REBALANCE_LOW_MARK, WAN_REBALANCE_BUDGET, WAN_VECTORIZED_THRESHOLD,
+    WAN_SYNC_BATCH_SIZE, WAN_SYNC_WORKERS, WAN_CORE_SYNC_DEADLINE, WAN_CACHE_SAMPLE_SIZE,
+    WAN_TRAFFIC_HALF_LIFE, WAN_TRAFFIC_MIN_SAMPLES, WAN_TRAFFIC_MAX_AGE, USAGE_WEIGHTING,
+)
 
 logger = logging.getLogger(__name__)
 
+# Cache value for a target address already listed by an entry the sync did not
+# create ("already have such entry"): the target counts as met, the entry is
+# never re-commented or removed, and it is only forgotten when no longer wanted.
+UNMANAGED_ENTRY = 'unmanaged'
+
 
 class WANManager:
-    WAN_REBALANCE_THRESHOLD = WAN_REBALANCE_THRESHOLD
+    WAN_REBALANCE_THRESHOLD  = WAN_REBALANCE_THRESHOLD
+    WAN_REBALANCE_LOW_MARK   = WAN_REBALANCE_LOW_MARK
+    WAN_REBALANCE_BUDGET     = WAN_REBALANCE_BUDGET
+    WAN_VECTORIZED_THRESHOLD = WAN_VECTORIZED_THRESHOLD
+    WAN_SYNC_BATCH_SIZE      = WAN_SYNC_BATCH_SIZE
+    WAN_SYNC_WORKERS         = WAN_SYNC_WORKERS
+    WAN_CORE_SYNC_DEADLINE   = WAN_CORE_SYNC_DEADLINE
+    WAN_CACHE_SAMPLE_SIZE    = WAN_CACHE_SAMPLE_SIZE
+    WAN_TRAFFIC_HALF_LIFE    = WAN_TRAFFIC_HALF_LIFE
+    WAN_TRAFFIC_MIN_SAMPLES  = WAN_TRAFFIC_MIN_SAMPLES
+    WAN_TRAFFIC_MAX_AGE      = WAN_TRAFFIC_MAX_AGE
+    USAGE_WEIGHTING          = USAGE_WEIGHTING
 
-    def __init__(self, connect_fn):
-        # connect_fn is connect_to_router from updatecsv.py, injected to avoid circular imports
+    def __init__(self, connect_fn, shared_pools=False):
+        # connect_fn(core) returns a logged-in RouterOsApiPool or None (e.g.
+        # RouterScanner.connect_pool), injected to avoid circular imports; see _session
         self._connect = connect_fn
-        # Per-core cache: {core_address: {(list_name, ip): entry_id}}
+        # True when connect_fn hands out long-lived pools it owns (the GUI's
+        # per-core pools): sessions then release them instead of disconnecting
+        self._shared_pools = shared_pools
+        # Per-core cache: {core_address: {(list_name, ip): entry_id or UNMANAGED_ENTRY}}
         # Populated on first contact, updated incrementally — avoids re-fetching every cycle.
+        # Persisted in the wan_cache table; _restore_caches reloads it after a restart.
         self._cache: dict = {}
+        self._restored: set = set()
+        # Incremental phase-1 state (see _refresh_targets):
+        #   _placements {code: (core_name, wan_name, ipv4)} as last read from the DB
+        #   _targets    {(core_name, wan_name): PrefixSet} collapsed per WAN
+        #   _dirty      core names whose target changed since the last sync ('*' = all)
+        self._placements: dict = {}
+        self._targets: dict = {}
+        self._dirty: set = set()
+        self._target_opts = None
+        # Device journal version _placements reflects (None = rescan next time)
+        self._journal_version = None
+        # WANs being drained by _rebalance: entered above WAN_REBALANCE_THRESHOLD,
+        # left once back under WAN_REBALANCE_LOW_MARK
+        self._draining: set = set()
+        # {core_address: Future} of workers that overran their deadline and may
+        # still be writing to that core (see _run_cores)
+        self._inflight: dict = {}
+
+    @contextmanager
+    def _session(self, core):
+        """
+        The core's API for one operation, or None if it could not connect.
+        The pool from connect_fn is disconnected on exit, so no operation
+        leaves a connection open. A shared pool is only released, keeping its
+        login for the next operation, unless the operation raised — then it is
+        disconnected so the next one starts on a fresh connection.
+        """
+        pool = self._connect(core)
+        failed = True
+        try:
+            yield pool.get_api() if pool is not None else None
+            failed = False
+        finally:
+            if pool is not None and (failed or not self._shared_pools):
+                try:
+                    pool.disconnect()
+                except Exception as ex:
+                    logger.debug(f"Disconnect from {core['name']} failed: {ex}")
+
+    def is_rebalancing(self):
+        """True while any WAN is still being drained across cycles (see _rebalance)."""
+        return bool(self._draining)
 
     def assign_wan_nodes(self, conn, cores, wan_sources=None):
         """
         Assign only NEW (unassigned) devices to WANs using greedy bin-packing
-        weighted by WAN capacity. Existing assignments are never touched, so the
-        address lists on core routers only receive incremental adds/removes.
+        weighted by WAN capacity. Devices still on a WAN that has been removed
+        from the config count as unassigned. Existing assignments are only touched by the
+        budgeted rebalance of overloaded WANs (see _rebalance), so the address
+        lists on core routers only receive incremental adds/removes.
+        With weight_by_usage, loads are observed peak-hour usage instead of
+        plan rates (see DeviceDatabase.load_columns).
+
+        wan_sources['mode'] selects the placement unit: 'device' (default) or
+        'subnet', which keeps aligned /subnet_prefix blocks whole on one WAN
+        (see _pack_wans_by_subnet). With wan_sources['balance_by_traffic'],
+        WANs with a fresh interface measurement (see poll_wan_traffic) are
+        balanced on their measured load instead of plan sums (see
+        _apply_measured_load). 'hash' instead derives every device's WAN
+        from its code by capacity-weighted rendezvous hashing (see
+        _assign_by_hash), so adding or removing a WAN moves only that WAN's
+        proportional share of devices.
         Returns {(core_name, wan_name): (total_dl_mbps, total_ul_mbps)}.
         """
         wans = []
@@ -41,11 +133,13 @@ class WANManager:
             logger.info("No cores/WANs defined — skipping WAN assignment")
             return {}
 
+        load_dl, load_ul, load_weight = DeviceDatabase.load_columns(self.USAGE_WEIGHTING)
+
         # Seed each WAN's current load from the DB so new devices are balanced
         # against what is already assigned, not from zero.
         for w in wans:
             row = conn.execute(
-                "SELECT COALESCE(SUM(download_max_mbps),0), COALESCE(SUM(upload_max_mbps),0) "
+                f"SELECT COALESCE(SUM({load_dl}),0), COALESCE(SUM({load_ul}),0) "
                 "FROM devices WHERE core_name=? AND wan_name=?",
                 (w['core'], w['wan'])
             ).fetchone()
@@ -53,81 +147,472 @@ class WANManager:
 
         if wan_sources is None:
             wan_sources = {}
+        if wan_sources.get('balance_by_traffic', False):
+            self._apply_measured_load(conn, wans)
+        subnet_mode = wan_sources.get('mode', 'device') == 'subnet'
+        prefix      = int(wan_sources.get('subnet_prefix', 24))
+        excl_sql, excluded = self._source_exclusion(wan_sources)
+
+        if wan_sources.get('mode', 'device') == 'hash':
+            return self._assign_by_hash(conn, wans, excl_sql, excluded, (load_dl, load_ul))
+
+        # Only process devices that have not been assigned yet — or are still
+        # on a WAN that is no longer configured
+        known = [value for w in wans for value in (w['core'], w['wan'])]
+        new_devices = conn.execute(
+            f"SELECT rowid, {load_dl}, {load_ul}, ipv4 FROM devices "
+            "WHERE (core_name IS NULL OR core_name = '' OR wan_name IS NULL OR wan_name = '' "
+            f"OR (core_name, wan_name) NOT IN (VALUES {','.join(['(?, ?)'] * len(wans))}))"
+            + (f" AND {excl_sql}" if excl_sql else "") + f" ORDER BY {load_weight} DESC",
+            known + excluded
+        ).fetchall()
+
+        if not new_devices:
+            return self._rebalance(
+                conn, wans, excl_sql, excluded, (load_dl, load_ul), prefix if subnet_mode else None
+            )
+        owners = self._block_owners(conn, prefix) if subnet_mode else {}
+
+        if subnet_mode:
+            assignments = self._pack_wans_by_subnet(wans, new_devices, prefix, owners)
+        elif HAS_NUMPY and len(new_devices) >= self.WAN_VECTORIZED_THRESHOLD:
+            assignments = self._pack_wans_bulk(wans, [row[:3] for row in new_devices])
+        else:
+            assignments = self._pack_wans(wans, [row[:3] for row in new_devices])
+
+        conn.executemany(
+            "UPDATE devices SET core_name=?, wan_name=? WHERE rowid=?",
+            assignments
+        )
+        conn.commit()
+        logger.info(f"Assigned {len(new_devices)} new device(s) across {len(wans)} WAN(s)")
+
+        return {(w['core'], w['wan']): (w['used_dl'], w['used_ul']) for w in wans}
+
+    @staticmethod
+    def _source_exclusion(wan_sources):
+        """
+        Condition leaving out the device sources wan_sources does not include
+        (hotspot / dhcp unless include_*), as (sql, params) with no leading
+        WHERE / AND; ("", []) when every source is included.
+        """
         excluded = []
         if not wan_sources.get('include_hotspot', False):
             excluded.append('hotspot')
         if not wan_sources.get('include_dhcp', False):
             excluded.append('dhcp')
+        if not excluded:
+            return "", []
+        return f"(source NOT IN ({','.join('?' * len(excluded))}) OR source IS NULL)", excluded
 
-        excl_sql = ""
-        if excluded:
-            placeholders = ','.join('?' * len(excluded))
-            excl_sql = f" AND (source NOT IN ({placeholders}) OR source IS NULL)"
+    def _rebalance(self, conn, wans, excl_sql, excluded, load_cols, prefix=None):
+        """
+        Move load off overloaded WANs with as little churn as possible.
 
-        # Only process devices that have not been assigned yet
-        new_devices = conn.execute(
-            "SELECT code, download_max_mbps, upload_max_mbps FROM devices "
-            "WHERE (core_name IS NULL OR core_name = '' OR wan_name IS NULL OR wan_name = '')"
-            + excl_sql + " ORDER BY weight DESC",
+        A WAN starts draining when its utilisation exceeds
+        WAN_REBALANCE_THRESHOLD (high watermark) and keeps draining across
+        cycles until it is back under WAN_REBALANCE_LOW_MARK, so a WAN hovering
+        around one mark does not flip subscribers back and forth. Each cycle it
+        sheds the excess over the low watermark using the fewest units: the
+        smallest unit that covers the remaining excess if one exists, otherwise
+        the largest one below it. Units are devices, or whole aligned /prefix
+        blocks in subnet mode. Each goes to the least-utilised WAN that stays at
+        or under the low watermark with it. At most WAN_REBALANCE_BUDGET devices
+        move per cycle; the rest follow in later cycles.
+        Returns {(core_name, wan_name): (total_dl_mbps, total_ul_mbps)}.
+        """
+        _utilization = WANManager._utilization
+        load_dl, load_ul = load_cols
+        by_key = {(w['core'], w['wan']): w for w in wans}
+
+        self._draining &= set(by_key)
+        for key, w in by_key.items():
+            util = _utilization(w)
+            if util > self.WAN_REBALANCE_THRESHOLD and key not in self._draining:
+                logger.info(
+                    f"WAN {w['wan']} on {w['core']} utilization {util:.0%} exceeds "
+                    f"threshold {self.WAN_REBALANCE_THRESHOLD:.0%} — draining to "
+                    f"{self.WAN_REBALANCE_LOW_MARK:.0%}"
+                )
+                self._draining.add(key)
+            elif util <= self.WAN_REBALANCE_LOW_MARK:
+                self._draining.discard(key)
+
+        if not self._draining:
+            return {key: (w['used_dl'], w['used_ul']) for key, w in by_key.items()}
+
+        budget = max(int(self.WAN_REBALANCE_BUDGET), 0)
+        dest_heap = [(_utilization(w), key) for key, w in by_key.items() if key not in self._draining]
+        heapq.heapify(dest_heap)
+        assignments = []
+
+        for key in sorted(self._draining, key=lambda k: -_utilization(by_key[k])):
+            src = by_key[key]
+            excess = (src['used_dl'] + src['used_ul']) - self.WAN_REBALANCE_LOW_MARK * (
+                src['dl_limit'] + src['ul_limit'])
+            if excess <= 0 or not dest_heap or budget <= 0:
+                continue
+
+            groups = {}
+            for rowid, dl, ul, ipv4 in conn.execute(
+                f"SELECT rowid, {load_dl}, {load_ul}, ipv4 FROM devices "
+                "WHERE core_name=? AND wan_name=?" + (f" AND {excl_sql}" if excl_sql else ""),
+                [src['core'], src['wan']] + excluded
+            ):
+                ip = self._ip_to_int(ipv4) if prefix and ipv4 else None
+                unit = ('b', ip >> (32 - prefix)) if ip is not None else ('d', rowid)
+                members = groups.setdefault(unit, [0, 0, []])
+                members[0] += dl
+                members[1] += ul
+                members[2].append(rowid)
+            # (weight, dl, ul, rowids), ascending for the bisect below
+            units = sorted((dl + ul, dl, ul, rowids) for dl, ul, rowids in groups.values())
+            weights = [u[0] for u in units]
+
+            while excess > 0 and units and budget > 0:
+                i = bisect.bisect_left(weights, excess)
+                i = i if i < len(units) else len(units) - 1
+                weight, dl, ul, rowids = units.pop(i)
+                weights.pop(i)
+                if len(rowids) > budget:
+                    continue
+                util, dest_key = dest_heap[0]
+                dest = by_key[dest_key]
+                cap = dest['dl_limit'] + dest['ul_limit']
+                if cap <= 0 or (dest['used_dl'] + dest['used_ul'] + weight) / cap > self.WAN_REBALANCE_LOW_MARK:
+                    continue
+                heapq.heappop(dest_heap)
+                assignments.extend((dest['core'], dest['wan'], rowid) for rowid in rowids)
+                dest['used_dl'] += dl
+                dest['used_ul'] += ul
+                src['used_dl'] -= dl
+                src['used_ul'] -= ul
+                heapq.heappush(dest_heap, (_utilization(dest), dest_key))
+                excess -= weight
+                budget -= len(rowids)
+
+        if assignments:
+            conn.executemany("UPDATE devices SET core_name=?, wan_name=? WHERE rowid=?", assignments)
+            conn.commit()
+            logger.info(
+                f"Rebalanced {len(assignments)} device(s) off {len(self._draining)} draining WAN(s) "
+                f"(budget {self.WAN_REBALANCE_BUDGET} per cycle)"
+            )
+        for key in list(self._draining):
+            if _utilization(by_key[key]) <= self.WAN_REBALANCE_LOW_MARK:
+                self._draining.discard(key)
+        return {key: (w['used_dl'], w['used_ul']) for key, w in by_key.items()}
+
+    def _assign_by_hash(self, conn, wans, excl_sql, excluded, load_cols):
+        """
+        Capacity-weighted rendezvous (highest-random-weight) placement: each
+        device goes to the WAN with the highest capacity / -ln(h), where h is
+        a uniform hash of (core, WAN, device code) in (0, 1). Every WAN wins a
+        share of devices proportional to its dl_limit + ul_limit, and a
+        device's WAN only changes when the WAN it hashed to is removed or a
+        new WAN outscores it — no state is kept between cycles.
+        Balances device counts, not load; O(devices × WANs) hashes per cycle.
+        Only rows whose placement differs are written.
+        """
+        keys = [
+            (w, hashlib.blake2b(f"{w['core']}/{w['wan']}".encode(), digest_size=16).digest(),
+             float(w['dl_limit'] + w['ul_limit']))
+            for w in wans
+        ]
+        keys = [k for k in keys if k[2] > 0] or [(w, key, 1.0) for w, key, _ in keys]
+
+        devices = conn.execute(
+            "SELECT rowid, code, core_name, wan_name FROM devices"
+            + (f" WHERE {excl_sql}" if excl_sql else ""),
             excluded
         ).fetchall()
 
-        totals = {(w['core'], w['wan']): (w['used_dl'], w['used_ul']) for w in wans}
+        assignments = []
+        for rowid, code, core_name, wan_name in devices:
+            data = code.encode()
+            best, best_score = None, -1.0
+            for w, key, weight in keys:
+                h = int.from_bytes(hashlib.blake2b(data, digest_size=8, key=key).digest(), 'big')
+                score = weight / -math.log((h + 0.5) / 2 ** 64)
+                if score > best_score:
+                    best, best_score = w, score
+            if (best['core'], best['wan']) != (core_name, wan_name):
+                assignments.append((best['core'], best['wan'], rowid))
 
-        if not new_devices:
-            # Check if any WAN is overloaded beyond the rebalance threshold
-            rebalance_needed = False
-            for w in wans:
-                cap = w['dl_limit'] + w['ul_limit']
-                if cap > 0:
-                    util = (w['used_dl'] + w['used_ul']) / cap
-                    if util > self.WAN_REBALANCE_THRESHOLD:
-                        logger.info(
-                            f"WAN {w['wan']} on {w['core']} utilization {util:.0%} exceeds "
-                            f"threshold {self.WAN_REBALANCE_THRESHOLD:.0%} — triggering rebalance"
-                        )
-                        rebalance_needed = True
-                        break
-
-            if not rebalance_needed:
-                return totals
-
-            # Full rebalance without wiping assignments first: recompute all placements,
-            # then update rows in place.
-            logger.info("Rebalancing all WAN assignments (delta update mode)...")
-            for w in wans:
-                w['used_dl'] = w['used_ul'] = 0
-            new_devices = conn.execute(
-                "SELECT code, download_max_mbps, upload_max_mbps FROM devices"
-                + (excl_sql.replace("AND (source", "WHERE (source") if excl_sql else "")
-                + " ORDER BY weight DESC",
-                excluded
-            ).fetchall()
-
-        def _utilization(w):
-            cap = w['dl_limit'] + w['ul_limit']
-            return (w['used_dl'] + w['used_ul']) / cap if cap > 0 else float('inf')
+        if assignments:
+            conn.executemany(
+                "UPDATE devices SET core_name=?, wan_name=? WHERE rowid=?",
+                assignments
+            )
+            conn.commit()
+            logger.info(f"Rendezvous hashing moved {len(assignments)} of {len(devices)} device(s) "
+                        f"across {len(wans)} WAN(s)")
+
+        load_dl, load_ul = load_cols
+        totals = {(w['core'], w['wan']): (0, 0) for w in wans}
+        for core_name, wan_name, dl, ul in conn.execute(
+            f"SELECT core_name, wan_name, COALESCE(SUM({load_dl}),0), COALESCE(SUM({load_ul}),0) "
+            "FROM devices GROUP BY core_name, wan_name"
+        ):
+            if (core_name, wan_name) in totals:
+                totals[(core_name, wan_name)] = (dl, ul)
+        return totals
+
+    @staticmethod
+    def _utilization(w):
+        cap = w['dl_limit'] + w['ul_limit']
+        return (w['used_dl'] + w['used_ul']) / cap if cap > 0 else float('inf')
+
+    @staticmethod
+    def _ip_to_int(ipv4):
+        try:
+            return int(ipaddress.IPv4Address(ipv4))
+        except (ipaddress.AddressValueError, ValueError):
+            return None
+
+    @staticmethod
+    def _block_owners(conn, prefix):
+        """
+        {block: (core_name, wan_name)} for every aligned /prefix block that
+        already has assigned devices — the WAN holding most of them.
+        """
+        votes = {}
+        for ipv4, core_name, wan_name in conn.execute(
+            "SELECT ipv4, core_name, wan_name FROM devices "
+            "WHERE ipv4 IS NOT NULL AND COALESCE(core_name, '') != '' AND COALESCE(wan_name, '') != ''"
+        ):
+            ip = WANManager._ip_to_int(ipv4)
+            if ip is not None:
+                votes.setdefault(ip >> (32 - prefix), Counter())[(core_name, wan_name)] += 1
+        return {block: counter.most_common(1)[0][0] for block, counter in votes.items()}
+
+    @staticmethod
+    def _pack_wans_by_subnet(wans, devices, prefix, owners):
+        """
+        Subnet-aligned placement of (rowid, dl, ul, ipv4) rows: devices are
+        grouped into aligned /prefix blocks and every block goes to one WAN.
+        A block that already has assigned devices joins its owner WAN; the
+        rest are placed heaviest first on the least-utilised WAN. A block that
+        would push that WAN past its capacity is halved (/prefix+1, ...) until
+        the parts fit or hold a single device. Devices without a valid IPv4
+        are placed on their own.
+        Updates used_dl/used_ul in place; returns [(core_name, wan_name, rowid)].
+        """
+        index = {(w['core'], w['wan']): i for i, w in enumerate(wans)}
+        assignments = []
+
+        def _place(idx, members):
+            wan = wans[idx]
+            for rowid, dl, ul, _ in members:
+                assignments.append((wan['core'], wan['wan'], rowid))
+                wan['used_dl'] += dl
+                wan['used_ul'] += ul
+
+        blocks, loose = {}, []
+        for rowid, dl, ul, ipv4 in devices:
+            ip = WANManager._ip_to_int(ipv4) if ipv4 else None
+            if ip is None:
+                loose.append((rowid, dl, ul, ip))
+            else:
+                blocks.setdefault(ip >> (32 - prefix), []).append((rowid, dl, ul, ip))
+
+        # Work queue of units, heaviest first: (-weight, seq, prefix_len, members)
+        units, seq = [], 0
+        for block, members in blocks.items():
+            owner = owners.get(block)
+            if owner in index:
+                _place(index[owner], members)
+                continue
+            units.append((-sum(dl + ul for _, dl, ul, _ in members), seq, prefix, members))
+            seq += 1
+        for member in loose:
+            units.append((-(member[1] + member[2]), seq, 32, [member]))
+            seq += 1
+        heapq.heapify(units)
+
+        wan_heap = [(WANManager._utilization(w), i) for i, w in enumerate(wans)]
+        heapq.heapify(wan_heap)
+
+        while units:
+            neg_weight, _, plen, members = heapq.heappop(units)
+            _, idx = heapq.heappop(wan_heap)
+            wan = wans[idx]
+            room = (wan['dl_limit'] + wan['ul_limit']) - (wan['used_dl'] + wan['used_ul'])
+            if -neg_weight > room and len(members) > 1 and plen < 32:
+                # Split on the next address bit and retry both halves
+                bit = 1 << (31 - plen)
+                for half in ([m for m in members if not m[3] & bit], [m for m in members if m[3] & bit]):
+                    if half:
+                        heapq.heappush(units, (-sum(dl + ul for _, dl, ul, _ in half), seq, plen + 1, half))
+                        seq += 1
+            else:
+                _place(idx, members)
+            heapq.heappush(wan_heap, (WANManager._utilization(wan), idx))
+        return assignments
+
+    @staticmethod
+    def _pack_wans(wans, devices):
+        """
+        Greedy placement of (rowid, dl, ul) rows onto the least-utilised WAN.
+        Updates each WAN's used_dl/used_ul in place and returns
+        [(core_name, wan_name, rowid)] assignments.
+        """
+        _utilization = WANManager._utilization
 
         heap = [(_utilization(w), i) for i, w in enumerate(wans)]
         heapq.heapify(heap)
 
         assignments = []
-        for code, dl, ul in new_devices:
+        for rowid, dl, ul in devices:
             ratio, idx = heapq.heappop(heap)
             wan = wans[idx]
-            assignments.append((wan['core'], wan['wan'], code))
+            assignments.append((wan['core'], wan['wan'], rowid))
             wan['used_dl'] += dl
             wan['used_ul'] += ul
             heapq.heappush(heap, (_utilization(wan), idx))
+        return assignments
 
-        conn.executemany(
-            "UPDATE devices SET core_name=?, wan_name=? WHERE code=?",
-            assignments
-        )
-        conn.commit()
-        logger.info(f"Assigned {len(new_devices)} new device(s) across {len(wans)} WAN(s)")
+    @staticmethod
+    def _pack_wans_bulk(wans, devices):
+        """
+        NumPy variant of _pack_wans for large batches. Each WAN's share of the
+        new load is the amount that brings it up to the common utilisation level
+        the heap would converge on; devices are then split to those shares in
+        one pass.
+        """
+        rows    = BulkPacker.load_rows(devices)
+        weights = rows[:, 1] + rows[:, 2]
+        caps    = [w['dl_limit'] + w['ul_limit'] for w in wans]
+        used    = [w['used_dl'] + w['used_ul'] for w in wans]
 
-        return {(w['core'], w['wan']): (w['used_dl'], w['used_ul']) for w in wans}
+        level   = (sum(used) + int(weights.sum())) / (sum(caps) or 1)
+        targets = [max(level * cap - u, 0) for cap, u in zip(caps, used)]
+        placement = BulkPacker.pack_to_targets(weights, targets)
+        totals    = BulkPacker.bin_totals(rows[:, 1:], placement, len(wans))
+
+        for w, (dl, ul) in zip(wans, totals.tolist()):
+            w['used_dl'] += dl
+            w['used_ul'] += ul
+
+        labels = [(w['core'], w['wan']) for w in wans]
+        return [(*labels[idx], rowid) for idx, rowid in zip(placement.tolist(), rows[:, 0].tolist())]
+
+    def poll_wan_traffic(self, conn, cores, sample_time=None):
+        """
+        Read the byte counters of every WAN that names its core 'interface' and
+        fold them into a rolling rate per WAN (EWMA with a half-life of
+        WAN_TRAFFIC_HALF_LIFE seconds), stored in the wan_traffic table.
+        Download is rx on the uplink, upload is tx. A counter reset or an
+        interface change just re-baselines. The WAN's assigned load at poll
+        time is stored alongside, for _apply_measured_load. Cores are read
+        concurrently through _run_cores, so an unreachable one costs at most
+        WAN_CORE_SYNC_DEADLINE and no other core waits on it.
+        Returns {(core_name, wan_name): (dl_mbps, ul_mbps)} for the WANs polled.
+        """
+        sample_time = sample_time or time.time()
+        previous = DeviceDatabase.load_wan_traffic(conn)
+        load_dl, load_ul, _ = DeviceDatabase.load_columns(self.USAGE_WEIGHTING)
+        plans = {
+            (core_name, wan_name): (dl, ul)
+            for core_name, wan_name, dl, ul in conn.execute(
+                f"SELECT core_name, wan_name, COALESCE(SUM({load_dl}),0), COALESCE(SUM({load_ul}),0) "
+                "FROM devices GROUP BY core_name, wan_name"
+            )
+        }
+        jobs = []
+        for core in cores:
+            wans = {
+                (core['name'], wan.get('address_list', f"WAN{i}")): wan['interface']
+                for i, wan in enumerate(core.get('wans', []), start=1) if wan.get('interface')
+            }
+            if wans:
+                jobs.append((core, wans))
+        results = self._run_cores(jobs, self._read_interface_counters)
+
+        rows, rates = {}, {}
+        for core, wans in jobs:
+            counters = results[core['name']].get('counters')
+            if counters is None:
+                continue
+            for key, ifname in wans.items():
+                if ifname not in counters:
+                    logger.warning(f"WAN {key[1]} on {core['name']}: interface '{ifname}' not found")
+                    continue
+                rx, tx = counters[ifname]
+                prev = previous.get(key)
+                plan_dl, plan_ul = plans.get(key, (0, 0))
+                row = {'interface': ifname, 'sample_time': sample_time, 'rx_bytes': rx, 'tx_bytes': tx,
+                       'dl_mbps': 0.0, 'ul_mbps': 0.0, 'samples': 0, 'plan_dl': plan_dl, 'plan_ul': plan_ul}
+                dt = sample_time - prev['sample_time'] if prev else 0
+                if (prev and prev['interface'] == ifname and dt > 0
+                        and rx >= prev['rx_bytes'] and tx >= prev['tx_bytes']):
+                    dl = (rx - prev['rx_bytes']) * 8 / dt / 1_000_000
+                    ul = (tx - prev['tx_bytes']) * 8 / dt / 1_000_000
+                    if prev['samples']:
+                        alpha = 1 - 0.5 ** (dt / self.WAN_TRAFFIC_HALF_LIFE)
+                        dl = prev['dl_mbps'] + alpha * (dl - prev['dl_mbps'])
+                        ul = prev['ul_mbps'] + alpha * (ul - prev['ul_mbps'])
+                    row.update(dl_mbps=dl, ul_mbps=ul, samples=prev['samples'] + 1)
+                    rates[key] = (dl, ul)
+                rows[key] = row
+
+        if rows:
+            DeviceDatabase.store_wan_traffic(conn, rows)
+            logger.info(f"Polled traffic on {len(rows)} WAN interface(s)")
+        return rates
+
+    def _read_interface_counters(self, core, wans, deadline):
+        """
+        Worker for poll_wan_traffic: one core's {interface: (rx_bytes, tx_bytes)}
+        under "counters", or no counters and an error. Touches no DB.
+        """
+        result = {"core": core['name'], "added": 0, "removed": 0, "error": ""}
+        try:
+            with self._session(core) as api:
+                if api is None:
+                    logger.warning(f"WAN traffic poll skipped on {core['name']} — connection failed.")
+                    result["error"] = "connection failed"
+                    return result
+                result["counters"] = {
+                    e.get('name'): (int(e.get('rx-byte', 0)), int(e.get('tx-byte', 0)))
+                    for e in api.get_resource('/interface').call(
+                        'print', {'proplist': 'name,rx-byte,tx-byte'}
+                    )
+                }
+        except Exception as ex:
+            logger.warning(f"WAN traffic poll on {core['name']} failed: {ex}")
+            result["error"] = str(ex)
+        return result
+
+    def _apply_measured_load(self, conn, wans):
+        """
+        Re-weight the load of every WAN that has at least
+        WAN_TRAFFIC_MIN_SAMPLES samples no older than WAN_TRAFFIC_MAX_AGE by
+        how much traffic its devices actually generate: its current assigned
+        load times the measured rate per assigned Mbps at poll time, rescaled
+        so the measured WANs keep their combined assigned load. Thresholds and
+        per-device weights keep their meaning, a WAN carrying more than its
+        share shows up as over-utilised, and devices moved since the last poll
+        count immediately instead of waiting for the rolling rate to catch up.
+        """
+        now = time.time()
+        traffic = DeviceDatabase.load_wan_traffic(conn)
+        measured = []
+        for w in wans:
+            t = traffic.get((w['core'], w['wan']))
+            if (t and t['samples'] >= self.WAN_TRAFFIC_MIN_SAMPLES
+                    and now - t['sample_time'] <= self.WAN_TRAFFIC_MAX_AGE):
+                measured.append((w, t))
+        for used, rate, plan in (('used_dl', 'dl_mbps', 'plan_dl'), ('used_ul', 'ul_mbps', 'plan_ul')):
+            weighted = [(w, w[used] * t[rate] / t[plan]) for w, t in measured if t[plan] > 0]
+            total = sum(load for _, load in weighted)
+            if total <= 0:
+                continue
+            scale = sum(w[used] for w, _ in weighted) / total
+            for w, load in weighted:
+                w[used] = load * scale
+        if measured:
+            logger.info(f"Balancing {len(measured)} of {len(wans)} WAN(s) on measured traffic")
 
     def check_wan_capacity(self, wan_totals, cores):
         """
@@ -170,21 +655,135 @@ class WANManager:
             return []
         return [str(n) for n in ipaddress.collapse_addresses(networks)]
 
-    def _build_target_subnets(self, conn, core):
+    @staticmethod
+    def _whole_blocks(conn, prefix, known_only=False):
+        """
+        {block: (core_name, wan_name)} for aligned /prefix blocks owned by one
+        WAN: every host address of the block (all but the network and
+        broadcast address, for blocks of four or more) is a device on it.
+        With known_only, a block whose known devices all sit on one WAN is
+        enough — its unknown addresses are then steered to that WAN too.
+        Blocks containing an unassigned device (e.g. an excluded source) are
+        never whole.
+        """
+        shift = 32 - prefix
+        owners, seen = {}, {}
+        for ipv4, core_name, wan_name in conn.execute(
+            "SELECT ipv4, COALESCE(core_name, ''), COALESCE(wan_name, '') FROM devices "
+            "WHERE ipv4 IS NOT NULL"
+        ):
+            ip = WANManager._ip_to_int(ipv4)
+            if ip is not None:
+                owners.setdefault(ip >> shift, set()).add((core_name, wan_name))
+                seen.setdefault(ip >> shift, set()).add(ip)
+        whole = {}
+        for block, wans in owners.items():
+            owner = next(iter(wans))
+            if len(wans) != 1 or not all(owner):
+                continue
+            if not known_only:
+                first, last = block << shift, ((block + 1) << shift) - 1
+                if shift >= 2:
+                    first, last = first + 1, last - 1
+                if sum(first <= ip <= last for ip in seen[block]) < last - first + 1:
+                    continue
+            whole[block] = owner
+        return whole
+
+    @staticmethod
+    def _aggregate_lossy(owned, blocked, fill_ratio, min_prefix):
+        """
+        Lossy supernet aggregation over {ip_int: wan_name}.
+
+        Walking from /min_prefix down to /31, a block is taken as a supernet
+        for its majority WAN when that WAN's addresses fill at least
+        fill_ratio of the block, no address in it is in blocked (devices on
+        other cores or without a WAN) and no larger supernet already covers it.
+        Addresses of other WANs inside a supernet become exceptions.
+
+        Returns (supernets, exceptions, remaining): the first two are
+        {wan_name: [cidr]}, remaining is {ip_int: wan_name} left uncovered.
+        """
+        supernets, exceptions = {}, {}
+        remaining = dict(owned)
+        for plen in range(min_prefix, 32):
+            shift = 32 - plen
+            members = {}
+            for ip in remaining:
+                members.setdefault(ip >> shift, []).append(ip)
+            blocked_here = {ip >> shift for ip in blocked}
+            for block, ips in members.items():
+                wan_name, count = Counter(remaining[ip] for ip in ips).most_common(1)[0]
+                if count < 2 or count < fill_ratio * (1 << shift) or block in blocked_here:
+                    continue
+                supernets.setdefault(wan_name, []).append(
+                    f"{ipaddress.IPv4Address(block << shift)}/{plen}"
+                )
+                for ip in ips:
+                    other = remaining.pop(ip)
+                    if other != wan_name:
+                        exceptions.setdefault(other, []).append(f"{ipaddress.IPv4Address(ip)}/32")
+        return supernets, exceptions, remaining
+
+    def _build_target_subnets(self, conn, core, wan_sources=None):
         """
         Build target {(wan_name, subnet_str)} from DB IPs, collapsed per WAN.
         Collapsing means IPs within the same CIDR block become a single entry,
         so the address-list is smaller and changes less frequently.
+        In subnet mode a /subnet_prefix block whose host addresses all sit on
+        one WAN (see _whole_blocks) is listed as the block itself, network and
+        broadcast address included; with whole_blocks it is enough that all
+        of the block's known devices do, which steers its unknown, excluded
+        and not yet assigned addresses to that WAN as well.
+
+        With aggregate_fill_ratio below 1.0, mostly-owned supernets are
+        emitted first (see _aggregate_lossy); the minority addresses inside
+        them go to '<wan_name><exception_suffix>' lists, which the core's
+        mangle rules must match before the plain WAN lists.
         """
+        wan_sources = wan_sources or {}
+        prefix, whole = 32, {}
+        if wan_sources.get('mode', 'device') == 'subnet':
+            prefix = int(wan_sources.get('subnet_prefix', 24))
+            whole  = self._whole_blocks(conn, prefix, bool(wan_sources.get('whole_blocks', False)))
+        fill_ratio = float(wan_sources.get('aggregate_fill_ratio', 1.0))
+        suffix     = wan_sources.get('exception_suffix', '-except')
+
+        wan_names = {
+            wan.get('address_list', f"WAN{i}") for i, wan in enumerate(core.get('wans', []), start=1)
+        }
+        owned, blocked = {}, set()
+        for ipv4, core_name, wan_name in conn.execute(
+            "SELECT ipv4, COALESCE(core_name, ''), COALESCE(wan_name, '') FROM devices "
+            "WHERE ipv4 IS NOT NULL"
+        ):
+            ip = self._ip_to_int(ipv4)
+            if ip is None:
+                continue
+            if core_name == core['name'] and wan_name in wan_names:
+                owned[ip] = wan_name
+            elif fill_ratio < 1.0:
+                blocked.add(ip)
+
         target = set()
-        for i, wan in enumerate(core.get('wans', []), start=1):
-            wan_name = wan.get('address_list', f"WAN{i}")
-            ips = [row[0] for row in conn.execute(
-                "SELECT ipv4 FROM devices WHERE core_name=? AND wan_name=? AND ipv4 IS NOT NULL",
-                (core['name'], wan_name)
-            )]
-            for subnet in self._collapse_to_subnets(ips):
-                target.add((wan_name, subnet))
+        if fill_ratio < 1.0:
+            min_prefix = int(wan_sources.get('aggregate_min_prefix', 16))
+            supernets, exceptions, owned = self._aggregate_lossy(owned, blocked, fill_ratio, min_prefix)
+            for wan_name, subnets in supernets.items():
+                target.update((wan_name, subnet) for subnet in subnets)
+            for wan_name, hosts in exceptions.items():
+                target.update((f"{wan_name}{suffix}", subnet)
+                              for subnet in self._collapse_to_subnets(hosts))
+
+        entries = {}
+        for ip, wan_name in owned.items():
+            if whole.get(ip >> (32 - prefix)) == (core['name'], wan_name):
+                block = ip >> (32 - prefix) << (32 - prefix)
+                entries.setdefault(wan_name, set()).add(f"{ipaddress.IPv4Address(block)}/{prefix}")
+            else:
+                entries.setdefault(wan_name, set()).add(f"{ipaddress.IPv4Address(ip)}/32")
+        for wan_name, subnets in entries.items():
+            target.update((wan_name, subnet) for subnet in self._collapse_to_subnets(subnets))
         return target
 
     @staticmethod
@@ -192,39 +791,310 @@ class WANManager:
         """
         Normalize an address string to canonical CIDR form so it can be compared
         against the output of _collapse_to_subnets.
-        MikroTik may return bare host IPs ('10.0.0.1') while our target always
-        produces CIDR notation ('10.0.0.1/32'). Normalizing both sides prevents
-        false-positive diffs that would re-add already-present entries on every run.
+        MikroTik returns /32 entries as bare host IPs ('10.0.0.1') and every
+        other prefix already in canonical network form, so appending '/32' is
+        enough for the common case; ipaddress is only consulted for anything
+        that does not look like a plain IPv4 entry.
         """
+        if '/' in addr:
+            return addr
+        if addr.count('.') == 3:
+            return addr + '/32'
         try:
             return str(ipaddress.ip_network(addr, strict=False))
         except ValueError:
             return addr
 
-    def _build_wan_cache(self, api, core):
+    @staticmethod
+    def _wan_list_names(core, wan_sources=None):
+        """Address lists this core's sync manages: one per WAN, plus exception lists."""
+        wan_names = {
+            wan.get('address_list', f"WAN{i}")
+            for i, wan in enumerate(core.get('wans', []), start=1)
+        }
+        if float((wan_sources or {}).get('aggregate_fill_ratio', 1.0)) < 1.0:
+            suffix = (wan_sources or {}).get('exception_suffix', '-except')
+            wan_names |= {f"{name}{suffix}" for name in wan_names}
+        return wan_names
+
+    def _build_wan_cache(self, api, core, wan_sources=None):
         """
         Fetch current WAN address-list entries from the router.
+
+        One print of /ip/firewall/address-list filtered on the
+        'libreqos-managed' comment and limited to .id/list/address replaces a
+        full fetch per WAN list; the reply is partitioned by list in a single
+        pass. Entries on lists that are not this core's WAN (or exception)
+        lists are ignored, and unmanaged entries are never seen, so a sync
+        only ever removes what it added. Unmanaged entries the previous cache
+        held as UNMANAGED_ENTRY are re-checked (pipelined) and kept while the
+        router still lists them.
         Addresses are normalized to CIDR form so cache keys always match the
         keys produced by _build_target_subnets / _collapse_to_subnets.
         """
         cache = {}
-        wan_names = [
-            wan.get('address_list', f"WAN{i}")
-            for i, wan in enumerate(core.get('wans', []), start=1)
-        ]
+        wan_names = self._wan_list_names(core, wan_sources)
         resource = api.get_resource('/ip/firewall/address-list')
-        for wan_name in wan_names:
-            try:
-                for e in resource.get(list=wan_name):
-                    if e.get('address') and '.id' in e:
-                        normalized = self._normalize_address(e['address'])
-                        cache[(wan_name, normalized)] = e['.id']
-            except Exception as ex:
-                logger.warning(f"Cache init {wan_name} on {core['name']}: {ex}")
+        # A failed fetch propagates: syncing against an empty cache would
+        # re-add every entry, so the caller reports the core as errored instead.
+        entries = resource.call(
+            'print', {'proplist': '.id,list,address'}, {'comment': 'libreqos-managed'}
+        )
+        normalize = self._normalize_address
+        for e in entries:
+            wan_name, addr = e.get('list'), e.get('address')
+            entry_id = e.get('id') or e.get('.id')
+            if wan_name in wan_names and addr and entry_id:
+                cache[(wan_name, normalize(addr))] = entry_id
+
+        held = [
+            key for key, entry_id in self._cache.get(core['address'], {}).items()
+            if entry_id == UNMANAGED_ENTRY and key[0] in wan_names and key not in cache
+        ]
+        replies = [
+            (key, resource.call_async(
+                'print', {'proplist': '.id'},
+                {'list': key[0], 'address': key[1][:-3] if key[1].endswith('/32') else key[1]}
+            ))
+            for key in held
+        ]
+        for key, promise in replies:
+            if list(promise.get()):
+                cache[key] = UNMANAGED_ENTRY
         logger.info(f"WAN cache built for {core['name']}: {len(cache)} entries")
         return cache
 
-    def sync_wan_address_lists(self, conn, cores):
+    def _restore_caches(self, conn, cores, wan_sources=None):
+        """
+        Reload the persisted caches of cores this process has not contacted
+        yet and keep the ones that still match the router (see
+        _validate_cache). A validated core whose target is unchanged is then
+        skipped by phase 1 instead of being re-read in full after a restart.
+        """
+        pending = [
+            core for core in cores
+            if core.get('wans') and core['address'] not in self._cache
+            and core['address'] not in self._restored
+        ]
+        if not pending:
+            return
+        self._restored.update(core['address'] for core in pending)
+        persisted = DeviceDatabase.load_wan_cache(conn)
+        jobs = [(core, persisted[core['address']]) for core in pending if core['address'] in persisted]
+        self._run_cores(jobs, lambda core, cache, deadline: self._validate_cache(core, cache, wan_sources))
+
+    def _validate_cache(self, core, cache, wan_sources=None):
+        """
+        Cheap check of a persisted cache against the router: the managed entry
+        count of every WAN list (count-only prints, pipelined) must match, and
+        WAN_CACHE_SAMPLE_SIZE random cached entries must still exist with the
+        same list and address. On success the cache is adopted as-is;
+        otherwise it is left out and the core's next sync re-reads its lists.
+        """
+        result = {"core": core['name'], "added": 0, "removed": 0, "error": ""}
+        with self._session(core) as api:
+            if api is None:
+                result["error"] = "connection failed"
+                return result
+            resource = api.get_resource('/ip/firewall/address-list')
+
+            managed = {key: entry_id for key, entry_id in cache.items() if entry_id != UNMANAGED_ENTRY}
+            counts = Counter(list_name for list_name, _ in managed)
+            count_replies = [
+                (list_name, resource.call_async(
+                    'print', {'count-only': ''}, {'comment': 'libreqos-managed', 'list': list_name}
+                ))
+                for list_name in self._wan_list_names(core, wan_sources) | set(counts)
+            ]
+            sample = random.sample(sorted(managed.items()), min(self.WAN_CACHE_SAMPLE_SIZE, len(managed)))
+            sample_replies = [
+                (key, resource.call_async('print', {'proplist': '.id,list,address'}, {'id': entry_id}))
+                for key, entry_id in sample
+            ]
+
+            stale = None
+            for list_name, promise in count_replies:
+                live = int(self._entry_id(promise.get()) or 0)
+                if live != counts.get(list_name, 0):
+                    stale = f"{list_name} has {live} managed entries, cache {counts.get(list_name, 0)}"
+            for (list_name, address), promise in sample_replies:
+                rows = list(promise.get())
+                if not rows or (rows[0].get('list'), self._normalize_address(rows[0].get('address', ''))) \
+                        != (list_name, address):
+                    stale = f"{address} ({list_name}) no longer matches"
+
+            if stale:
+                logger.info(f"Persisted WAN cache for {core['name']} is stale ({stale}) — re-reading")
+            else:
+                self._cache[core['address']] = cache
+                logger.info(f"WAN cache restored for {core['name']}: {len(cache)} entries")
+            return result
+
+    @staticmethod
+    def _exact_targets(wan_sources):
+        """True when targets are the plain collapse of each WAN's hosts (no blocks or supernets)."""
+        wan_sources = wan_sources or {}
+        return (wan_sources.get('mode', 'device') != 'subnet'
+                and float(wan_sources.get('aggregate_fill_ratio', 1.0)) >= 1.0)
+
+    def _refresh_targets(self, conn, wan_sources=None):
+        """
+        Bring the per-WAN PrefixSets up to date with the DB and mark the cores
+        whose target changed. Only devices whose (core, WAN, IPv4) differs
+        from the previous cycle touch a PrefixSet, each in O(32). After the
+        first cycle only the devices in the device journal since the last one
+        are read (see DeviceDatabase.journal_changes); the whole table is
+        rescanned only when the journal no longer reaches back that far.
+
+        Subnet mode and lossy aggregation depend on every device in a block,
+        so there any change marks all cores.
+        """
+        wan_sources = wan_sources or {}
+        opts = tuple(wan_sources.get(k) for k in (
+            'mode', 'subnet_prefix', 'whole_blocks', 'aggregate_fill_ratio', 'aggregate_min_prefix',
+            'exception_suffix'
+        ))
+        if opts != self._target_opts:
+            self._target_opts = opts
+            self._placements, self._targets = {}, {}
+            self._journal_version = None
+            self._dirty.add('*')
+
+        exact = self._exact_targets(wan_sources)
+        self._journal_version, changed = DeviceDatabase.journal_changes(conn, self._journal_version)
+        select = ("SELECT code, COALESCE(core_name, ''), COALESCE(wan_name, ''), ipv4 "
+                  "FROM devices WHERE ipv4 IS NOT NULL")
+        if changed is None:
+            # No usable journal position — full scan.
+            current = {code: (core_name, wan_name, ipv4)
+                       for code, core_name, wan_name, ipv4 in conn.execute(select)}
+            codes = set(self._placements) | set(current)
+        else:
+            # Only the devices journaled since the last cycle.
+            current, codes = {}, list(changed)
+            for start in range(0, len(codes), 500):
+                chunk = codes[start:start + 500]
+                current.update(
+                    (code, (core_name, wan_name, ipv4))
+                    for code, core_name, wan_name, ipv4 in conn.execute(
+                        select + f" AND code IN ({','.join('?' * len(chunk))})", chunk
+                    )
+                )
+
+        def _apply(placement, add):
+            core_name, wan_name, ipv4 = placement
+            if not exact:
+                self._dirty.add('*')
+            if not core_name or not wan_name:
+                return
+            ip = self._ip_to_int(ipv4)
+            if ip is None:
+                return
+            prefixes = self._targets.setdefault((core_name, wan_name), PrefixSet())
+            if prefixes.add(ip) if add else prefixes.discard(ip):
+                self._dirty.add(core_name)
+
+        moves = [(code, self._placements.get(code), current.get(code)) for code in codes]
+        moves = [(code, old, new) for code, old, new in moves if old != new]
+        # Every removal before any addition: an address can change hands within
+        # one batch, and a PrefixSet keeps no per-host reference count
+        for code, old, new in moves:
+            if old is not None:
+                _apply(old, add=False)
+        for code, old, new in moves:
+            if new is not None:
+                _apply(new, add=True)
+                self._placements[code] = new
+            else:
+                del self._placements[code]
+
+    def _current_target(self, conn, core, wan_sources=None):
+        """Target {(list_name, subnet)} for a core — from the PrefixSets when exact."""
+        if not self._exact_targets(wan_sources):
+            return self._build_target_subnets(conn, core, wan_sources)
+        target = set()
+        for i, wan in enumerate(core.get('wans', []), start=1):
+            wan_name = wan.get('address_list', f"WAN{i}")
+            prefixes = self._targets.get((core['name'], wan_name))
+            if prefixes:
+                target.update((wan_name, subnet) for subnet in prefixes.cidrs())
+        return target
+
+    @staticmethod
+    def _entry_id(reply):
+        """The new entry's .id from an add reply ('ret' of its !done message)."""
+        done = getattr(reply, 'done_message', None) or {}
+        return done.get('ret', reply if isinstance(reply, str) else None)
+
+    def _apply_changes(self, resource, core, cache, to_add, to_remove, deadline=None):
+        """
+        Push removes, then adds, in pipelined batches of WAN_SYNC_BATCH_SIZE:
+        every command of a batch is sent (tagged) before any reply is read, so
+        a batch costs about one round-trip instead of one per entry. Failed
+        commands are collected per batch and never stop the remaining ones.
+        An add refused because an unmanaged entry already holds the address
+        is cached as UNMANAGED_ENTRY, and removing such a key only drops it
+        from the cache — the router entry is left to whoever created it.
+        No new batch is started once the monotonic deadline has passed.
+        Updates cache in place; returns (added, removed, [error strings]).
+        """
+        batch_size = max(int(self.WAN_SYNC_BATCH_SIZE), 1)
+        added = removed = 0
+        errors = []
+
+        for op, keys in (('remove', sorted(to_remove)), ('add', sorted(to_add))):
+            for start in range(0, len(keys), batch_size):
+                if deadline is not None and time.monotonic() > deadline:
+                    errors.append(f"deadline exceeded: {len(keys) - start} {op} command(s) not sent")
+                    break
+                pending, batch_errors = [], []
+                for key in keys[start:start + batch_size]:
+                    list_name, subnet = key
+                    if op == 'remove' and cache.get(key) == UNMANAGED_ENTRY:
+                        cache.pop(key)
+                        continue
+                    try:
+                        if op == 'remove':
+                            promise = resource.remove_async(id=cache[key])
+                        else:
+                            promise = resource.add_async(
+                                list=list_name, address=subnet, comment='libreqos-managed'
+                            )
+                        pending.append((key, promise))
+                    except Exception as ex:
+                        batch_errors.append(f"{op} {subnet} ({list_name}): {ex}")
+
+                for key, promise in pending:
+                    list_name, subnet = key
+                    try:
+                        reply = promise.get()
+                    except Exception as ex:
+                        if op == 'add' and 'already have such entry' in str(ex):
+                            cache[key] = UNMANAGED_ENTRY
+                            logger.info(f"{subnet} ({list_name}) on {core['name']} is already "
+                                        "listed by an unmanaged entry — leaving it in place")
+                            continue
+                        batch_errors.append(f"{op} {subnet} ({list_name}): {ex}")
+                        if op == 'remove':
+                            cache.pop(key, None)
+                        continue
+                    if op == 'remove':
+                        cache.pop(key, None)
+                        removed += 1
+                    else:
+                        cache[key] = self._entry_id(reply)
+                        added += 1
+                    logger.debug(f"{op} {subnet} ({list_name}) on {core['name']}")
+
+                if batch_errors:
+                    logger.warning(
+                        f"{core['name']}: {len(batch_errors)} of {len(keys[start:start + batch_size])} "
+                        f"{op} command(s) failed in batch {start // batch_size + 1}: {batch_errors[0]}"
+                    )
+                    errors.extend(batch_errors)
+        return added, removed, errors
+
+    def sync_wan_address_lists(self, conn, cores, wan_sources=None, force=False):
         """
         Sync address-list entries on each core router using subnet aggregation.
 
@@ -233,62 +1103,188 @@ class WANManager:
         same subnet do not trigger any router update.
 
         Two-phase approach:
-          1. Collapse DB IPs to subnets and diff against the in-memory cache.
-             Skip the router entirely if the subnet set is unchanged.
+          1. Apply device changes since the last cycle to the per-WAN
+             PrefixSets. A core whose target did not change is skipped
+             without rebuilding anything; otherwise diff against the cache.
           2. Only when subnets changed: connect, re-fetch live state from the
              router, recompute the diff, then add/remove subnets as needed.
+             Changed cores sync concurrently on up to WAN_SYNC_WORKERS threads,
+             each bounded by WAN_CORE_SYNC_DEADLINE seconds.
+
+        force skips phase 1 and verifies every core against the router.
+        Each synced core's cache is persisted in the wan_cache table and, after
+        a restart, reloaded and spot-checked by _restore_caches before use.
+
+        Returns {"ok", "cores": [{"core", "added", "removed", "error"}],
+        "total_added", "total_removed", "errors"}.
         """
+        self._restore_caches(conn, cores, wan_sources)
+        self._refresh_targets(conn, wan_sources)
+        dirty, self._dirty = self._dirty, set()
+
+        results, jobs = {}, []
         for core in cores:
             core_key = core['address']
+            results[core['name']] = {"core": core['name'], "added": 0, "removed": 0, "error": ""}
+
+            if not core.get('wans'):
+                continue
 
-            # Phase 1 — collapse IPs → subnets (free, no connection).
-            target = self._build_target_subnets(conn, core)
+            # Phase 1 — nothing changed for this core since its last sync.
+            if (not force and core_key in self._cache
+                    and '*' not in dirty and core['name'] not in dirty):
+                continue
+
+            target = self._current_target(conn, core, wan_sources)
 
             # Diff against the cached subnet set — skip if nothing changed.
-            if core_key in self._cache:
+            if not force and core_key in self._cache:
                 if target == set(self._cache[core_key]):
                     continue
+            jobs.append((core, target))
+
+        # Phase 2 — cores with changes sync concurrently, each within its deadline.
+        results.update(self._run_cores(
+            jobs, lambda core, target, deadline: self._sync_core(core, target, wan_sources, deadline)
+        ))
+        # Persist what the router now holds; a core that failed or overran its
+        # deadline is dropped, so the next restart re-reads it instead.
+        for core, _ in jobs:
+            ok = not results[core['name']]["error"]
+            DeviceDatabase.store_wan_cache(
+                conn, core['address'], self._cache.get(core['address']) if ok else None
+            )
+        return self._summarize(results)
 
-            # Phase 2 — subnets changed; connect and verify against live state.
-            api = self._connect(core)
+    def purge_managed(self, cores, wan_sources=None):
+        """
+        Remove every 'libreqos-managed' entry from the WAN lists of each core
+        (concurrently, pipelined like a sync) and reset their caches to empty.
+        Returns the same summary as sync_wan_address_lists.
+        """
+        def _purge(core, _, deadline):
+            core_key = core['address']
+            result = {"core": core['name'], "added": 0, "removed": 0, "error": ""}
+            with self._session(core) as api:
+                if api is None:
+                    self._cache.pop(core_key, None)
+                    result["error"] = "connection failed"
+                    return result
+                resource = api.get_resource('/ip/firewall/address-list')
+                cache = self._build_wan_cache(api, core, wan_sources)
+                self._cache[core_key] = cache
+                _, removed, errors = self._apply_changes(resource, core, cache, set(), set(cache), deadline)
+                result["removed"] = removed
+                if errors:
+                    result["error"] = f"{len(errors)} command(s) failed: {errors[0]}"
+                    self._cache.pop(core_key, None)
+                logger.info(f"{core['name']} WAN purge: -{removed}")
+                return result
+
+        results = {core['name']: {"core": core['name'], "added": 0, "removed": 0, "error": ""}
+                   for core in cores}
+        results.update(self._run_cores([(core, None) for core in cores if core.get('wans')], _purge))
+        self._placements, self._targets = {}, {}
+        self._journal_version = None
+        self._dirty.add('*')
+        return self._summarize(results)
+
+    def _run_cores(self, jobs, worker):
+        """
+        Run worker(core, arg, deadline) for each (core, arg) job on up to
+        WAN_SYNC_WORKERS threads, each bounded by WAN_CORE_SYNC_DEADLINE.
+        Returns {core_name: result}; a worker that raises or overruns is
+        reported as an error and its core re-synced next cycle. An overrunning
+        worker keeps running, so its core is skipped (and reported busy) until
+        it has finished — two workers never write one core's lists at once.
+        """
+        results = {}
+        self._inflight = {key: f for key, f in self._inflight.items() if not f.done()}
+        for core, _ in jobs:
+            if core['address'] in self._inflight:
+                logger.warning(f"Previous WAN sync on {core['name']} is still running — skipping")
+                results[core['name']] = {"core": core['name'], "added": 0, "removed": 0,
+                                         "error": "previous sync still running"}
+                self._dirty.add(core['name'])
+        jobs = [(core, arg) for core, arg in jobs if core['address'] not in self._inflight]
+        if not jobs:
+            return results
+        deadline = time.monotonic() + self.WAN_CORE_SYNC_DEADLINE
+        pool = ThreadPoolExecutor(max_workers=max(min(self.WAN_SYNC_WORKERS, len(jobs)), 1))
+        futures = {pool.submit(worker, core, arg, deadline): core for core, arg in jobs}
+        done, late = wait(futures, timeout=self.WAN_CORE_SYNC_DEADLINE + 5)
+        for future, core in futures.items():
+            result = {"core": core['name'], "added": 0, "removed": 0, "error": ""}
+            if future in late:
+                logger.error(f"WAN sync on {core['name']} missed its deadline — retrying once it finishes")
+                result["error"] = "deadline exceeded"
+                self._inflight[core['address']] = future
+            elif future.exception() is not None:
+                logger.error(f"Error syncing address lists on {core['name']}: {future.exception()}")
+                self._cache.pop(core['address'], None)
+                result["error"] = str(future.exception())
+            else:
+                result = future.result()
+            if result["error"]:
+                self._dirty.add(core['name'])
+            results[core['name']] = result
+        pool.shutdown(wait=False)
+        return results
+
+    @staticmethod
+    def _summarize(results):
+        summary = {"ok": True, "cores": [], "total_added": 0, "total_removed": 0, "errors": []}
+        for result in results.values():
+            summary["cores"].append(result)
+            summary["total_added"]   += result["added"]
+            summary["total_removed"] += result["removed"]
+            if result["error"]:
+                summary["ok"] = False
+                summary["errors"].append(f"{result['core']}: {result['error']}")
+        return summary
+
+    def _sync_core(self, core, target, wan_sources, deadline):
+        """
+        Phase 2 for one core: connect, re-fetch its live entries, and push the
+        difference to target. Runs on a worker thread; touches no DB.
+        Returns {"core", "added", "removed", "error"}.
+        """
+        core_key = core['address']
+        result = {"core": core['name'], "added": 0, "removed": 0, "error": ""}
+
+        with self._session(core) as api:
             if api is None:
                 logger.warning(f"Skipping core {core['name']} — connection failed.")
                 self._cache.pop(core_key, None)
-                continue
+                result["error"] = "connection failed"
+                return result
 
             try:
                 resource = api.get_resource('/ip/firewall/address-list')
 
                 # Re-fetch from router so we never add subnets already present.
-                self._cache[core_key] = self._build_wan_cache(api, core)
+                self._cache[core_key] = self._build_wan_cache(api, core, wan_sources)
                 cache = self._cache[core_key]
 
                 to_add    = target - set(cache)
                 to_remove = set(cache) - target
 
                 if not to_add and not to_remove:
-                    continue
-
-                for key in to_remove:
-                    list_name, subnet = key
-                    try:
-                        resource.remove(id=cache[key])
-                        logger.info(f"Removed {subnet} from {list_name} on {core['name']}")
-                    except Exception as ex:
-                        logger.warning(f"Failed to remove {subnet} from {list_name}: {ex}")
-                    cache.pop(key, None)
+                    return result
 
-                for key in to_add:
-                    list_name, subnet = key
-                    try:
-                        new_id = resource.add(list=list_name, address=subnet, comment='libreqos-managed')
-                        cache[key] = new_id
-                        logger.info(f"Added {subnet} to {list_name} on {core['name']}")
-                    except Exception as ex:
-                        logger.warning(f"Failed to add {subnet} to {list_name}: {ex}")
-
-                logger.info(f"{core['name']} WAN sync: +{len(to_add)} / -{len(to_remove)}")
+                added, removed, errors = self._apply_changes(
+                    resource, core, cache, to_add, to_remove, deadline
+                )
+                result.update(added=added, removed=removed)
+                if errors:
+                    result["error"] = f"{len(errors)} command(s) failed: {errors[0]}"
+                logger.info(
+                    f"{core['name']} WAN sync: +{added} / -{removed}"
+                    + (f" ({len(errors)} failed)" if errors else "")
+                )
 
             except Exception as ex:
                 logger.error(f"Error syncing address lists on {core['name']}: {ex}")
                 self._cache.pop(core_key, None)
+                result["error"] = str(ex)
+            return result
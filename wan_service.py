@@ -3,7 +3,10 @@ wan_service.py — standalone WAN assignment and address-list sync daemon.
 
 Runs independently from the device scanner (updatecsv.py) so its cadence
 can be tuned separately. Reads config.json on every cycle, so interval and
-enabled state changes take effect without a restart.
+enabled state changes take effect without a restart. Between cycles it waits
+on the 'devices' change channel, so devices added by a scan or the GUI are
+placed within seconds, and a cycle with no journaled device change and no
+config change skips the DB work.
 
 Typical usage:
     python wan_service.py
@@ -11,6 +14,19 @@ Typical usage:
 config.json knobs (under wan_assignment):
     enabled   (bool, default true)  — master on/off switch
     interval  (int,  default 300)   — seconds between sync cycles
+    mode      (str,  default device) — 'subnet' places aligned CIDR blocks as units;
+        'hash' places each device by capacity-weighted rendezvous hashing of its code
+    subnet_prefix (int, default 24) — block size for mode 'subnet'
+    whole_blocks (bool, default false) — in mode 'subnet', list a block as one entry
+        once all its known devices share a WAN, steering its unknown addresses
+        too; otherwise only when every host address in it is on that WAN
+    aggregate_fill_ratio (float, default 1.0) — below 1.0, list a supernet on the
+        WAN owning at least this fraction of it; other WANs' hosts inside go to
+        '<list><exception_suffix>' lists (match those first on the core)
+    aggregate_min_prefix (int, default 16) — largest supernet considered
+    exception_suffix (str, default '-except')
+    balance_by_traffic (bool, default false) — balance on the rolling rate measured on
+        each WAN's core 'interface' (cores[].wans[].interface) instead of plan sums
 """
 
 import json
@@ -48,6 +64,13 @@ def _read_wan_config():
             'enabled':         wan_cfg.get('enabled',         True),
             'include_hotspot': wan_cfg.get('include_hotspot', False),
             'include_dhcp':    wan_cfg.get('include_dhcp',    False),
+            'mode':            wan_cfg.get('mode',            'device'),
+            'subnet_prefix':   wan_cfg.get('subnet_prefix',   24),
+            'whole_blocks':    wan_cfg.get('whole_blocks',    False),
+            'aggregate_fill_ratio': wan_cfg.get('aggregate_fill_ratio', 1.0),
+            'aggregate_min_prefix': wan_cfg.get('aggregate_min_prefix', 16),
+            'exception_suffix':     wan_cfg.get('exception_suffix',     '-except'),
+            'balance_by_traffic':   wan_cfg.get('balance_by_traffic',   False),
         }
         interval = int(wan_cfg.get('interval', DEFAULT_INTERVAL))
         return cores, wan_sources, interval
@@ -69,10 +92,17 @@ def main():
     db = DeviceDatabase(DB_FILE, SHAPED_DEVICES_CSV, NETWORK_JSON)
     db.open()
 
-    wan_mgr = WANManager(RouterScanner.connect)
+    wan_mgr = WANManager(RouterScanner.connect_pool)
+
+    # Device journal version and config the last clean cycle worked from; a
+    # cycle with neither changed (and nothing left to rebalance) is skipped.
+    # The journal is written by triggers, so GUI edits count as much as scans.
+    last_version, last_config = None, None
+    published = db.change_version()
 
     while True:
         cores, wan_sources, interval = _read_wan_config()
+        version = DeviceDatabase.journal_version(db.conn)
 
         try:
             if not wan_sources.get('enabled', True):
@@ -80,17 +110,37 @@ def main():
             elif not cores:
                 logger.info("No cores configured — sleeping.")
             else:
-                wan_totals = wan_mgr.assign_wan_nodes(db.conn, cores, wan_sources)
-                wan_mgr.check_wan_capacity(wan_totals, cores)
-                wan_mgr.sync_wan_address_lists(db.conn, cores)
-                logger.info(f"WAN cycle complete. Next in {interval}s.")
+                wan_mgr.poll_wan_traffic(db.conn, cores)
+                config = (cores, wan_sources)
+                if (version == last_version and config == last_config
+                        and not wan_sources.get('balance_by_traffic', False)
+                        and not wan_mgr.is_rebalancing()):
+                    logger.info(f"No device changes — WAN cycle skipped. Next in {interval}s.")
+                else:
+                    wan_totals = wan_mgr.assign_wan_nodes(db.conn, cores, wan_sources)
+                    # The assignment's own core_name/wan_name writes are journaled
+                    # too; move past them unless a device was added meanwhile, as
+                    # that one may have missed this assignment
+                    settled, changes = DeviceDatabase.journal_changes(db.conn, version)
+                    if changes is not None and 'insert' not in changes.values():
+                        version = settled
+                    wan_mgr.check_wan_capacity(wan_totals, cores)
+                    summary = wan_mgr.sync_wan_address_lists(db.conn, cores, wan_sources)
+                    if summary["ok"]:
+                        last_version, last_config = version, config
+                        logger.info(f"WAN cycle complete. Next in {interval}s or on device changes.")
+                    else:
+                        # Failed or overrunning cores are retried next cycle
+                        last_version, last_config = None, None
+                        logger.warning(f"WAN cycle finished with errors: {'; '.join(summary['errors'])}")
 
         except Exception as e:
             logger.error(f"Error in WAN cycle: {e}")
             time.sleep(ERROR_RETRY_INTERVAL)
             continue
 
-        time.sleep(interval)
+        # Wake early when updatecsv or the GUI publishes a device change
+        published = db.wait_for_change(published, interval)
 
 
 if __name__ == "__main__":